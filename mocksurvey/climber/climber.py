@@ -1,5 +1,7 @@
 import os
+import pickle
 import pathlib
+import functools
 from typing import Union, Sequence, Optional
 import json
 from packaging.version import parse as vparse
@@ -10,6 +12,12 @@ import halotools as ht
 from . import util
 from .. import mocksurvey as ms
 
+# Rough peak memory (in bytes) of one run of the UniverseMachine lightcone
+# code, used to limit how many run at once. It reads the sfr_catalog
+# snapshots bracketing each redshift, which are ~2 GB each (see the sizes
+# in UMWgetter), so this allows for two of them in memory
+LIGHTCONE_MEM_COST = int(4e9)
+
 
 def lightcone(z_low, z_high, x_arcmin, y_arcmin,
               executable=None, umcfg=None, samples=1,
@@ -19,7 +27,8 @@ def lightcone(z_low, z_high, x_arcmin, y_arcmin,
               outfilepath=None, outfilebase=None, id_tag=None,
               do_collision_test=False, ra=0.,
               dec=0., theta=0., rseed=None,
-              keep_ascii_files=False, start_from_ascii=False):
+              keep_ascii_files=False, start_from_ascii=False,
+              workers=1, resume=False):
 
     # Predict/generate filenames
     fake_id = "_tmp_file_made_by_universemachine_"
@@ -44,25 +53,45 @@ def lightcone(z_low, z_high, x_arcmin, y_arcmin,
     if umcfg is None:
         umcfg = ms.UMConfig().get_lightcone_config()
 
+    convert_kw = dict(
+        calibration=calibration, nomags=nomags, fit_with_mass=fit_with_mass,
+        photbands=photbands, obs_mass_limit=obs_mass_limit,
+        true_mass_limit=true_mass_limit)
+    indices = range(len(moved_files))
+    if resume:
+        indices = [i for i in indices if not util.is_complete(
+            ".".join(moved_files[i].split(".")[:-1]), "convert")]
+
     if not start_from_ascii:
-        # Execute the lightcone code in the UniverseMachine package
-        if util.execute_lightcone_code(
-                *args[:4], executable, umcfg, samples, id_tag=fake_id,
-                do_collision_test=do_collision_test,
-                ra=ra, dec=dec, theta=theta, rseed=rseed):
-            raise RuntimeError("lightcone code failed")
-
-        # Move lightcone files to their desired locations
+        # Run one process of the UniverseMachine lightcone code per
+        # realization, converting its output while it is being written
         pathlib.Path(data_dir).mkdir(parents=True, exist_ok=True)
-        for origin, destination in zip(files, moved_files):
-            pathlib.Path(origin).rename(destination)
-
-    # Convert the enormous ascii file into a binary table + meta data
-    for filename in moved_files:
-        util.convert_ascii_to_npy_and_json(
-            filename, calibration, nomags=nomags, fit_with_mass=fit_with_mass,
-            remove_ascii_file=not keep_ascii_files, photbands=photbands,
-            obs_mass_limit=obs_mass_limit, true_mass_limit=true_mass_limit)
+        if rseed is None:
+            # Realizations are seeded by rseed + index, so they never share
+            # a seed (as they could if each were seeded by the time)
+            rseed = int(np.random.randint(2**31 - len(moved_files)))
+        generate = functools.partial(
+            util.generate_lightcone_realization, z_low=z_low, z_high=z_high,
+            x_arcmin=x_arcmin, y_arcmin=y_arcmin, executable=executable,
+            umcfg=umcfg, id_tag=fake_id, rseed=rseed,
+            keep_ascii_file=keep_ascii_files, lightcone_kw=dict(
+                do_collision_test=do_collision_test, ra=ra, dec=dec,
+                theta=theta), **convert_kw)
+        # The lightcone code itself needs a few GB; conversion is streamed
+        # (a realization whose lightcone code fails raises RuntimeError)
+        util.run_realizations(
+            generate, [(i, moved_files[i]) for i in indices],
+            workers=workers, mem_costs=[LIGHTCONE_MEM_COST] * len(indices))
+    else:
+        # Convert the enormous ascii file into a binary table + meta data
+        convert = functools.partial(
+            util.convert_ascii_to_npy_and_json,
+            remove_ascii_file=not keep_ascii_files, **convert_kw)
+        # Rough peak memory: parsed rows + the calibration data
+        files = [moved_files[i] for i in indices]
+        util.run_realizations(
+            convert, [(f,) for f in files], workers=workers,
+            mem_costs=[os.path.getsize(f) // 2 + int(1e9) for f in files])
 
     # Print location of the stored files
     ms.LightConeConfig(data_dir).auto_add()
@@ -74,7 +103,9 @@ def lightcone_selection(input_name: Union[str, object],
                         outfile: Optional[str] = None,
                         input_realization: Union[
                             str, int, Sequence[int]] = "all",
-                        nblocks_per_dim: int = 1) -> None:
+                        nblocks_per_dim: int = 1,
+                        workers: int = 1,
+                        resume: bool = False) -> None:
     """
     Take an input lightcone and perform a selection and optionally
     break it up into sky regions. The resulting lightcone is saved
@@ -98,6 +129,12 @@ def lightcone_selection(input_name: Union[str, object],
     nblocks_per_dim : int (default=1)
         Integer greater than 1 will break up the lightcone into
         data into nblocks_per_dim^2 different equal-sized sky regions
+    workers : int (default=1)
+        Number of realizations to process in parallel processes,
+        limited further by the memory currently available
+    resume : bool (default=False)
+        If True, the output directory may already exist, and
+        realizations previously completed there are skipped
 
     Returns
     -------
@@ -112,7 +149,6 @@ def lightcone_selection(input_name: Union[str, object],
     if selector is None:
         selector = ms.util.selector_from_meta(config.load_meta(0))
 
-    nblocks = nblocks_per_dim ** 2
     if input_realization is None or input_realization == "all":
         input_realization = range(len(config["files"]))
     input_realization = np.ravel(input_realization)
@@ -121,45 +157,62 @@ def lightcone_selection(input_name: Union[str, object],
     assert ms.util.is_int(input_realization), "Integer realizations required"
     if not ms.util.explicit_path(output_name, assert_dir=True):
         output_name = ms.UMConfig().get_path("lightcones", output_name)
-        pathlib.Path(output_name).mkdir(parents=True)
+        pathlib.Path(output_name).mkdir(parents=True, exist_ok=resume)
 
+    arglist, mem_costs = [], []
     for index in input_realization:
         num = f"_{index}" if len(input_realization) > 1 else ""
         base_fn = f"{config['files'][index]}"[:-4] \
             if outfile is None else f"{outfile}{num}"
         base_fn = os.path.join(output_name, base_fn)
+        if resume and util.is_complete(base_fn, "selection"):
+            continue
 
-        cat, meta = config.load(index)
-        cat = cat[selector(cat)]
-        block_digits = selector.block_digitize(cat, (nblocks_per_dim,
-                                                     nblocks_per_dim))
-        for i in range(nblocks):
-            num = f"-{i}" if nblocks > 1 else ""
-            phot_fn = f"{base_fn}{num}.npy"
-            meta_fn = f"{base_fn}{num}.json"
-
-            mask = block_digits == i
-            cat_block = cat[mask]
-
-            selector_num = max([1, *(int(key.split("_")[-1]) + 1
-                                     for key in meta.keys()
-                                     if key.startswith("selector_"))])
-            np.save(phot_fn, cat_block)
-            with open(meta_fn, "w") as f:
-                json.dump({**meta, f"selector_{selector_num}":
-                           repr(selector)}, f, indent=4)
+        arglist.append((config, index, selector, base_fn, nblocks_per_dim))
+        mem_costs.append(2 * os.path.getsize(
+            config.get_path(config["files"][index])))
+    util.run_realizations(_select_realization, arglist,
+                          workers=workers, mem_costs=mem_costs)
 
     # Print location of the stored files
     ms.LightConeConfig(output_name).auto_add()
 
 
+def _select_realization(config, index, selector, base_fn, nblocks_per_dim):
+    nblocks = nblocks_per_dim ** 2
+    cat, meta = config.load(index)
+    cat = cat[selector(cat)]
+    block_digits = selector.block_digitize(cat, (nblocks_per_dim,
+                                                 nblocks_per_dim))
+    for i in range(nblocks):
+        num = f"-{i}" if nblocks > 1 else ""
+        phot_fn = f"{base_fn}{num}.npy"
+        meta_fn = f"{base_fn}{num}.json"
+
+        mask = block_digits == i
+        cat_block = cat[mask]
+
+        selector_num = max([1, *(int(key.split("_")[-1]) + 1
+                                 for key in meta.keys()
+                                 if key.startswith("selector_"))])
+        np.save(phot_fn, cat_block)
+        with open(meta_fn, "w") as f:
+            json.dump({**meta, f"selector_{selector_num}":
+                       repr(selector)}, f, indent=4)
+    util.mark_complete(base_fn, "selection")
+
+
 def lightcone_spectra(input_name: str = ".",
                       input_realization: Union[
                           str, int, Sequence[int]] = "all",
                       make_specmap: bool = False,
                       best_of: int = 6,
                       calibration="uvista",
-                      photbands: Sequence[str] = None):
+                      photbands: Sequence[str] = None,
+                      workers: int = 1,
+                      resume: bool = False,
+                      spec_format: str = "f4",
+                      fill_library: bool = False):
     """
     Take an input lightcone and perform a selection and optionally break it
     up into sky regions. The resulting data is saved in the same directory,
@@ -184,6 +237,23 @@ def lightcone_spectra(input_name: str = ".",
     photbands : list[str] (default = ['g', 'r', 'y', 'j'])
         Photometric bands used for nearest-neighbor color matching
         of the nearest `best_of` neighbors
+    workers : int (default = 1)
+        Number of realizations to process in parallel processes,
+        limited further by the memory currently available
+    resume : bool (default = False)
+        If True, skip realizations whose spectra were already
+        completed by a previous (possibly interrupted) run, and continue
+        computing apparent magnitudes where an interrupted run left off
+        (only if its neighbor matches are the same, e.g. given a seed)
+    spec_format : str (default = "f4")
+        Storage format of the '.spec' files: "f4" (float32),
+        "log16" (16-bit log-quantized, see util.Log16Specmap), or
+        "sparse" (neighbors and weights only, see util.SparseSpecmap)
+    fill_library : bool (default = False)
+        If True, stack spectra from a copy of Sean's library whose NaNs
+        are filled once and cached (SeanSpectraConfig.filled_specmap),
+        so that stacked spectra only need filling where redshifting
+        moves them off the wavelength grid
 
     Returns
     -------
@@ -204,47 +274,79 @@ def lightcone_spectra(input_name: str = ".",
     input_realization = np.atleast_1d(input_realization)
 
     assert ms.util.is_int(input_realization)
+    if fill_library:
+        # Fill the library once here, rather than in every worker
+        ms.SeanSpectraConfig().filled_specmap()
 
+    arglist, mem_costs = [], []
     for index in input_realization:
         base_fn = f"{config['files'][index]}"[:-4]
         base_fn = os.path.join(input_name, base_fn)
-
-        meta_fn = f"{base_fn}.json"
-        prop_fn = f"{base_fn}.specprop"
-        if make_specmap:
-            spec_fn = f"{base_fn}.spec"
-        else:
-            spec_fn = None
-
-        cat, meta = config.load(index)
-        ngal = len(cat)
-        meta = util.metadict_with_specprop(meta)
-        if make_specmap:
-            meta = util.metadict_with_spec(meta, ngal)
-
-        nfinder = NeighborSeanSpecFinder(cat, photbands=photbands,
-                                         calibration=calibration)
-        nearest = nfinder.find_nearest_specid(
-            num_nearest=best_of, bestcolor=True)
-        propcat = nfinder.specprops(nearest, cosmo=ms.bplcosmo,
-                                    specmap_filename=spec_fn,
-                                    progress=True)
-
-        with open(meta_fn, "w") as f:
-            json.dump(meta, f, indent=4)
-        np.save(prop_fn, propcat)
-        os.rename(prop_fn + ".npy", prop_fn)
+        if resume and util.is_complete(base_fn, "spectra"):
+            continue
+
+        arglist.append((config, index, base_fn, make_specmap, best_of,
+                        calibration, photbands, spec_format, resume,
+                        fill_library))
+        # Rough peak memory: catalog copies + UltraVISTA/spectra tables
+        mem_costs.append(3 * os.path.getsize(
+            config.get_path(config["files"][index])) + int(2e9))
+    util.run_realizations(_spectra_realization, arglist,
+                          workers=workers, mem_costs=mem_costs)
 
     # Print location of the stored files
     ms.LightConeConfig(input_name).auto_add()
 
 
+def _spectra_realization(config, index, base_fn, make_specmap, best_of,
+                         calibration, photbands, spec_format="f4",
+                         resume=False, fill_library=False):
+    meta_fn = f"{base_fn}.json"
+    prop_fn = f"{base_fn}.specprop"
+    if make_specmap:
+        spec_fn = f"{base_fn}.spec"
+    else:
+        spec_fn = None
+
+    cat, meta = config.load(index)
+    ngal = len(cat)
+    meta = util.metadict_with_specprop(meta)
+    if make_specmap:
+        meta = util.metadict_with_spec(meta, ngal, spec_format)
+
+    nfinder = NeighborSeanSpecFinder(cat, photbands=photbands,
+                                     calibration=calibration,
+                                     fill_library=fill_library)
+    nearest = nfinder.find_nearest_specid(
+        num_nearest=best_of, bestcolor=True)
+    propcat = nfinder.specprops(nearest, cosmo=ms.bplcosmo,
+                                specmap_filename=spec_fn,
+                                spec_format=spec_format,
+                                progress=True,
+                                # (the specmap can't resume, so neither can this)
+                                checkpoint=None if make_specmap
+                                else f"{base_fn}.appmags", resume=resume)
+
+    with open(meta_fn, "w") as f:
+        json.dump(meta, f, indent=4)
+    np.save(prop_fn, propcat)
+    os.rename(prop_fn + ".npy", prop_fn)
+    util.mark_complete(base_fn, "spectra")
+
+
 class UVData:
-    def __init__(self, calibration, photbands=None):
+    def __init__(self, calibration, photbands=None, cache=True):
+        """
+        If cache=True, the processed columns (and fitted mass-to-light
+        models, see UMData) are saved to hidden files in the data
+        directory, keyed by the input files and parameters, so later
+        runs don't have to parse the catalog or train again
+        """
         self.calibration = calibration
         self.photbands = ms.available_calibrations[
             calibration].get_photbands(photbands)
         self.names = ["M_" + key for key in self.photbands]
+        self.cache = cache
 
         # Load UltraVISTA columns: mass, sSFR_UV, redshift, mass-to-light
         (self.z, self.logm, self.logssfr_uv,
@@ -254,9 +356,34 @@ class UVData:
     def m2l(self):
         return self.logm[:, None] + self.abs_mag.values / 2.5
 
+    @property
+    def config(self):
+        return ms.available_calibrations[self.calibration](
+            photbands=self.photbands)
+
     def load_uvista(self):
-        uvista_cat = ms.available_calibrations[self.calibration](
-            photbands=self.photbands).load()
+        if not self.cache:
+            return self._load_uvista()
+        config = self.config
+        files = [config.get_filepath(ftype) for ftype in config.FILES]
+        key = util.input_hash(util.file_signature(*files), self.photbands,
+                              repr(ms.bplcosmo))
+
+        def load(path):
+            with np.load(path) as f:
+                abs_mag = pd.DataFrame(f["abs_mag"], columns=self.photbands)
+                return f["z"], f["logm"], f["logssfr_uv"], abs_mag, f["id"]
+
+        def save(cols, path):
+            z, logm, logssfr_uv, abs_mag, uvista_id = cols
+            np.savez(path, z=z, logm=logm, logssfr_uv=logssfr_uv,
+                     abs_mag=abs_mag.values, id=uvista_id)
+
+        return util.cached_file(config.get_path(), "uvdata.npz", key,
+                                self._load_uvista, load, save)
+
+    def _load_uvista(self):
+        uvista_cat = self.config.load()
 
         z = uvista_cat["redshift"].values
         logm = uvista_cat["logm"].values
@@ -367,8 +494,20 @@ class UMData:
         y = self.uvdat.m2l
         s = np.isfinite(x).all(axis=1) & np.isfinite(y).all(axis=1)
 
-        regressor = ensemble.RandomForestRegressor(n_estimators=10)
-        regressor.fit(x[s], y[s])
+        params = dict(n_estimators=10, random_state=self.seed)
+
+        def fit():
+            regressor = ensemble.RandomForestRegressor(**params)
+            return regressor.fit(x[s], y[s])
+
+        if self.uvdat.cache:
+            import joblib
+            key = util.input_hash(x[s], y[s], **params)
+            regressor = util.cached_file(
+                self.uvdat.config.get_path(), "m2l-model.joblib", key, fit,
+                joblib.load, joblib.dump)
+        else:
+            regressor = fit()
 
         s = np.isfinite(self.logssfr_uv)
         x = [self.logssfr_uv, self.z]
@@ -383,31 +522,47 @@ class UMData:
 
 
 class SeanSpecStacker:
-    def __init__(self, uvista_z, uvista_id):
+    def __init__(self, uvista_z, uvista_id, fill_library=False):
+        """
+        If fill_library=True, stack spectra from the copy of the library
+        whose NaNs were filled once (SeanSpectraConfig.filled_specmap)
+        """
+        self.fill_library = fill_library
         self.config = ms.SeanSpectraConfig()
         self.wave = self.config.wavelength()
         self.specid = self.config.specid()
         self.isnan = self.config.isnan()
-        self.get_specmap = self.config.specmap()
-
-        redshifts = pd.DataFrame(dict(
-                        z=uvista_z,
-                        uvista_idx=np.arange(len(uvista_z))),
-                        index=uvista_id)
-        fullmapper = pd.DataFrame(dict(
-                        idx=np.arange(len(self.specid)),
-                        hex=[hex(s) for s in self.specid]),
-                        index=self.specid)
-        self.mapper = pd.merge(fullmapper.iloc[~self.isnan], redshifts,
-                               left_index=True, right_index=True)
+        if fill_library:
+            self.get_specmap = self.config.filled_specmap()
+        else:
+            self.get_specmap = self.config.specmap()
+        self.resample = util.RedshiftResampler(self.wave)
+
+        # Map UltraVISTA ID --> specmap row and UltraVISTA catalog row
+        self.specid_index = self.config.specid_index()
+        self.uvista_index = ms.util.id_index(uvista_id)
+        self.uvista_z = np.asarray(uvista_z)
 
     @property
     def bytes_per_spec(self):
         specmap = self.get_specmap()
         return specmap.itemsize * specmap.shape[-1]
 
+    def read_specs(self, specids, max_read_bytes=int(1e8)):
+        """
+        Spectra of the given UltraVISTA IDs (any shape), read from the
+        memmap in sorted, coalesced order (see util.gather_rows)
+        """
+        return util.gather_rows(self.get_specmap(),
+                                self.id2idx_specmap(specids),
+                                max_read_bytes=max_read_bytes)
+
     def avg_spectrum(self, specids, lumcorrs, redshift, cosmo=None,
-                     return_each_spec=False):
+                     return_each_spec=False, specs=None):
+        """
+        `specs` may be given if the spectra of `specids` have already
+        been read with read_specs()
+        """
         if cosmo is None:
             cosmo = ms.bplcosmo
         is_scalar = not ms.util.is_arraylike(specids)
@@ -419,17 +574,10 @@ class SeanSpecStacker:
         idx = self.id2idx_specmap(specids)
         z = self.id2redshift(specids)
 
-        lumcorrs = lumcorrs * ms.util.redshift_rest_flux_correction(
-            from_z=z, to_z=redshift[:, None], cosmo=cosmo)
-
-        specs = self.get_specmap()[idx, :] * lumcorrs[:, :, None]
-        waves = self.wave[None, None, :] / (1 + z[:, :, None])
-        truewave = self.wave[None, :] / (1 + redshift[:, None])
-
-        eachspec = [[np.interp(truewave_i, wave_ij, spec_ij,
-                               left=np.nan, right=np.nan)
-                     for wave_ij, spec_ij in zip(waves_i, specs_i)]
-                    for truewave_i, waves_i, specs_i in zip(truewave, waves, specs)]
+        if specs is None:
+            specs = util.gather_rows(self.get_specmap(), idx)
+        eachspec = util.shift_spectra(specs, self.resample, z, lumcorrs,
+                                      redshift, cosmo)
         avgspec = np.mean(eachspec, axis=1)
         if is_scalar:
             avgspec, eachspec = avgspec[0], eachspec[0]
@@ -439,27 +587,64 @@ class SeanSpecStacker:
             return avgspec
 
     def id2redshift(self, uvista_id):
-        return np.reshape(self.mapper["z"].loc[
-                        np.ravel(uvista_id)].values, np.shape(uvista_id))
+        return self.uvista_z[self.id2idx_uvista(uvista_id)]
 
     def id2idx_uvista(self, uvista_id):
-        return np.reshape(self.mapper["uvista_idx"].loc[
-                        np.ravel(uvista_id)].values, np.shape(uvista_id))
+        return self._lookup(uvista_id)[1]
 
     def id2idx_specmap(self, uvista_id):
-        return np.reshape(self.mapper["idx"].loc[
-                        np.ravel(uvista_id)].values, np.shape(uvista_id))
+        return self._lookup(uvista_id)[0]
+
+    def _lookup(self, uvista_id):
+        # Only IDs with a (non-NaN) spectrum and UltraVISTA data are valid
+        spec_idx = ms.util.lookup_id_index(self.specid_index, uvista_id)
+        if self.isnan[spec_idx].any():
+            raise KeyError(f"IDs have no spectrum: "
+                           f"{np.asarray(uvista_id)[self.isnan[spec_idx]][:10]}")
+        return spec_idx, ms.util.lookup_id_index(self.uvista_index, uvista_id)
+
+
+def kdtree(points, directory=None):
+    """
+    cKDTree of `points`, kept in memory so that it is only built once
+    for every realization that searches the same points. If `directory`
+    is given, the tree is also pickled there (see util.cached_file), so
+    that worker processes and later runs load it instead
+    """
+    from scipy import spatial
+    key = util.input_hash(np.asarray(points))
+    if key not in _kdtrees:
+        def build():
+            return spatial.cKDTree(points)
+
+        def load(path):
+            with open(path, "rb") as f:
+                return pickle.load(f)
+
+        def save(tree, path):
+            with open(path, "wb") as f:
+                pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        _kdtrees.clear()
+        _kdtrees[key] = build() if directory is None else util.cached_file(
+            directory, "kdtree.pickle", key, build, load, save)
+    return _kdtrees[key]
+
+
+_kdtrees = {}
 
 
 class NeighborSeanSpecFinder:
     def __init__(self, umhalos, photbands=None, calibration="uvista",
-                 snapshot_redshift=None, nwin=501, dz=0.05, seed=None):
+                 snapshot_redshift=None, nwin=501, dz=0.05, seed=None,
+                 fill_library=False):
         self.uvdat = UVData(calibration, photbands=photbands)
         self.umdat = UMData(umhalos, uvdat=self.uvdat,
                             snapshot_redshift=snapshot_redshift,
                             nwin=nwin, dz=dz, seed=seed)
         self.stacker = SeanSpecStacker(self.uvdat.z,
-                                       self.uvdat.id)
+                                       self.uvdat.id,
+                                       fill_library=fill_library)
 
     def id2redshift(self, uvista_id):
         return self.stacker.id2redshift(uvista_id)
@@ -470,32 +655,50 @@ class NeighborSeanSpecFinder:
     def id2idx_specmap(self, uvista_id):
         return self.stacker.id2idx_specmap(uvista_id)
 
-    def avg_spectrum(self, specids, lumcorrs, redshift, cosmo=None):
+    def avg_spectrum(self, specids, lumcorrs, redshift, cosmo=None,
+                     specs=None):
         return self.stacker.avg_spectrum(specids, lumcorrs, redshift,
-                                         cosmo=cosmo)
+                                         cosmo=cosmo, specs=specs)
 
     def sublist_indices(self, length, max_mem_usage=int(1e8)):
         sublength = int(max_mem_usage / self.stacker.bytes_per_spec)
         return list(ms.util.generate_sublists(
             list(range(length)), sublength))
 
-    def init_specmap(self, filename, num_spectra):
-        f = np.memmap(filename, self.stacker.get_specmap().dtype, "w+",
-                      shape=(num_spectra, len(self.stacker.wave)))
-        return f
+    def init_specmap(self, filename, num_spectra, spec_format="f4",
+                     num_neighbors=1, cosmo=None):
+        return util.open_specmap(
+            filename, (num_spectra, len(self.stacker.wave)),
+            spec_format=spec_format, mode="w+", num_neighbors=num_neighbors,
+            cosmo=cosmo, fill_library=self.stacker.fill_library)
+
+    def set_sparse_specmap(self, specmap, key, neighbor_id, lumcorrs,
+                           redshift):
+        """
+        Store the stacking recipe of the spectra specmap[key] in a
+        util.SparseSpecmap: the neighbors' spectra, redshifts, and
+        luminosity corrections, and the redshift to shift them to
+        """
+        neighbor_id = np.asarray(neighbor_id).reshape(len(redshift), -1)
+        specmap.set(key, specid=neighbor_id,
+                    row=self.id2idx_specmap(neighbor_id),
+                    from_z=self.id2redshift(neighbor_id),
+                    lumcorr=np.reshape(lumcorrs, neighbor_id.shape),
+                    redshift=redshift)
 
     def write_specmap(self, outfile, neighbor_id, ummask=None,
                       cosmo=None, corr="mass", progress=True,
-                      max_mem_usage=int(1e8)):
+                      max_mem_usage=int(1e8), spec_format="f4"):
         if ummask is None:
             ummask = np.ones(self.umdat.z.shape, dtype=bool)
         iterator = util.progress_iterator(progress)
 
         um_redshift = self.umdat.z[ummask]
-        f = self.init_specmap(outfile, len(um_redshift))
-
         if np.ndim(neighbor_id) == 1:
             neighbor_id = np.asarray(neighbor_id)[:, None]
+        f = self.init_specmap(outfile, len(um_redshift), spec_format,
+                              num_neighbors=neighbor_id.shape[1],
+                              cosmo=cosmo)
 
         if corr is None:
             masscorr = np.ones_like(neighbor_id)
@@ -506,11 +709,23 @@ class NeighborSeanSpecFinder:
         else:
             raise ValueError(f"Invalid corr={corr}")
 
+        if spec_format == "sparse":
+            # Just save what's needed to stack the spectra later
+            self.set_sparse_specmap(f, slice(None), neighbor_id, masscorr,
+                                    um_redshift)
+            f.flush()
+            return
+
         sub_index = self.sublist_indices(len(neighbor_id), max_mem_usage)
+        # Read ahead the spectra of the next sublist while stacking
+        specs = util.prefetch(self.stacker.read_specs, [
+            (neighbor_id[i], max_mem_usage) for i in sub_index])
         for i in iterator(len(sub_index)):
             i = sub_index[i]
             f[i] = self.avg_spectrum(neighbor_id[i], masscorr[i],
-                                     um_redshift[i], cosmo=cosmo)
+                                     um_redshift[i], cosmo=cosmo,
+                                     specs=next(specs))
+        f.flush()
 
     def find_nearest_specid(self, num_nearest=6, bestcolor=True,
                             metric_weights=None, ummask=None, verbose=1):
@@ -520,10 +735,10 @@ class NeighborSeanSpecFinder:
         """
         if not num_nearest:
             return None
-        from sklearn import neighbors
         num_nearest = int(num_nearest)
         if metric_weights is None:
             metric_weights = [1/1.0, 1/0.5, 1/2.0]
+        metric_weights = np.asarray(metric_weights, dtype=float)
         if ummask is None:
             ummask = np.ones(self.umdat.z.shape, dtype=bool)
 
@@ -531,12 +746,6 @@ class NeighborSeanSpecFinder:
         specid = ms.SeanSpectraConfig().specid()[
             ~ms.SeanSpectraConfig().isnan()]
         uvsel = np.isin(self.uvdat.id, specid)
-        # Instantiate the nearest-neighbor regressor with metric
-        # d^2 = (logM/1)^2 + (logsSFR/0.75)^2 + (z/2)^2
-        reg = neighbors.NearestNeighbors(
-                n_neighbors=num_nearest,
-                metric="wminkowski",
-                metric_params=dict(w=metric_weights))
 
         # Predictors:
         uv_x = np.array([self.uvdat.logm,
@@ -549,11 +758,17 @@ class NeighborSeanSpecFinder:
         umsel = ummask
         assert np.isfinite(um_x).all()
 
+        # Scaling the predictors by the weights makes the metric
+        # d^2 = (logM/1)^2 + (logsSFR/0.5)^2 + (z/2)^2 plain Euclidean
+        tree = kdtree(uv_x[uvsel] * metric_weights, directory=(
+            ms.SeanSpectraConfig().get_path() if self.uvdat.cache else None))
+
         # Find nearest neighbor index --> SpecID
-        reg.fit(uv_x[uvsel])
         if verbose:
             print("Assigning nearest-neighbor SpecIDs...")
-        neighbor_index = reg.kneighbors(um_x[umsel])[1]
+        neighbor_index = tree.query(um_x[umsel] * metric_weights,
+                                    k=num_nearest, workers=-1)[1]
+        neighbor_index = neighbor_index.reshape(-1, num_nearest)
         if verbose:
             print("SpecIDs assigned successfully.")
         neighbor_id = np.full((len(self.umdat.logm), num_nearest), -99)
@@ -565,7 +780,9 @@ class NeighborSeanSpecFinder:
         return ans
 
     def specprops(self, specid, ummask=None, cosmo=None,
-                  specmap_filename=None, progress=True):
+                  specmap_filename=None, progress=True, z_grid=None,
+                  workers=1, checkpoint=None, resume=False,
+                  spec_format="f4"):
         """
         Return structured array of spectral properties derived from
         Sean's synthetic spectra
@@ -582,9 +799,27 @@ class NeighborSeanSpecFinder:
         specmap_filename : str (default = None)
             If supplied, save the spectra as they are generated to
             a memory map at this filename (alternative to write_specmap)
+        spec_format : str (default = "f4")
+            Format of the spectra saved to `specmap_filename`: "f4"
+            (float32), "log16" (half the size, see util.Log16Specmap),
+            or "sparse" (a few numbers per galaxy from which spectra are
+            stacked on access, see util.SparseSpecmap)
         progress : bool | str (default = True)
             If True, use tqdm progress bar. If 'notebook', use
             tqdm.notebook progress bar. If False, no progress bar
+        z_grid : array (default = None)
+            If supplied, interpolate apparent magnitudes in redshift
+            from fluxes tabulated on this (fine) grid for each spectrum,
+            instead of integrating a stacked spectrum per galaxy. It
+            must cover the redshifts of all galaxies in `ummask`
+        workers : int (default = 1)
+            Number of processes stacking and integrating spectra
+        checkpoint : str (default = None)
+            If supplied, apparent magnitudes are saved to files at this
+            path (+ extensions) as they are computed
+        resume : bool (default = False)
+            If True, continue from the `checkpoint` of an interrupted
+            call with the same neighbors (and redshifts) where it left off
 
         Returns
         -------
@@ -598,21 +833,19 @@ class NeighborSeanSpecFinder:
         if specmap_filename is None:
             specmap = None
         else:
-            specmap = self.init_specmap(specmap_filename, len(specid))
-        props = self.stacker.config.load()
-        props.index = props["id"].values
-        props = props.loc[specid]
-
-        dtypes = list(zip(props.columns.values, props.dtypes.values))
-        propcat = np.empty(len(props), dtype=dtypes)
-        for key in props.columns.values:
-            propcat[key] = props[key]
+            specmap = self.init_specmap(specmap_filename, len(specid),
+                                        spec_format, cosmo=cosmo)
+        config = self.stacker.config
+        propcat = config.load_table()[config.table_rows(specid)]
 
         um_redshift = self.umdat.z[ummask]
         propcat = util.fix_specprops_columns(self, um_redshift, propcat,
                                              cosmo, max_gband_nan=5000,
                                              specmap=specmap,
-                                             progress=progress)
+                                             progress=progress,
+                                             z_grid=z_grid, workers=workers,
+                                             checkpoint=checkpoint,
+                                             resume=resume)
         return propcat
 
     def lumcorr(self, spec_id, band=None, ummask=None):
@@ -648,14 +881,33 @@ class NeighborSeanSpecFinder:
 
         return 10 ** (um_logm - uv_logm)
 
-    def best_color(self, spec_id, ummask=None):
+    def best_color(self, spec_id, ummask=None, max_mem_usage=int(1e8)):
+        """
+        Of the neighbors in each row of `spec_id`, return the one whose
+        colors (differences of adjacent absolute magnitudes) are closest
+        to the galaxy's, in chunks of rows using < `max_mem_usage` bytes
+        """
         if ummask is None:
             ummask = np.ones(self.umdat.z.shape, dtype=bool)
-
-        um_colors = -np.diff(self.umdat.abs_mag[ummask])
-        nbr_colors = -np.diff(self.uvdat.abs_mag.values[
-                                  self.id2idx_uvista(spec_id)])
-
-        best_neighbor = (np.abs(um_colors[:, None, :] - nbr_colors)
-                         ).sum(axis=2).argmin(axis=1)
-        return spec_id[np.arange(len(spec_id)), best_neighbor]
+        spec_id = np.asarray(spec_id)
+
+        um_mags = self.umdat.abs_mag.values[ummask]
+        uv_mags = self.uvdat.abs_mag.values
+        ncolor = um_mags.shape[1] - 1
+        # Per row: neighbor indices, mags, and running distance
+        row_bytes = spec_id.shape[1] * (8 + 8 * (ncolor + 2))
+        rows = max(1, int(max_mem_usage // row_bytes))
+
+        best = np.empty(len(spec_id), dtype=spec_id.dtype)
+        for start in range(0, len(spec_id), rows):
+            chunk = slice(start, start + rows)
+            ids = spec_id[chunk]
+            nbr_mags = uv_mags[self.id2idx_uvista(ids)]
+            um_colors = -np.diff(um_mags[chunk])
+            # Accumulate |color difference| one color at a time
+            dist = np.zeros(ids.shape)
+            for j in range(ncolor):
+                nbr_color = nbr_mags[..., j] - nbr_mags[..., j + 1]
+                dist += np.abs(um_colors[:, j, None] - nbr_color)
+            best[chunk] = ids[np.arange(len(ids)), dist.argmin(axis=1)]
+        return best
@@ -4,6 +4,7 @@ Modified by Alan Pearl to work the code into my package.
 """
 
 import os
+import functools
 
 import numpy as np
 from scipy.integrate import simps
@@ -22,40 +23,98 @@ class OptimizedFilterIntegrator:
     Provides the functionality of appmag_nm_njy more efficiently
     by saving the rebinned filter transmission curves instead of
     loading them and rebinning for every single spectrum
+
+    Since Simpson's rule over a fixed grid is linear in the integrand,
+    each filter's integral is saved as a weight vector, so that all
+    filters are integrated at once by one matrix product in appmags()
     """
     def __init__(self, wave_o_nm, filter_strings):
         wave_o = wave_o_nm * 10.0  # nm to Ang.
         self.nu = c_A / wave_o
-        self.filter_strings = filter_strings
-
-        self.saved_filters = {
-            s: rebinfilter(readfilter(s), self.nu)
-            for s in self.filter_strings
-        }
-        self.selections = {
-            s: self.saved_filters[s]["transmission"] != 0
-            for s in self.filter_strings
-        }
-
-        # Apply selection on filter transmission curve.
-        # This still needs to be applied on the spectrum itself
-        self.saved_filters = {
-            s: self.saved_filters[s][self.selections[s]]
-            for s in self.filter_strings
-        }
+        self.filter_strings = list(filter_strings)
+
+        # weights @ fnu_njy = numerator of each filter's flux ratio
+        weights = [filter_weights(s, self.nu) for s in self.filter_strings]
+        self.weights = np.array([w for w, _ in weights])
+        self.denominators = np.array([d for _, d in weights])
+        self.selections = self.weights != 0
+
+    def appmags(self, fnu_njy):
+        """
+        Apparent magnitudes of spectra `fnu_njy` (..., N_wave) through
+        every filter, returned as an array of shape (..., N_filters).
+        A spectrum with any NaN inside a filter gets a NaN magnitude
+        """
+        return self.magnitudes(self.fluxes(fnu_njy))
+
+    def fluxes(self, fnu_njy):
+        """
+        Filter-weighted fluxes of spectra `fnu_njy` (..., N_wave) for
+        every filter, in units of the zero point. Since these are linear
+        in the spectrum, they can be averaged or interpolated before
+        being converted to magnitudes(). NaN inside a filter gives NaN
+        """
+        fnu_njy = np.asarray(fnu_njy)
+        isnan = np.isnan(fnu_njy)
+        numerator = np.where(isnan, 0, fnu_njy) @ self.weights.T
+        # NaNs are only a problem where the filter transmits
+        numerator[(isnan @ self.selections.T.astype(np.float32)) > 0] = np.nan
+        return numerator / self.denominators
+
+    @staticmethod
+    def magnitudes(fluxes):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -2.5 * np.log10(fluxes)
 
     def appmag_nm_njy(self, fnu_njy, filter_string):
-        rebinned_filter = self.saved_filters[filter_string]
-        selection = self.selections[filter_string]
+        i = self.filter_strings.index(filter_string)
+        fnu_njy = np.asarray(fnu_njy)[..., self.selections[i]]
+        numerator = fnu_njy @ self.weights[i][self.selections[i]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return -2.5 * np.log10(numerator / self.denominators[i])
+
+
+def filter_weights(filter_string, nu):
+    """
+    Returns (weights, denominator) such that weights @ fnu_njy is the
+    Simpson's rule numerator of appmag_nm_njy for the filter on the
+    frequency grid `nu`. The last FILTER_WEIGHTS_CACHE_SIZE are cached,
+    so redshifted or repeated grids are only rebinned and integrated once
+    """
+    nu = np.asarray(nu, dtype=float)
+    return _filter_weights(filter_string, nu.tobytes())
+
 
-        fnu = fnu_njy[..., selection] / 1e9  # nJy to Jy
-        nu = self.nu[selection]
+# Enough for the filters of a few integrators at once
+FILTER_WEIGHTS_CACHE_SIZE = 64
 
-        numerator = simps(fnu * rebinned_filter['transmission'] / nu, nu)
-        denominator = simps(3631.0 * rebinned_filter['transmission'] / nu, nu)
 
-        m = -2.5 * np.log10(numerator / denominator)
-        return m
+@functools.lru_cache(maxsize=FILTER_WEIGHTS_CACHE_SIZE)
+def _filter_weights(filter_string, nu_bytes):
+    nu = np.frombuffer(nu_bytes, dtype=float)
+    transmission = rebinfilter(readfilter(filter_string),
+                               nu)["transmission"]
+    selection = transmission != 0
+    integrand = transmission[selection] / nu[selection]
+
+    weights = np.zeros(len(nu))
+    weights[selection] = simpson_weights(nu[selection]) * integrand / 1e9
+    denominator = simps(3631.0 * integrand, nu[selection])
+    return weights, denominator
+
+
+def simpson_weights(x, blocksize=256):
+    """
+    Weights w such that w @ y == simps(y, x) for any y
+    """
+    # simps is linear in y, so integrate each unit vector (in blocks)
+    n = len(x)
+    weights = np.empty(n)
+    for i in range(0, n, blocksize):
+        unit = np.zeros((min(blocksize, n - i), n))
+        unit[np.arange(len(unit)), np.arange(i, i + len(unit))] = 1
+        weights[i:i + len(unit)] = simps(unit, x, axis=-1)
+    return weights
 
 
 # Helper function that returns filter transmission curve
@@ -1,13 +1,23 @@
 import os
+import io
+import re
+import hashlib
+import tempfile
+import contextlib
+import time
+import subprocess
+import multiprocessing
 import pathlib
 import json
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                wait, FIRST_COMPLETED)
 from packaging.version import parse as vparse
 import numpy as np
 import pandas as pd
+from astropy import cosmology
 import halotools as ht
 import halotools.utils as ht_utils
 import halotools.empirical_models as ht_empirical_models
-import halotools.sim_manager as ht_sim_manager
 
 from . import climber
 from .. import mocksurvey as ms
@@ -17,52 +27,290 @@ from . import kcorrect
 def convert_ascii_to_npy_and_json(asciifile, calibration, outfilebase=None,
                                   remove_ascii_file=False, fit_with_mass=False,
                                   obs_mass_limit=8e8, true_mass_limit=0,
-                                  photbands=None, cosmo=None, nomags=False):
+                                  photbands=None, cosmo=None, nomags=False,
+                                  process=None):
+    """
+    If `process` (subprocess.Popen) is given, it is still writing
+    `asciifile`, which is then parsed as it grows via stream_ascii_data()
+    """
     if outfilebase is None:
         outfilebase = ".".join(asciifile.split(".")[:-1])
 
-    ascii_data = load_ascii_data(asciifile, obs_mass_limit=obs_mass_limit,
-                                 true_mass_limit=true_mass_limit)
+    # Parse straight into the final dtype, so columns are filled in place
+    photbands = ms.available_calibrations[calibration].get_photbands(
+        photbands)
+    dtype = lightcone_dtype(photbands)
+    if process is None:
+        ascii_data, header = load_ascii_data(
+            asciifile, obs_mass_limit=obs_mass_limit,
+            true_mass_limit=true_mass_limit, dtype=dtype,
+            return_header=True)
+    else:
+        ascii_data, header = stream_ascii_data(
+            asciifile, process, obs_mass_limit=obs_mass_limit,
+            true_mass_limit=true_mass_limit, dtype=dtype,
+            return_header=True)
     data = lightcone_from_ascii(ascii_data, calibration, photbands=photbands,
                                 cosmo=cosmo, nomags=nomags,
                                 fit_with_mass=fit_with_mass)
     metadict = metadict_from_ascii(asciifile, calibration, photbands=photbands,
                                    obs_mass_limit=obs_mass_limit,
                                    true_mass_limit=true_mass_limit,
-                                   nomags=nomags)
+                                   nomags=nomags, header=header)
 
     np.save(outfilebase + ".npy", data)
     with open(outfilebase + ".json", "w") as f:
         json.dump(metadict, f, indent=4)
 
+    mark_complete(outfilebase, "convert")
     if remove_ascii_file:
         # Save disk space by deleting the huge ascii file
         os.remove(asciifile)
 
 
-def load_ascii_data(filename, obs_mass_limit=8e8, true_mass_limit=0):
+def lightcone_dtype(photbands, ascii_cols=None):
+    """
+    The dtype of the structured array returned by lightcone_from_ascii
+    """
+    if ascii_cols is None:
+        ascii_cols = LIGHTCONE_ASCII_COLS
+    xyz_dtype = [(s, "<f4") for s in ("x", "y", "z")]
+    ascii_dtype = [(name, dt) for name, (_, dt) in ascii_cols.items()]
+    mag_dtype = [(f"m_{s}", "<f4") for s in photbands]
+    other_dtype = [("sfr_uv", "<f4"),
+                   ("distmod", "<f4"), ("distmod_cosmo", "<f4")]
+    return np.dtype(xyz_dtype + ascii_dtype + mag_dtype + other_dtype)
+
+
+LIGHTCONE_ASCII_COLS = {
+    "id": (5, "<i8"), "upid": (7, "<i8"),
+    "x_real": (10, "<f4"), "y_real": (11, "<f4"),
+    "z_real": (12, "<f4"), "vx": (13, "<f4"), "vy": (14, "<f4"),
+    "vz": (15, "<f4"), "ra": (0, "<f4"), "dec": (1, "<f4"),
+    "redshift": (2, "<f4"), "redshift_cosmo": (3, "<f4"),
+    "scale_snapshot": (4, "<f4"), "obs_sm": (28, "<f4"),
+    "obs_sfr": (29, "<f4"), "true_sm": (25, "<f4"),
+    "true_sfr": (27, "<f4"), "obs_uv": (32, "<f4"),
+    "halo_mvir": (16, "<f4"),
+    "halo_mvir_peak": (18, "<f4"), "halo_vmax": (17, "<f4"),
+    "halo_vmax_peak": (19, "<f4"), "halo_rvir": (20, "<f4"),
+    "halo_delta_vmax_rank": (21, "<f4")}
+
+
+def load_ascii_data(filename, obs_mass_limit=8e8, true_mass_limit=0,
+                    nthreads=None, chunksize=int(6.4e7), outfile=None,
+                    dtype=None, return_header=False):
     """
     This is the longest part of the process. It just loads the
     UniverseMachine output needed for lightcone_from_ascii()
+
+    The file is split at line boundaries into chunks of roughly
+    `chunksize` bytes, which are parsed in parallel on `nthreads`
+    threads (default = number of CPUs) by pandas' C parser, and the
+    mass cut is applied to each chunk as soon as it is parsed. If
+    `outfile` is given, the result is written to (and returned as)
+    a memory-mapped .npy file instead of being held in memory. A wider
+    `dtype` (e.g., lightcone_dtype()) may be given to leave room for
+    columns to be filled later; those are left uninitialized. If
+    `return_header` is True, the parsed header (see read_ascii_header)
+    is returned as well.
     """
-    cols = {"id": (5, "<i8"), "upid": (7, "<i8"),
-            "x_real": (10, "<f4"), "y_real": (11, "<f4"),
-            "z_real": (12, "<f4"), "vx": (13, "<f4"), "vy": (14, "<f4"),
-            "vz": (15, "<f4"), "ra": (0, "<f4"), "dec": (1, "<f4"),
-            "redshift": (2, "<f4"), "redshift_cosmo": (3, "<f4"),
-            "scale_snapshot": (4, "<f4"), "obs_sm": (28, "<f4"),
-            "obs_sfr": (29, "<f4"), "true_sm": (25, "<f4"),
-            "true_sfr": (27, "<f4"), "obs_uv": (32, "<f4"),
-            "halo_mvir": (16, "<f4"),
-            "halo_mvir_peak": (18, "<f4"), "halo_vmax": (17, "<f4"),
-            "halo_vmax_peak": (19, "<f4"), "halo_rvir": (20, "<f4"),
-            "halo_delta_vmax_rank": (21, "<f4")}
+    cols = LIGHTCONE_ASCII_COLS
+    masslimit = {"obs_sm": obs_mass_limit, "true_sm": true_mass_limit}
+    if dtype is None:
+        dtype = np.dtype([(name, dt) for name, (_, dt) in cols.items()])
+    if nthreads is None:
+        nthreads = os.cpu_count()
 
     # Read in the ASCII table, make mass cut (this takes a while)
+    header = read_ascii_header(filename)
+    offsets = ascii_chunk_offsets(filename, chunksize,
+                                  start=header["nbytes"])
+    with ThreadPoolExecutor(max(1, int(nthreads))) as executor:
+        chunks = list(executor.map(
+            lambda x: parse_ascii_chunk(filename, *x, cols, masslimit),
+            offsets))
+
+    data = _join_ascii_chunks(chunks, dtype, outfile)
+    return (data, header) if return_header else data
+
+
+def stream_ascii_data(filename, process, obs_mass_limit=8e8,
+                      true_mass_limit=0, chunksize=int(6.4e7),
+                      poll_interval=1.0, outfile=None, dtype=None,
+                      return_header=False):
+    """
+    Same as load_ascii_data, but `filename` is parsed while it is still
+    being written by `process` (subprocess.Popen), in chunks of complete
+    lines as they appear. Returns after the process exits and the rest
+    of the file is parsed, or raises RuntimeError as soon as the process
+    exits with a nonzero code. Parsing starts once the header is
+    complete (see read_ascii_header).
+    """
+    cols = LIGHTCONE_ASCII_COLS
     masslimit = {"obs_sm": obs_mass_limit, "true_sm": true_mass_limit}
-    reader = ht_sim_manager.tabular_ascii_reader.TabularAsciiReader(
-                             filename, cols, row_cut_min_dict=masslimit)
-    return reader.read_ascii()
+    if dtype is None:
+        dtype = np.dtype([(name, dt) for name, (_, dt) in cols.items()])
+
+    chunks, start, header = [], 0, None
+    while True:
+        finished = process.poll() is not None
+        if finished and process.returncode:
+            raise RuntimeError(f"lightcone code failed with exit code "
+                               f"{process.returncode}: {process.args}")
+        if not os.path.isfile(filename):
+            if finished:
+                raise FileNotFoundError(filename)
+            time.sleep(poll_interval)
+            continue
+        if header is None:
+            header = read_ascii_header(filename)
+            if not (header["complete"] or finished):
+                header = None
+                time.sleep(poll_interval)
+                continue
+            start = header["nbytes"]
+        size = os.path.getsize(filename)
+        stop = size if finished else _last_line_end(filename, start, size)
+
+        if stop > start and (finished or stop - start >= chunksize):
+            chunks.append(parse_ascii_chunk(filename, start, stop,
+                                            cols, masslimit))
+            start = stop
+        elif finished:
+            break
+        else:
+            time.sleep(poll_interval)
+
+    data = _join_ascii_chunks(chunks, dtype, outfile)
+    return (data, header) if return_header else data
+
+
+def read_ascii_header(filename, blocksize=4096):
+    """
+    Parse the '#' header of a UniverseMachine lightcone ascii file,
+    reading only as many blocks of `blocksize` bytes as it takes
+
+    Returns
+    -------
+    header : dict
+        Contains `columns`, `cmd`, `seed`, `origin`, and `Rmatrix` (when
+        present), and `nbytes` (the offset where the data begins), and
+        `complete` (False if no data follows the header yet)
+    """
+    lines, nbytes, complete = [], 0, False
+    with open(filename, "rb") as f:
+        buffer = b""
+        while not complete:
+            block = f.read(blocksize)
+            buffer += block
+            *full_lines, buffer = buffer.split(b"\n")
+            for line in full_lines:
+                if not line.startswith(b"#"):
+                    complete = True
+                    break
+                lines.append(line[1:].decode().strip())
+                nbytes += len(line) + 1
+            if not block:
+                break
+            # A partial line that isn't a comment also ends the header
+            complete |= bool(buffer) and not buffer.startswith(b"#")
+
+    header = dict(nbytes=nbytes, complete=complete)
+    if lines:
+        header["columns"] = lines[0].split()
+    for i, line in enumerate(lines):
+        key, _, value = line.partition(":")
+        if key == "Command line":
+            header["cmd"] = " ".join(value.split())
+        elif key == "Random seed":
+            header["seed"] = int(value)
+        elif key == "Origin (O)":
+            header["origin"] = [float(x) for x in value.split()[-3:]]
+        elif key == "Rotation Matrix (R)":
+            rows = [_NUMBER_REGEX.findall(row) for row in lines[i+1:i+4]]
+            header["Rmatrix"] = [[float(x) for x in row] for row in rows]
+    return header
+
+
+_NUMBER_REGEX = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def _last_line_end(filename, start, stop, blocksize=65536):
+    # Offset just past the last newline in filename[start:stop] (or start)
+    with open(filename, "rb") as f:
+        while stop > start:
+            f.seek(max(start, stop - blocksize))
+            block = f.read(stop - f.tell())
+            i = block.rfind(b"\n")
+            if i >= 0:
+                return stop - len(block) + i + 1
+            stop -= len(block)
+    return start
+
+
+def _join_ascii_chunks(chunks, dtype, outfile=None):
+    # The number of rows passing the cut is only known now
+    length = sum(len(chunk) for chunk in chunks)
+    if outfile is None:
+        data = np.empty(length, dtype=dtype)
+    else:
+        data = np.lib.format.open_memmap(outfile, mode="w+", dtype=dtype,
+                                         shape=(length,))
+    i = 0
+    while chunks:
+        chunk = chunks.pop(0)
+        for name in chunk.dtype.names:
+            data[name][i:i + len(chunk)] = chunk[name]
+        i += len(chunk)
+    return data
+
+
+def ascii_chunk_offsets(filename, chunksize=int(6.4e7), start=None):
+    """
+    Byte ranges (start, stop) of roughly `chunksize` bytes, which
+    cover every line following the '#' header of an ascii file (or
+    byte offset `start`) and begin and end on line boundaries
+    """
+    if start is None:
+        start = read_ascii_header(filename)["nbytes"]
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        edges = [start]
+        while edges[-1] < size:
+            f.seek(min(edges[-1] + int(chunksize), size))
+            f.readline()
+            edges.append(f.tell())
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def parse_ascii_chunk(filename, start, stop, cols, row_cut_min_dict=None):
+    """
+    Parse the lines between byte offsets `start` and `stop` of an ascii
+    file into a structured array. `cols` is a dict of the form
+    {name: (column_index, dtype)}, and only rows where the column
+    `name` > `value` for each item of `row_cut_min_dict` are kept
+    """
+    dtype = np.dtype([(name, dt) for name, (_, dt) in cols.items()])
+    with open(filename, "rb") as f:
+        f.seek(start)
+        buffer = io.BytesIO(f.read(stop - start))
+    try:
+        df = pd.read_csv(buffer, sep=r"\s+", header=None, comment="#",
+                         engine="c", usecols=[i for i, _ in cols.values()],
+                         dtype={i: dt for i, dt in cols.values()})
+    except pd.errors.EmptyDataError:
+        return np.empty(0, dtype=dtype)
+
+    mask = np.ones(len(df), dtype=bool)
+    if row_cut_min_dict is not None:
+        for name, lower_bound in row_cut_min_dict.items():
+            mask &= df[cols[name][0]].values > lower_bound
+
+    chunk = np.empty(mask.sum(), dtype=dtype)
+    for name, (i, _) in cols.items():
+        chunk[name] = df[i].values[mask]
+    return chunk
 
 
 def lightcone_from_ascii(ascii_data, calibration, photbands=None,
@@ -79,83 +327,79 @@ def lightcone_from_ascii(ascii_data, calibration, photbands=None,
     Additionally, apparent magnitudes and distance modulus are calculated.
     Note that h-scaling is applied to all distances (including distance
     modulus), and therefore M = m - distmod + 5log(h).
+
+    If `ascii_data` already has every column of lightcone_dtype()
+    (see load_ascii_data), the new columns are filled in place and
+    `ascii_data` itself is returned, instead of a copy.
     """
     if cosmo is None:
         cosmo = ms.bplcosmo
 
+    uvdat = climber.UVData(calibration, photbands=photbands)
+    dtype = lightcone_dtype(uvdat.photbands)
+    if set(ascii_data.dtype.names) == set(dtype.names):
+        lightcone = ascii_data
+    else:
+        lightcone = np.empty(ascii_data.shape, dtype)
+        for name in ascii_data.dtype.names:
+            lightcone[name] = ascii_data[name]
+
     # Limit RA to the range [-180,180) (column = "ra")
-    ascii_data["ra"] = (ascii_data["ra"] + 180) % 360 - 180
+    lightcone["ra"] = (lightcone["ra"] + 180) % 360 - 180
     # Calculate redshift-space-distorted positions (columns = "x","y","z")
-    xyz_real = ms.util.xyz_array(ascii_data,
+    xyz_real = ms.util.xyz_array(lightcone,
                                  keys=["x_real", "y_real", "z_real"])
-    vel = ms.util.xyz_array(ascii_data, keys=["vx", "vy", "vz"])
+    vel = ms.util.xyz_array(lightcone, keys=["vx", "vy", "vz"])
     rdz = ms.util.ra_dec_z(xyz_real, vel, cosmo=cosmo)
-    xyz = ms.util.rdz2xyz(rdz, cosmo=cosmo)
-
-    # Calculate distance modulus (column = "distmod")
-    dlum = cosmo.luminosity_distance(ascii_data["redshift"]).value * cosmo.h
-    distmod = 5 * np.log10(dlum * 1e5)
-    dlum_true = cosmo.luminosity_distance(ascii_data["redshift_cosmo"]
-                                          ).value * cosmo.h
-    distmod_cosmo = 5 * np.log10(dlum_true * 1e5)
+    del xyz_real, vel
+    rdz[:, 2] = ms.util.comoving_disth_interp(rdz[:, 2], cosmo)
+    for name, column in zip("xyz", ms.util.rdz2xyz(rdz, cosmo=None).T):
+        lightcone[name] = column
+    del rdz
+
+    # Calculate distance modulus (columns = "distmod", "distmod_cosmo")
+    for name, z in [("distmod", "redshift"),
+                    ("distmod_cosmo", "redshift_cosmo")]:
+        dlum = ms.util.luminosity_disth_interp(lightcone[z], cosmo)
+        lightcone[name] = 5 * np.log10(dlum * 1e5)
+    del dlum
 
     # Calculate apparent magnitudes (column = "m_g", "m_r", etc.)
-    uvdat = climber.UVData(calibration, photbands=photbands)
-    umdat = climber.UMData(ascii_data, uvdat=uvdat,
-                           fit_with_mass=fit_with_mass)
     if nomags:
-        sfr_uv = np.full_like(dlum, np.nan)
-        magdf = pd.DataFrame({f"m_{k}": sfr_uv for k in uvdat.photbands})
+        lightcone["sfr_uv"] = np.nan
+        for band in uvdat.photbands:
+            lightcone[f"m_{band}"] = np.nan
     else:
-        sfr_uv = 10 ** umdat.logssfr_uv * ascii_data["obs_sm"]
-        magdf = pd.DataFrame({f"m_{k}": umdat.abs_mag[k] + distmod_cosmo
-                              for k in umdat.abs_mag.columns})
-
-    # Name the new columns and specify their dtypes
-    xyz_dtype = [(s, "<f4") for s in ("x", "y", "z")]
-    mag_dtype = [(s, "<f4") for s in magdf.columns]
-    other_dtype = [("sfr_uv", "<f4"),
-                   ("distmod", "<f4"), ("distmod_cosmo", "<f4")]
-
-    full_dtype = (xyz_dtype + ascii_data.dtype.descr + mag_dtype +
-                  other_dtype)
-
-    # Copy all columns into a new structured numpy array
-    final_lightcone_array = np.zeros(ascii_data.shape, full_dtype)
-    for i, (name, dtype) in enumerate(xyz_dtype):
-        final_lightcone_array[name] = xyz[:, i]
-    for (name, dtype) in mag_dtype:
-        final_lightcone_array[name] = magdf[name]
-    for (name, dtype) in ascii_data.dtype.descr:
-        final_lightcone_array[name] = ascii_data[name]
-    final_lightcone_array["sfr_uv"] = sfr_uv
-    final_lightcone_array["distmod"] = distmod
-    final_lightcone_array["distmod_cosmo"] = distmod_cosmo
+        # Only pass the inputs, since the outputs aren't filled yet
+        umdat = climber.UMData(
+            {key: lightcone[key] for key in ("obs_sm", "obs_sfr",
+                                             "redshift")},
+            uvdat=uvdat, fit_with_mass=fit_with_mass)
+        lightcone["sfr_uv"] = 10 ** umdat.logssfr_uv * lightcone["obs_sm"]
+        for band in umdat.abs_mag.columns:
+            lightcone[f"m_{band}"] = (umdat.abs_mag[band].values +
+                                      lightcone["distmod_cosmo"])
 
-    return final_lightcone_array
+    return lightcone
 
 
 def metadict_from_ascii(filename, calibration, photbands=None, obs_mass_limit=8e8,
-                        true_mass_limit=0, nomags=False):
+                        true_mass_limit=0, nomags=False, header=None):
+    """
+    If `header` (see read_ascii_header) was already parsed, e.g. by
+    load_ascii_data, `filename` isn't opened again
+    """
     data_config = ms.available_calibrations[calibration]()
     photbands = data_config.get_photbands(photbands)
     dataname = calibration.upper()
 
-    with open(filename) as f:
-        [f.readline() for _ in range(1)]
-        cmd = " ".join(f.readline().split()[2:])
-        seed = eval(f.readline().split()[-1])
-        origin = [float(s) for s in f.readline().split()[-3:]]
-        [f.readline() for _ in range(30)]
-        rot_matrix = eval(("".join([f.readline()[1:].strip().replace(" ", ",")
-                                    for _ in range(3)]))[:-1])
-
-    (executable, config, z_low, z_high,
-     x_arcmin, y_arcmin, samples) = cmd.split()[:7]
+    if header is None:
+        header = read_ascii_header(filename)
+    meta = metadict_from_header(header)
     nomags_msg = (' *Note*: This was run with nomags=True, so m_{{*}}'
                   ' and sfr_uv columns are missing or NaN.\n')
 
-    header = f"""# Structured array of mock galaxy/halo properties
+    header_text = f"""# Structured array of mock galaxy/halo properties
 # Load via 
 # >>> data = np.load("filename.npy")
 # Cosmology: FlatLambdaCDM(H0=67.8, Om0=0.307, Ob0=0.048)
@@ -185,11 +429,23 @@ def metadict_from_ascii(filename, calibration, photbands=None, obs_mass_limit=8e
 # halo_delta_vmax_rank - z-score of a proxy for halo accretion rate --> sSFR
 # scale_snapshot - the scale-factor of the snapshot this halo was taken from
 """
-    return dict(header=header, z_low=float(z_low), z_high=float(z_high),
+    return dict(header=header_text, photbands=photbands,
+                obs_mass_limit=obs_mass_limit,
+                true_mass_limit=true_mass_limit, **meta)
+
+
+def metadict_from_header(header):
+    """
+    The part of a lightcone's meta data that comes from the header of
+    its ascii file (see read_ascii_header)
+    """
+    cmd = header["cmd"]
+    (executable, config, z_low, z_high,
+     x_arcmin, y_arcmin, samples) = cmd.split()[:7]
+    return dict(z_low=float(z_low), z_high=float(z_high),
                 x_arcmin=float(x_arcmin), y_arcmin=float(y_arcmin),
-                samples=int(samples), photbands=photbands,
-                obs_mass_limit=obs_mass_limit, true_mass_limit=true_mass_limit,
-                Rmatrix=rot_matrix, seed=seed, origin=origin,
+                samples=int(samples), Rmatrix=header["Rmatrix"],
+                seed=header["seed"], origin=header["origin"],
                 config=config, executable=executable, cmd=cmd)
 
 
@@ -219,13 +475,10 @@ def metadict_with_specprop(meta):
     return dict(header_specprop=header_specprop, **meta)
 
 
-def metadict_with_spec(meta, ngal):
-    if "header_spec" in meta:
-        del meta["header_spec"]
-    if "Ngal" in meta:
-        del meta["Ngal"]
-    if "Nwave" in meta:
-        del meta["Nwave"]
+def metadict_with_spec(meta, ngal, spec_format="f4"):
+    for key in ["header_spec", "Ngal", "Nwave", "spec_format"]:
+        if key in meta:
+            del meta[key]
 
     nwave = ms.SeanSpectraConfig().wavelength().size
     header_spec = """# Binary array of the spectrum of each galaxy in the mock.
@@ -249,7 +502,26 @@ def metadict_with_spec(meta, ngal):
 # >>> i = 123
 # >>> spec = np.memmap("filename.spec", dtype="<f4", shape=shape)[i]
 """
-    return dict(Ngal=ngal, Nwave=nwave, header_spec=header_spec, **meta)
+    if spec_format == "sparse":
+        header_spec += """#
+# This file is stored in the "sparse" format: a structured .npy array
+# of the neighbors stacked into each spectrum, with an extra ".specmeta"
+# file of how they're stacked. Instead of the above,
+# load it with (requires Sean's spectra, see SeanSpectraConfig)
+# >>> spec = LightConeConfig("path/to/dir").load_specmap(index)[i]
+# which stacks spectra as they are accessed (see
+# mocksurvey.climber.util.SparseSpecmap for the exact format)
+"""
+    if spec_format == "log16":
+        header_spec += """#
+# This file is stored in the compact "log16" format, with an extra
+# ".specscale" file. Instead of the above, load it with
+# >>> spec = LightConeConfig("path/to/dir").load_specmap(index)[i]
+# which decodes spectra as they are accessed (see
+# mocksurvey.climber.util.Log16Specmap for the exact format)
+"""
+    return dict(Ngal=ngal, Nwave=nwave, spec_format=spec_format,
+                header_spec=header_spec, **meta)
 
 
 # def get_photbands(photbands, default=None):
@@ -300,40 +572,87 @@ def cam_binned_z(m, z, prop, m2, z2, prop2, nwin=501, dz=0.05,
 
     # noinspection PyArgumentList
     zmin, zmax = centroids.min(), centroids.max()
-    s, s2 = (zmin < z) & (z < zmax), (zmin < z2) & (z2 < zmax)
-    assert np.all(s)
+    assert np.all((zmin < z) & (z < zmax))
 
-    m2 = m2[s2]
-    z2 = z2[s2]
-    prop2 = prop2[s2]
+    # Observed galaxies sorted by (z bin, m), with bin boundaries
+    centroids, m2, prop2, bounds2 = binned_cam_table(
+        m2, z2, prop2, centroids, seed, min_counts_in_z2_bins)
 
-    inds2 = ht_utils.fuzzy_digitize(z2, centroids, seed=seed,
-                                    min_counts=min_counts_in_z2_bins)
-    centroids: np.ndarray
-    centroids, inds2 = ms.util.correction_for_empty_bins(centroids, inds2)
     inds = ms.util.fuzzy_digitize_improved(z, centroids, seed=seed,
                                            min_counts=0)
 
+    # Sort the model galaxies the same way, once
+    order = np.lexsort((m, inds))
+    m, prop = np.asarray(m)[order], np.asarray(prop)[order]
+    bounds = np.searchsorted(inds[order], np.arange(len(centroids) + 1))
+
     new_prop = np.full_like(prop, np.nan)
     for i in range(len(centroids)):
-        s, s2 = inds == i, inds2 == i
-        if not s.sum():
+        s = slice(bounds[i], bounds[i + 1])
+        s2 = slice(bounds2[i], bounds2[i + 1])
+        n, n2 = s.stop - s.start, s2.stop - s2.start
+        if not n:
             continue
-        nwin1 = min([nwin, s2.sum()//2*2-1, s.sum()//2*2-1])
+        nwin1 = min([nwin, n2//2*2-1, n//2*2-1])
         if nwin1 < 2:
-            print(f"Warning: Only {s2.sum()} real galaxies in the z"
+            print(f"Warning: Only {n2} real galaxies in the z"
                   f"={centroids[i]} bin. You should use a larger"
                   f"value of dz than {dz}")
-        new_prop[s] = ht_empirical_models.conditional_abunmatch(
-            m[s], prop[s], m2[s2], prop2[s2], nwin1)
+        new_prop[order[s]] = ht_empirical_models.conditional_abunmatch(
+            m[s], prop[s], m2[s2], prop2[s2], nwin1,
+            assume_x_is_sorted=True, assume_x2_is_sorted=True)
 
     return new_prop
 
 
+def binned_cam_table(m2, z2, prop2, centroids, seed=None, min_counts=0):
+    """
+    Observed galaxies (within the range of `centroids`) assigned to
+    redshift bins and sorted by (bin, m2), as needed by cam_binned_z.
+    This doesn't depend on the mock, so it is kept in memory for other
+    mocks (e.g., realizations) with the same redshift bins.
+
+    Returns
+    -------
+    centroids : array
+        Centroids of the non-empty bins
+    m2, prop2 : arrays
+        Observed galaxies sorted by (bin, m2)
+    bounds : array
+        Galaxies in bin i are m2[bounds[i]:bounds[i+1]]
+    """
+    key = input_hash(np.asarray(m2), np.asarray(z2), np.asarray(prop2),
+                     np.asarray(centroids), seed=seed, min_counts=min_counts)
+    if key not in _cam_tables:
+        zmin, zmax = centroids.min(), centroids.max()
+        s2 = (zmin < z2) & (z2 < zmax)
+        m2, z2, prop2 = m2[s2], z2[s2], prop2[s2]
+
+        inds2 = ht_utils.fuzzy_digitize(z2, centroids, seed=seed,
+                                        min_counts=min_counts)
+        centroids, inds2 = ms.util.correction_for_empty_bins(centroids,
+                                                             inds2)
+        order2 = np.lexsort((m2, inds2))
+        bounds2 = np.searchsorted(inds2[order2],
+                                  np.arange(len(centroids) + 1))
+        _cam_tables.clear()
+        _cam_tables[key] = centroids, m2[order2], prop2[order2], bounds2
+    return _cam_tables[key]
+
+
+_cam_tables = {}
+
+
 def execute_lightcone_code(z_low, z_high, x_arcmin, y_arcmin,
                            executable=None, umcfg=None, samples=1,
                            id_tag="", do_collision_test=False, ra=0.,
-                           dec=0., theta=0., rseed=None):
+                           dec=0., theta=0., rseed=None, wait=True,
+                           cwd=None):
+    """
+    Run UniverseMachine's lightcone code, which writes its ascii output
+    files into the working directory `cwd`. Returns the exit code, or
+    if wait=False, the running subprocess.Popen without waiting for it
+    """
     # homedir = str(pathlib.Path.home()) + "/"
     if executable is None:
         # executable = homedir + "local/src/universemachine/lightcone"
@@ -345,7 +664,7 @@ def execute_lightcone_code(z_low, z_high, x_arcmin, y_arcmin,
         assert ms.util.is_int(rseed), "Random seed must be an integer"
     assert ms.util.is_int(samples), "Number of samples must be an integer"
 
-    args = ["'"+str(id_tag)+"'", str(int(do_collision_test)),
+    args = [str(id_tag), str(int(do_collision_test)),
             str(float(ra)), str(float(dec)), str(float(theta)), str(rseed)]
 
     if rseed is None:
@@ -361,10 +680,59 @@ def execute_lightcone_code(z_low, z_high, x_arcmin, y_arcmin,
                         if not id_tag:
                             args.pop()
 
-    cmd = f"{str(executable)} {str(umcfg)} {float(z_low)} {float(z_high)} "\
-          f"{float(x_arcmin)} {float(y_arcmin)} {samples} {' '.join(args)}"
-    print(cmd)
-    return os.system(cmd)
+    cmd = [os.path.abspath(executable), os.path.abspath(umcfg),
+           str(float(z_low)), str(float(z_high)), str(float(x_arcmin)),
+           str(float(y_arcmin)), str(samples), *args]
+    print(" ".join(cmd))
+    process = subprocess.Popen(cmd, cwd=cwd)
+    if not wait:
+        return process
+    return process.wait()
+
+
+def generate_lightcone_realization(index, destination, z_low, z_high,
+                                   x_arcmin, y_arcmin, executable=None,
+                                   umcfg=None, id_tag="", rseed=None,
+                                   keep_ascii_file=False, lightcone_kw=None,
+                                   **convert_kw):
+    """
+    Generate realization number `index` of a lightcone with its own
+    process of the lightcone code (seeded by rseed + index), and convert
+    its ascii output while it is still being written. The converted
+    files (and the ascii file, if kept) are named after `destination`.
+    Extra `lightcone_kw` go to execute_lightcone_code() and `convert_kw`
+    go to convert_ascii_to_npy_and_json()
+
+    Returns (exit code, seconds spent running the lightcone code)
+    """
+    id_tag = f"{id_tag}{index}"
+    rseed = None if rseed is None else rseed + index
+    cwd = os.path.dirname(os.path.abspath(destination))
+    asciifile = os.path.join(cwd, default_lightcone_filenames(
+        z_low, z_high, x_arcmin, y_arcmin, 1, id_tag)[0])
+    outfilebase = ".".join(destination.split(".")[:-1])
+
+    start = time.time()
+    process = execute_lightcone_code(
+        z_low, z_high, x_arcmin, y_arcmin, executable, umcfg, samples=1,
+        id_tag=id_tag, rseed=rseed, wait=False, cwd=cwd,
+        **({} if lightcone_kw is None else lightcone_kw))
+    try:
+        convert_ascii_to_npy_and_json(
+            asciifile, outfilebase=outfilebase, process=process,
+            remove_ascii_file=not keep_ascii_file, **convert_kw)
+    finally:
+        # Don't leave the lightcone code running if conversion failed
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    runtime = time.time() - start
+    if keep_ascii_file:
+        os.rename(asciifile, destination)
+
+    print(f"Realization {index}: lightcone code exited with code "
+          f"{process.returncode} after {runtime:.1f} seconds")
+    return process.returncode, runtime
 
 
 def default_lightcone_filenames(z_low, z_high, x_arcmin, y_arcmin,
@@ -426,6 +794,199 @@ def generate_lightcone_filenames(args, outfilepath=None,
     return asciifiles, moved_asciifiles
 
 
+def run_realizations(func, arglist, workers=1, mem_costs=None,
+                     mem_budget=None):
+    """
+    Call func(*args) for each `args` in `arglist`, running up to `workers`
+    calls at once in separate processes. A call only starts if the summed
+    `mem_costs` (estimated bytes of memory per call) of all running calls
+    stays within `mem_budget` (default = currently available memory), but
+    at least one call is always running. Results are returned in order.
+    If any call fails, the running calls finish but no more are started.
+
+    Worker processes are forked, so the arguments need not be picklable
+    (selectors and configs usually aren't), but the results must be.
+    """
+    arglist = list(arglist)
+    if mem_costs is None:
+        mem_costs = [0] * len(arglist)
+    if mem_budget is None:
+        mem_budget = available_memory()
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        workers = 1
+    if workers is None or workers <= 1 or len(arglist) <= 1:
+        return [func(*args) for args in arglist]
+
+    results = [None] * len(arglist)
+    pending = list(range(len(arglist)))
+    running = {}
+    _realization_tasks[:] = [(func, args) for args in arglist]
+    try:
+        with ProcessPoolExecutor(int(workers), mp_context=context) as executor:
+            while pending or running:
+                while pending and len(running) < workers and (
+                        not running or mem_budget is None or
+                        sum(mem_costs[i] for i in running.values())
+                        + mem_costs[pending[0]] <= mem_budget):
+                    i = pending.pop(0)
+                    running[executor.submit(_run_realization_task, i)] = i
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+    finally:
+        _realization_tasks.clear()
+    return results
+
+
+# Inherited by the forked workers of run_realizations()
+_realization_tasks = []
+
+
+def _run_realization_task(i):
+    func, args = _realization_tasks[i]
+    return func(*args)
+
+
+def available_memory():
+    """Bytes of physical memory currently available (None if unknown)"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def completion_marker(filename, step):
+    """
+    Path to the (hidden) file marking that `step` has been
+    completed for the realization stored at `filename`
+    """
+    dirname, basename = os.path.split(filename)
+    return os.path.join(dirname, f".{basename}.{step}-complete")
+
+
+def is_complete(filename, step):
+    return os.path.isfile(completion_marker(filename, step))
+
+
+def mark_complete(filename, step):
+    pathlib.Path(completion_marker(filename, step)).touch()
+
+
+def input_hash(*args, **kwargs):
+    """
+    Hex digest identifying the given arrays/values, used as the key of
+    cache files (see cached_file)
+    """
+    sha = hashlib.sha1()
+    for x in [*args, *sorted(kwargs.items())]:
+        if isinstance(x, np.ndarray):
+            x = np.ascontiguousarray(x)
+            sha.update(repr((x.dtype.str, x.shape)).encode())
+            sha.update(x.tobytes())
+        else:
+            sha.update(repr(x).encode())
+    return sha.hexdigest()
+
+
+def file_signature(*filenames):
+    """
+    Identifies the current version of each file by its size and mtime
+    """
+    stats = [os.stat(f) for f in filenames]
+    return [(os.path.basename(f), st.st_size, st.st_mtime_ns)
+            for f, st in zip(filenames, stats)]
+
+
+def cached_file(directory, name, key, compute, load, save):
+    """
+    Return load(path) of the cache file `name` (with `key` in the
+    file name) in `directory`, if it exists. Otherwise compute() it,
+    and try to save(result, path) for next time, replacing any stale
+    cache file of the same name with another key.
+    """
+    base, ext = os.path.splitext(name)
+    path = os.path.join(directory, f".{base}-{key[:20]}{ext}")
+    if os.path.isfile(path):
+        try:
+            return load(path)
+        except Exception as e:
+            print(f"Ignoring unreadable cache file {path} ({e})")
+
+    result = compute()
+    # Write to a temporary file first, so readers never see half a file
+    tmp = os.path.join(directory, f".{base}-{key[:20]}.tmp{os.getpid()}{ext}")
+    try:
+        save(result, tmp)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return result
+
+    # Remove the cache files of other keys (e.g., of older inputs)
+    pattern = re.compile(rf"\.{re.escape(base)}-\w{{20}}{re.escape(ext)}")
+    for stale in os.listdir(directory):
+        if pattern.fullmatch(stale) and stale != os.path.basename(path):
+            try:
+                os.remove(os.path.join(directory, stale))
+            except OSError:
+                pass
+    return result
+
+
+@contextlib.contextmanager
+def checkpointed_memmap(filebase, shape, nchunks, dtype="<f8", key=None,
+                        resume=False):
+    """
+    Provides (out, done): a memory-mapped array `out` of `shape`, and a
+    memory-mapped boolean array `done` recording which of its `nchunks`
+    chunks have been filled. Both are stored as {filebase}.npy and
+    {filebase}.done.npy, along with `key` (e.g., an input_hash of
+    whatever the results depend on) in {filebase}.key. If `resume` is
+    true and these already exist with the same shape and key, they are
+    reopened, keeping previous progress. Otherwise they start over.
+    They are deleted once the context exits without error. If
+    `filebase` is None, temporary files are used instead.
+    """
+    with contextlib.ExitStack() as stack:
+        if filebase is None:
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+            filebase = os.path.join(tmpdir, "checkpoint")
+        outfile, donefile = f"{filebase}.npy", f"{filebase}.done.npy"
+        keyfile = f"{filebase}.key"
+        key = str(key)
+
+        out = done = None
+        if resume and all(os.path.isfile(f)
+                          for f in (outfile, donefile, keyfile)):
+            with open(keyfile) as f:
+                stored_key = f.read()
+            out = np.load(outfile, mmap_mode="r+")
+            done = np.load(donefile, mmap_mode="r+")
+            if (stored_key != key or out.shape != tuple(shape)
+                    or done.shape != (nchunks,)):
+                out = done = None
+        if out is None:
+            # The key is written last, so it only matches complete files
+            if os.path.isfile(keyfile):
+                os.remove(keyfile)
+            done = np.lib.format.open_memmap(donefile, mode="w+",
+                                             dtype=bool, shape=(nchunks,))
+            out = np.lib.format.open_memmap(outfile, mode="w+",
+                                            dtype=dtype, shape=tuple(shape))
+            done.flush()
+            with open(keyfile + ".tmp", "w") as f:
+                f.write(key)
+            os.replace(keyfile + ".tmp", keyfile)
+
+        yield out, done
+        del out, done
+        for f in (outfile, donefile, keyfile):
+            os.remove(f)
+
+
 def progress_iterator(progress):
     if isinstance(progress, str):
         assert progress.lower() == "notebook", \
@@ -441,7 +1002,360 @@ def progress_iterator(progress):
     return iterator
 
 
+def open_specmap(filename, shape, spec_format="f4", mode="r",
+                 num_neighbors=1, cosmo=None, fill_library=False):
+    """
+    Open a specmap (array of spectra of shape (Ngal, Nwave)) stored in
+    the given format (see SPEC_FORMATS), returning an object which
+    reads (and, in a writable `mode`, writes) float spectra by row.
+    `num_neighbors`, `cosmo`, and `fill_library` are only needed to
+    create a sparse specmap
+    """
+    if spec_format == "f4":
+        return np.memmap(filename, dtype="<f4", mode=mode, shape=shape)
+    elif spec_format == "log16":
+        return Log16Specmap(filename, shape, mode=mode)
+    elif spec_format == "sparse":
+        return SparseSpecmap(filename, shape, mode=mode,
+                             num_neighbors=num_neighbors, cosmo=cosmo,
+                             fill_library=fill_library)
+    else:
+        raise ValueError(f"spec_format={spec_format} must be one of "
+                         f"{SPEC_FORMATS}")
+
+
+class Log16Specmap:
+    """
+    Spectra stored as 16-bit integers, quantized in log(flux) between
+    the smallest and largest positive flux of each spectrum. These two
+    numbers are stored per spectrum in an extra '.specscale' file.
+    Uses 2 instead of 4 bytes per pixel.
+
+    Zero (or negative) fluxes are stored as exactly zero, and NaNs are
+    kept. Each positive flux f of a spectrum spanning fmin <= f <= fmax
+    is decoded with relative error at most ln(fmax/fmin) / 131064 (plus
+    float32 rounding). The
+    flux through any filter is a positive weighted sum of these, so
+    synthesized magnitudes are off by at most 1.0857 times that, i.e.
+    < 2e-4 mag even for a spectrum spanning ten orders of magnitude.
+    """
+    NAN, ZERO = -32768, -32767
+    OFFSET = 32766  # positive fluxes are coded -32766, ..., 32766
+    LEVELS = 2 * OFFSET
+
+    def __init__(self, filename, shape, mode="r"):
+        scalefile = ms.util.change_file_extension(filename, "specscale")
+        self.codes = np.memmap(filename, dtype="<i2", mode=mode,
+                               shape=shape)
+        self.scales = np.memmap(scalefile, dtype="<f8", mode=mode,
+                                shape=(shape[0], 2))
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    dtype = np.dtype("<f4")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        # Decode the selected rows, then apply any column index
+        key, cols = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        spectra = self.decode(self.codes[key], self.scales[key])
+        return spectra[(..., *cols)] if cols else spectra
+
+    def __setitem__(self, key, spectra):
+        shape = self.codes[key].shape
+        codes, scales = self.encode(np.reshape(spectra, shape))
+        self.codes[key] = codes
+        self.scales[key] = scales
+
+    def flush(self):
+        self.codes.flush()
+        self.scales.flush()
+
+    @classmethod
+    def encode(cls, spectra):
+        """
+        Returns (codes, scales) of `spectra` of shape (..., Nwave), which
+        may also be a single spectrum
+        """
+        spectra = np.asarray(spectra, dtype=float)
+        shape = spectra.shape
+        spectra = spectra.reshape(-1, shape[-1])
+        isnan = np.isnan(spectra)
+        positive = spectra > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            logf = np.log(np.where(positive, spectra, 1))
+        lo = np.where(positive, logf, np.inf).min(axis=-1)
+        hi = np.where(positive, logf, -np.inf).max(axis=-1)
+        lo[~positive.any(axis=-1)] = hi[~positive.any(axis=-1)] = 0
+        step = (hi - lo) / cls.LEVELS
+        step[step == 0] = 1
+
+        codes = np.rint((logf - lo[..., None]) / step[..., None]) - cls.OFFSET
+        codes = codes.astype("<i2")
+        codes[~positive] = cls.ZERO
+        codes[isnan] = cls.NAN
+        scales = np.stack([lo, step], axis=-1)
+        return codes.reshape(shape), scales.reshape(*shape[:-1], 2)
+
+    @classmethod
+    def decode(cls, codes, scales):
+        codes, scales = np.asarray(codes), np.asarray(scales)
+        lo, step = scales[..., 0, None], scales[..., 1, None]
+        level = codes.astype(float) + cls.OFFSET
+        spectra = np.exp(lo + level * step).astype("<f4")
+        spectra[codes == cls.ZERO] = 0
+        spectra[codes == cls.NAN] = np.nan
+        return spectra
+
+
+class SparseSpecmap:
+    """
+    Spectra stored only as the recipe for stacking them (as done by
+    SeanSpecStacker.avg_spectrum) from Sean's spectra: for each galaxy,
+    its redshift, plus the spectrum row, redshift and luminosity
+    correction of each of its neighbors. Spectra are stacked when
+    accessed, so this takes a few numbers instead of Nwave per galaxy.
+    The file is a structured .npy array (despite its extension), with an
+    extra ".specmeta" JSON file of the cosmology the spectra are shifted
+    with, and whether they're stacked from the filled library (see
+    SeanSpectraConfig.filled_specmap). Without it, they're stacked from
+    the unfilled library in the Bolshoi-Planck cosmology
+    """
+    def __init__(self, filename, shape=None, mode="r", num_neighbors=1,
+                 cosmo=None, fill_library=False):
+        metafile = ms.util.change_file_extension(filename, "specmeta")
+        if mode in ("w+", "w"):
+            dtype = [("redshift", "<f8"),
+                     ("specid", "<i8", (num_neighbors,)),
+                     ("row", "<i8", (num_neighbors,)),
+                     ("from_z", "<f8", (num_neighbors,)),
+                     ("lumcorr", "<f8", (num_neighbors,))]
+            self.data = np.lib.format.open_memmap(
+                filename, mode="w+", dtype=dtype, shape=(shape[0],))
+            self.cosmo = ms.bplcosmo if cosmo is None else cosmo
+            self.fill_library = bool(fill_library)
+            with open(metafile, "w") as f:
+                json.dump(dict(cosmo=self.cosmo.to_format("yaml"),
+                               fill_library=self.fill_library), f, indent=4)
+        else:
+            self.data = np.load(filename, mmap_mode=mode)
+            self.cosmo, self.fill_library = ms.bplcosmo, False
+            if os.path.isfile(metafile):
+                with open(metafile) as f:
+                    meta = json.load(f)
+                self.cosmo = cosmology.Cosmology.from_format(
+                    meta["cosmo"], format="yaml")
+                self.fill_library = meta["fill_library"]
+        self._sean = None
+
+    @property
+    def shape(self):
+        return len(self.data), len(self.sean[1])
+
+    dtype = np.dtype("<f4")
+
+    @property
+    def sean(self):
+        # Spectra library, loaded the first time spectra are accessed
+        if self._sean is None:
+            config = ms.SeanSpectraConfig()
+            self._sean = (config.filled_specmap() if self.fill_library
+                          else config.specmap(), config.wavelength(),
+                          RedshiftResampler(config.wavelength()))
+        return self._sean
+
+    def __len__(self):
+        return len(self.data)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __getitem__(self, key):
+        key, cols = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        recipe = self.data[key]
+        get_specmap, _, resample = self.sean
+
+        redshift = np.atleast_1d(recipe["redshift"])
+        rows = recipe["row"].reshape(len(redshift), -1)
+        from_z = recipe["from_z"].reshape(rows.shape)
+        lumcorr = recipe["lumcorr"].reshape(rows.shape)
+        spectra = shift_spectra(gather_rows(get_specmap(), rows), resample,
+                                from_z, lumcorr, redshift, self.cosmo
+                                ).mean(axis=1)
+        if np.ndim(recipe) == 0:
+            spectra = spectra[0]
+        return spectra[(..., *cols)] if cols else spectra
+
+    def __setitem__(self, key, spectra):
+        raise TypeError("A SparseSpecmap can't store spectra, only how to "
+                        "stack them (see set)")
+
+    def set(self, key, specid, row, from_z, lumcorr, redshift):
+        for name, val in dict(specid=specid, row=row, from_z=from_z,
+                              lumcorr=lumcorr, redshift=redshift).items():
+            self.data[name][key] = val
+
+    def flush(self):
+        self.data.flush()
+
+
+SPEC_FORMATS = ("f4", "log16", "sparse")
+
+
+def gather_rows(array, idx, max_gap=16, max_read_bytes=int(1e8)):
+    """
+    Equivalent to array[idx] for a (memory-mapped) array, but reads each
+    requested row only once, in sorted order, merging rows less than
+    `max_gap` apart into sequential reads of up to `max_read_bytes`.
+    This turns random access of a large file into a few long reads
+    """
+    idx = np.asarray(idx)
+    rows, inverse = np.unique(idx.ravel(), return_inverse=True)
+    out = np.empty((len(rows), *array.shape[1:]), dtype=array.dtype)
+    rowbytes = max(1, array.itemsize * int(np.prod(array.shape[1:])))
+    max_rows = max(1, max_read_bytes // rowbytes)
+
+    # Group sorted rows into [start, stop) positions of each read
+    breaks = np.flatnonzero(np.diff(rows) > max_gap) + 1
+    starts, stops = [0, *breaks], [*breaks, len(rows)]
+    for start, stop in zip(starts, stops):
+        while start < stop:
+            first = rows[start]
+            end = np.searchsorted(rows, first + max_rows, side="left")
+            end = min(end, stop)
+            block = array[first:rows[end - 1] + 1]
+            out[start:end] = block[rows[start:end] - first]
+            start = end
+    return out[inverse].reshape(*idx.shape, *array.shape[1:])
+
+
+def shift_spectra(specs, resample, from_z, lumcorrs, redshift, cosmo):
+    """
+    Shift spectra (shape (N, num_neighbors, Nwave)) observed at `from_z`
+    to `redshift` (shape (N,)), correcting the flux for the change in
+    distance, and scaling it by `lumcorrs`
+    """
+    redshift = np.asarray(redshift)
+    from_z = np.asarray(from_z)
+    lumcorrs = lumcorrs * ms.util.redshift_rest_flux_correction(
+        from_z=from_z, to_z=redshift[:, None], cosmo=cosmo)
+    specs = np.reshape(specs, (*from_z.shape, -1))
+    eachspec = resample(specs, from_z, redshift[:, None])
+    eachspec *= lumcorrs[:, :, None]
+    return eachspec
+
+
+def prefetch(func, arglist):
+    """
+    Yield func(*args) for each `args` in `arglist`, computing the next
+    one in a background thread while the current one is being used
+    """
+    arglist = iter(arglist)
+    with ThreadPoolExecutor(1) as executor:
+        args = next(arglist, None)
+        future = None if args is None else executor.submit(func, *args)
+        while future is not None:
+            args = next(arglist, None)
+            current = future
+            future = None if args is None else executor.submit(func, *args)
+            yield current.result()
+
+
+class RedshiftResampler:
+    """
+    Linearly interpolates spectra observed at `from_z` onto the shared
+    observed-frame `wave` grid as if they were at `to_z`. Equivalent to
+    np.interp(wave/(1+to_z), wave/(1+from_z), spec) per spectrum (NaN
+    outside the grid), but done for a whole batch of spectra at once
+
+    If `wave` is uniformly spaced in log(wavelength), redshifting is just
+    a shift by a fractional number of pixels, the same for the whole
+    spectrum, so every spectrum is resampled as a weighted sum of two
+    shifted copies of itself, without searching for any indices
+    """
+    def __init__(self, wave, rtol=1e-6):
+        self.wave = np.asarray(wave, dtype=float)
+        assert self.wave.ndim == 1 and len(self.wave) > 1
+        assert np.all(np.diff(self.wave) > 0), "wave must be increasing"
+
+        dlogwave = np.diff(np.log(self.wave))
+        self.is_loguniform = np.allclose(dlogwave, dlogwave.mean(),
+                                         rtol=rtol, atol=0)
+        self.dlog = dlogwave.mean()
+
+    def __call__(self, specs, from_z, to_z, out=None):
+        """
+        Parameters
+        ----------
+        specs : array of shape (..., nwave)
+        from_z, to_z : arrays broadcastable to specs.shape[:-1]
+        out : array of shape specs.shape (optional)
+            Where to store the result. Default is a new float32 array
+
+        Returns
+        -------
+        Resampled spectra of the same shape as `specs`
+        """
+        nwave = len(self.wave)
+        shape = specs.shape
+        assert shape[-1] == nwave, "specs must be sampled on the wave grid"
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        specs = specs.reshape(-1, nwave)
+        from_z = np.broadcast_to(from_z, shape[:-1]).ravel()
+        to_z = np.broadcast_to(to_z, shape[:-1]).ravel()
+        flat_out = out.reshape(-1, nwave)
+
+        if self.is_loguniform:
+            self._shift_pixels(specs, np.log1p(from_z) - np.log1p(to_z),
+                               flat_out)
+        else:
+            for spec, z1, z2, o in zip(specs, from_z, to_z, flat_out):
+                o[:] = np.interp(self.wave / (1 + z2), self.wave / (1 + z1),
+                                 spec, left=np.nan, right=np.nan)
+        return out
+
+    def _shift_pixels(self, specs, logscale, out):
+        # Target pixel m lies between source pixels m + shift and
+        # m + shift + 1, at the same linear interpolation weight t for all m
+        nwave = len(self.wave)
+        shift = np.floor(logscale / self.dlog)
+        t = np.expm1(logscale - shift * self.dlog) / np.expm1(self.dlog)
+        t = t.astype(np.float32)[:, None]
+        shift = np.clip(shift, -nwave - 1, nwave).astype(np.intp)
+
+        # Padding with NaN takes care of pixels shifted off the grid
+        pad = np.abs(shift).max(initial=0) + 1
+        padded = np.empty((len(specs), nwave + 2 * pad), np.float32)
+        padded[:, :pad] = padded[:, -pad:] = np.nan
+        padded[:, pad:-pad] = specs
+        windows = np.lib.stride_tricks.sliding_window_view(
+            padded, nwave, axis=-1)
+        rows = np.arange(len(specs))
+        out[:] = windows[rows, shift + pad]
+        spec_hi = windows[rows, shift + pad + 1]
+        # Unshifted pixels (t = 0) shouldn't pick up NaNs from the next one
+        exact = t[:, 0] == 0
+        spec_hi[exact] = out[exact]
+        spec_hi -= out
+        spec_hi *= t
+        out += spec_hi
+
+
 def fill_nan_spec(spec, window_len=1000, inplace=False):
+    """
+    Fill the NaNs of each spectrum (row of `spec`) without any loop:
+    NaN runs inside the spectrum are linearly interpolated, and a NaN
+    run at either end is filled with the mean of the `window_len`
+    values next to it. Spectra which are entirely NaN are left as is
+    """
     assert np.ndim(spec) < 3
     newdim = np.ndim(spec) < 2
     if inplace:
@@ -450,23 +1364,35 @@ def fill_nan_spec(spec, window_len=1000, inplace=False):
         spec = np.array(spec)
     if newdim:
         spec = spec[None, :]
-    shape = spec.shape
+    nrow, ncol = spec.shape
 
-    # All NaNs must be one one side or the other
     isnan = np.isnan(spec)
-    last_on_left = np.where(np.diff(isnan, axis=-1))
-    assert np.all(np.arange(shape[0]) == last_on_left[0])
-    last_on_left = last_on_left[1]
-
-    window = np.arange(window_len)[None, :] + last_on_left[:, None]
-    window[isnan[:, 0], :] += 1
-    window[~isnan[:, 0], :] += 1 - window_len
-    window[window < 0] = 0
-    window[window >= shape[1]] = shape[1] - 1
-
-    fill = spec[np.arange(shape[0])[:, None], window].mean(axis=1)
-    fill = np.tile(fill[:, None], (1, spec.shape[1]))
-    spec[isnan] = fill[isnan]
+    first, last = nan_run_bounds(isnan)
+    valid = first < ncol
+    rows = np.arange(nrow)[:, None]
+    cols = np.arange(ncol)[None, :]
+
+    # Interpolate over interior runs all at once: offsetting each row by
+    # (ncol+1) lets a single np.interp call handle every spectrum
+    interior = isnan & (cols > first[:, None]) & (cols < last[:, None])
+    if interior.any():
+        offset = (np.arange(nrow) * (ncol + 1))[:, None]
+        known = ~isnan
+        xp = (cols + offset)[known]
+        spec[interior] = np.interp((cols + offset)[interior], xp,
+                                   spec[known])
+
+    # Fill the ends with the mean of the adjacent window (of valid values)
+    left_window = np.clip(first[:, None] + np.arange(window_len),
+                          first[:, None], last[:, None])
+    right_window = np.clip(last[:, None] - np.arange(window_len),
+                           first[:, None], last[:, None])
+    left_fill = spec[rows, left_window].mean(axis=1)
+    right_fill = spec[rows, right_window].mean(axis=1)
+    left = valid[:, None] & (cols < first[:, None])
+    right = valid[:, None] & (cols > last[:, None])
+    spec[left] = np.broadcast_to(left_fill[:, None], spec.shape)[left]
+    spec[right] = np.broadcast_to(right_fill[:, None], spec.shape)[right]
 
     if newdim:
         spec = spec[0, :]
@@ -474,24 +1400,114 @@ def fill_nan_spec(spec, window_len=1000, inplace=False):
 
 
 def count_nan(spec):
+    """
+    Number of NaNs at the start (positive) or, if none, at the end
+    (negative) of each spectrum. Zero if neither end is NaN
+    """
     assert np.ndim(spec) < 3
     newdim = np.ndim(spec) < 2
     if newdim:
         spec = spec[None, :]
 
-    isnan = np.isnan(spec)
-    last_on_left = np.where(np.diff(isnan, axis=-1))
-    assert np.all(np.arange(spec.shape[0]) == last_on_left[0])
-
-    counts = last_on_left[1] + 1
-    counts[~isnan[:, 0]] -= spec.shape[1]
+    ncol = spec.shape[1]
+    first, last = nan_run_bounds(np.isnan(spec))
+    counts = np.where(first > 0, np.minimum(first, ncol), last + 1 - ncol)
     if newdim:
         counts = counts[0]
     return counts
 
 
+def nan_run_bounds(isnan):
+    """
+    Indices of the first and last non-NaN value of each row of the
+    mask `isnan` (first = ncol and last = -1 for rows of all NaN)
+    """
+    ncol = isnan.shape[1]
+    known = ~isnan
+    anyknown = known.any(axis=1)
+    first = np.where(anyknown, known.argmax(axis=1), ncol)
+    last = np.where(anyknown, ncol - 1 - known[:, ::-1].argmax(axis=1), -1)
+    return first, last
+
+
+def redshift_flux_table(stacker, integrator, specids, z_grid, max_nan=5000,
+                        max_mem_usage=int(1e8), progress=False):
+    """
+    Filter fluxes (integrator.fluxes) of each spectrum of `specids`,
+    redshifted from its own redshift to each of `z_grid` (without any
+    distance correction). NaNs of each redshifted spectrum are filled
+    as in fix_specprops_columns, but before it is stacked, so stacks of
+    several neighbors with NaNs can differ slightly from filling the
+    stacked spectrum. Single spectra match it on grid points
+
+    Returns
+    -------
+    table : float32 array of shape (len(specids), len(z_grid), N_filters)
+    """
+    z_grid = np.asarray(z_grid)
+    table = np.empty((len(specids), len(z_grid),
+                      len(integrator.filter_strings)), dtype=np.float32)
+    from_z = stacker.id2redshift(specids)
+    rows_per_chunk = max(1, max_mem_usage // stacker.bytes_per_spec)
+    chunks = list(ms.util.generate_sublists(
+        list(range(len(specids))), rows_per_chunk))
+
+    iterator = progress_iterator(progress)
+    for i in iterator(len(chunks)):
+        rows = chunks[i]
+        specs = stacker.read_specs(specids[rows])
+        for j, z in enumerate(z_grid):
+            shifted = stacker.resample(specs, from_z[rows], z)
+            isnan = np.isnan(shifted)
+            hasnan = isnan.any(axis=1) & ~isnan.all(axis=1)
+            fix = np.flatnonzero(hasnan)[
+                np.abs(count_nan(shifted[hasnan])) <= max_nan]
+            shifted[fix] = fill_nan_spec(shifted[fix])
+            table[rows, j] = integrator.fluxes(shifted)
+    return table
+
+
+def interp_redshift_flux_table(table, z_grid, rows, redshift, lumcorrs):
+    """
+    Fluxes of stacked spectra from a redshift_flux_table(): the average
+    of lumcorrs * table[rows], linearly interpolated to `redshift`.
+    `rows` and `lumcorrs` may be (N,) or (N, num_neighbors). Raises
+    ValueError if any `redshift` is outside of `z_grid`
+    """
+    rows = np.atleast_2d(np.transpose(rows)).T
+    lumcorrs = np.atleast_2d(np.transpose(lumcorrs)).T
+    redshift = np.asarray(redshift)
+    if np.any(redshift < z_grid[0]) or np.any(redshift > z_grid[-1]):
+        raise ValueError(f"Redshifts from {redshift.min()} to "
+                         f"{redshift.max()} exceed z_grid, which spans "
+                         f"{z_grid[0]} to {z_grid[-1]}")
+    pos = np.interp(redshift, z_grid, np.arange(len(z_grid)))
+    lo = np.minimum(pos.astype(int), len(z_grid) - 2)[:, None]
+    t = (pos[:, None] - lo)[..., None]
+    lo_fluxes, hi_fluxes = table[rows, lo], table[rows, lo + 1]
+    # Grid points shouldn't pick up NaNs from the neighboring one
+    fluxes = np.where(t == 0, lo_fluxes, np.where(
+        t == 1, hi_fluxes, (1 - t) * lo_fluxes + t * hi_fluxes))
+    return np.mean(fluxes * lumcorrs[..., None], axis=1)
+
+
 def fix_specprops_columns(nfinder, um_redshift, specprops, cosmo,
-                          max_gband_nan=5000, specmap=None, progress=True):
+                          max_gband_nan=5000, specmap=None, progress=True,
+                          z_grid=None, workers=1, checkpoint=None,
+                          resume=False):
+    """
+    If `z_grid` is given (and no specmap is being saved), apparent
+    magnitudes are interpolated in redshift from tables precomputed by
+    redshift_flux_table(), instead of integrating a stacked spectrum
+    for every galaxy
+
+    Otherwise, sublists of galaxies are stacked and integrated on up to
+    `workers` processes. If `checkpoint` (file path without extension)
+    is given, magnitudes are stored there as they are computed, so that
+    if `resume` is true, an interrupted call on the same neighbors,
+    mass corrections, and redshifts resumes where it left off (see
+    checkpointed_memmap)
+    """
     nbr_id = specprops["id"]
     redshifts = um_redshift
     masscorr = nfinder.masscorr(nbr_id)
@@ -502,25 +1518,64 @@ def fix_specprops_columns(nfinder, um_redshift, specprops, cosmo,
 
     # For calculating mag_vals (apparent magnitudes)
     def get_appmags(integrator, show_progress=True, save_specmap=None):
-        iterator = progress_iterator(show_progress)
-        filternames = integrator.filter_strings
-
         sub_index = nfinder.sublist_indices(len(nbr_id))
-        ans = np.empty((len(nbr_id), len(filternames)), dtype="<f8")
-        for sub_i in iterator(len(sub_index)):
-            sub_i = sub_index[sub_i]
-            spectra = nfinder.avg_spectrum(nbr_id[sub_i],
-                                           masscorr[sub_i],
-                                           redshifts[sub_i])
-            if save_specmap is not None:
-                save_specmap[sub_i] = spectra
-            fix_nans = np.abs(count_nan(spectra)) <= max_gband_nan
-            spectra[fix_nans] = fill_nan_spec(spectra[fix_nans])
-            for j in range(len(filternames)):
-                ans[sub_i, j] = integrator.appmag_nm_njy(
-                    spectra, filternames[j]
-                )
-        return [*np.transpose(ans)]
+        shape = (len(nbr_id), len(integrator.filter_strings))
+        key = input_hash(nbr_id, masscorr, redshifts, np.concatenate(
+            sub_index), filters=integrator.filter_strings,
+                         max_gband_nan=max_gband_nan)
+        with checkpointed_memmap(checkpoint, shape, len(sub_index),
+                                 key=key, resume=resume) as (ans, done):
+            todo = np.flatnonzero(~done)
+
+            def compute(i, specs=None):
+                sub_i = sub_index[i]
+                spectra = nfinder.avg_spectrum(nbr_id[sub_i],
+                                               masscorr[sub_i],
+                                               redshifts[sub_i],
+                                               specs=specs)
+                if save_specmap is not None:
+                    save_specmap[sub_i] = spectra
+                # (from a filled library, only the ends shifted off the
+                # wavelength grid are NaN)
+                fix_nans = np.flatnonzero(np.isnan(spectra).any(axis=1))
+                fix_nans = fix_nans[np.abs(count_nan(spectra[fix_nans]))
+                                    <= max_gband_nan]
+                spectra[fix_nans] = fill_nan_spec(spectra[fix_nans])
+                ans[sub_i] = integrator.appmags(spectra)
+                # Only mark this sublist done once its results are stored
+                ans.flush()
+                done[i] = True
+                done.flush()
+
+            if workers > 1:
+                # Each forked worker writes straight into the memmap(s)
+                # (read, resampled and filled copies of each spectrum)
+                cost = nfinder.stacker.bytes_per_spec * 4
+                run_realizations(
+                    compute, [(i,) for i in todo], workers=workers,
+                    mem_costs=[cost * len(sub_index[i]) for i in todo])
+            else:
+                # Read the next sublist's spectra while this one is processed
+                iterator = progress_iterator(show_progress)
+                specs = prefetch(nfinder.stacker.read_specs,
+                                 [(nbr_id[sub_index[i]],) for i in todo])
+                for j in iterator(len(todo)):
+                    compute(todo[j], next(specs))
+            return [*np.array(ans).T]
+
+    # Same, but interpolated from each spectrum's table of fluxes on z_grid
+    def get_appmags_from_table(integrator, show_progress=True):
+        specids = np.unique(nbr_id)
+        table = redshift_flux_table(nfinder.stacker, integrator, specids,
+                                    z_grid, max_nan=max_gband_nan,
+                                    progress=show_progress)
+        lumcorr = masscorr * ms.util.redshift_rest_flux_correction(
+            from_z=nfinder.id2redshift(nbr_id), to_z=redshifts,
+            cosmo=ms.bplcosmo)
+        fluxes = interp_redshift_flux_table(
+            table, z_grid, np.searchsorted(specids, nbr_id), redshifts,
+            lumcorr)
+        return [*np.transpose(integrator.magnitudes(fluxes))]
 
     # For calculating line_vals
     def get_line(linename):
@@ -555,8 +1610,18 @@ def fix_specprops_columns(nfinder, um_redshift, specprops, cosmo,
     ]
     fintegrator = kcorrect.OptimizedFilterIntegrator(
         wavelength, [x[2:] for x in mag_names])
-    mag_vals = get_appmags(fintegrator, show_progress=progress,
-                           save_specmap=specmap)
+    if isinstance(specmap, SparseSpecmap):
+        # Only the stacking recipe is saved, not the spectra
+        nfinder.set_sparse_specmap(specmap, slice(None), nbr_id, masscorr,
+                                   redshifts)
+        specmap.flush()
+        specmap = None
+    if z_grid is None or specmap is not None:
+        mag_vals = get_appmags(fintegrator, show_progress=progress,
+                               save_specmap=specmap)
+    else:
+        mag_vals = get_appmags_from_table(fintegrator,
+                                          show_progress=progress)
     mag_dtypes = ["<f4"] * len(mag_names)
 
     # Collect lines integrated from the spectra
@@ -1,5 +1,9 @@
 import os
+import io
+import json
+import hashlib
 from math import ceil
+from concurrent.futures import ThreadPoolExecutor
 import natsort
 
 
@@ -22,39 +26,219 @@ def get_chunknames(filename):
     return [x for x in candidates if is_chunkname(x, filename)]
 
 
-def splitchunks_by_size(filename, chunksize, mem_usage=int(1e9)):
-    chunksize, mem_usage = int(chunksize), int(mem_usage)
-    file_remaining = os.stat(filename).st_size
-    numchunks = ceil(file_remaining / chunksize)
-    with open(filename, "rb") as f:
-        for i_chunk in range(numchunks):
-            with open(get_chunkname(filename, i_chunk), "wb") as chunk:
-                chunk_remaining = chunksize
-                nummems = min(file_remaining, chunksize) / mem_usage
-                nummems = ceil(nummems)
-                for _ in range(nummems):
-                    writesize = min(mem_usage, chunk_remaining, file_remaining)
-                    chunk.write(f.read(writesize))
-                    file_remaining -= writesize
-                    chunk_remaining -= writesize
-
-
-def splitchunks_by_num(filename, numchunks, mem_usage=int(1e9)):
+def get_manifestname(filename):
+    return f"{chunkbasename(filename)}manifest.json"
+
+
+def splitchunks_by_size(filename, chunksize, mem_usage=int(6.4e7),
+                        nthreads=None):
+    """
+    Split `filename` into chunks of `chunksize` bytes, which are written
+    in parallel on `nthreads` threads, using no more than `mem_usage`
+    bytes of buffers in total. The offset, size, and SHA256 of each
+    chunk are saved to a manifest (see get_manifestname), which
+    joinchunks uses to verify and resume the join.
+    """
+    chunksize = int(chunksize)
+    size = os.stat(filename).st_size
+    entries = [dict(name=os.path.basename(get_chunkname(filename, i)),
+                    offset=offset, size=min(chunksize, size - offset))
+               for i, offset in enumerate(range(0, size, chunksize))]
+    nthreads, bufsize = _threads_and_bufsize(len(entries), mem_usage,
+                                             nthreads)
+    dirname = os.path.dirname(filename)
+
+    def split_one(entry):
+        chunkname = os.path.join(dirname, entry["name"])
+        with open(filename, "rb") as f, open(chunkname, "w+b") as chunk:
+            copy_range(f.fileno(), chunk.fileno(), entry["offset"], 0,
+                       entry["size"], bufsize)
+            entry["sha256"] = sha256_range(chunk.fileno(), 0,
+                                           entry["size"], bufsize)
+
+    with ThreadPoolExecutor(nthreads) as executor:
+        list(executor.map(split_one, entries))
+    write_manifest(filename, entries)
+
+
+def splitchunks_by_num(filename, numchunks, mem_usage=int(6.4e7),
+                       nthreads=None):
     size = os.stat(filename).st_size
     chunksize = ceil(size / int(numchunks))
-    splitchunks_by_size(filename, chunksize, mem_usage=mem_usage)
+    splitchunks_by_size(filename, chunksize, mem_usage=mem_usage,
+                        nthreads=nthreads)
 
 
-def joinchunks(filename, mem_usage=int(1e9), rmchunks=False):
-    mem_usage = int(mem_usage)
-    chunknames = get_chunknames(filename)
-    with open(filename, "wb") as f:
-        for chunkname in chunknames:
-            size = os.stat(chunkname).st_size
+def joinchunks(filename, mem_usage=int(6.4e7), rmchunks=False,
+               nthreads=None):
+    """
+    Join the chunks of `filename` by copying each one to its offset
+    in parallel on `nthreads` threads, using no more than `mem_usage`
+    bytes of buffers in total (none when the kernel can copy them
+    directly). Each joined chunk is checked against the SHA256 in the
+    manifest, which is created first if the chunks were made elsewhere
+    (e.g., downloaded). If a previous join was interrupted, chunks which
+    are already in place are not copied again.
+    """
+    manifestname = get_manifestname(filename)
+    if os.path.isfile(manifestname):
+        with open(manifestname) as f:
+            entries = json.load(f)
+    else:
+        entries = write_manifest(filename)
+    nthreads, bufsize = _threads_and_bufsize(len(entries), mem_usage,
+                                             nthreads)
+    dirname = os.path.dirname(filename)
+    size = sum(entry["size"] for entry in entries)
+    resume = os.path.isfile(filename) and os.stat(filename).st_size == size
+
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if not resume:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+
+        def join_one(entry):
+            offset, nbytes = entry["offset"], entry["size"]
+            if resume and sha256_range(
+                    fd, offset, nbytes, bufsize) == entry["sha256"]:
+                return
+            chunkname = os.path.join(dirname, entry["name"])
             with open(chunkname, "rb") as chunk:
-                nummems = ceil(size / mem_usage)
-                for _ in range(nummems):
-                    f.write(chunk.read(min(mem_usage, size)))
+                copy_range(chunk.fileno(), fd, 0, offset, nbytes, bufsize)
+            if sha256_range(fd, offset, nbytes, bufsize) != entry["sha256"]:
+                raise ValueError(f"{chunkname} does not match the SHA256 "
+                                 f"in {manifestname}")
+
+        with ThreadPoolExecutor(nthreads) as executor:
+            list(executor.map(join_one, entries))
+    finally:
+        os.close(fd)
+
     if rmchunks:
-        for chunkname in chunknames:
-            os.remove(chunkname)
+        for entry in entries:
+            chunkname = os.path.join(dirname, entry["name"])
+            if os.path.isfile(chunkname):
+                os.remove(chunkname)
+        os.remove(manifestname)
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only stream through a list of chunk files in order, so the file
+    they make up can be read (e.g., by tarfile in "r|*" mode) without
+    ever being joined on disk
+
+    Parameters
+    ----------
+    chunknames : list[str]
+        Chunk files, in order
+    wait : callable | None
+        Called with the index of each chunk before it is opened, e.g. to
+        block until it is downloaded (and raise if its download failed)
+    rmchunks : bool
+        If true, each chunk is removed as soon as it has been read
+    """
+    def __init__(self, chunknames, wait=None, rmchunks=False):
+        super().__init__()
+        self.chunknames = list(chunknames)
+        self.wait = wait
+        self.rmchunks = rmchunks
+        self._index = -1
+        self._file = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self._file is None:
+                if self._index + 1 >= len(self.chunknames):
+                    return 0
+                self._index += 1
+                if self.wait is not None:
+                    self.wait(self._index)
+                self._file = open(self.chunknames[self._index], "rb")
+
+            n = self._file.readinto(buffer)
+            if n:
+                return n
+            self._file.close()
+            self._file = None
+            if self.rmchunks:
+                os.remove(self.chunknames[self._index])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+
+def write_manifest(filename, entries=None):
+    """
+    Save the list of chunk entries (name, offset, size, sha256) of
+    `filename`, computing them from its existing chunks if not given
+    """
+    if entries is None:
+        entries, offset = [], 0
+        for chunkname in get_chunknames(filename):
+            nbytes = os.stat(chunkname).st_size
+            with open(chunkname, "rb") as chunk:
+                sha256 = sha256_range(chunk.fileno(), 0, nbytes)
+            entries.append(dict(name=os.path.basename(chunkname),
+                                offset=offset, size=nbytes, sha256=sha256))
+            offset += nbytes
+
+    manifestname = get_manifestname(filename)
+    with open(manifestname + ".tmp", "w") as f:
+        json.dump(entries, f, indent=4)
+    os.replace(manifestname + ".tmp", manifestname)
+    return entries
+
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, size,
+               bufsize=int(1.6e7)):
+    """
+    Copy `size` bytes between file descriptors at the given offsets,
+    without moving either file position. Uses os.copy_file_range where
+    supported, and otherwise positional reads/writes of `bufsize` bytes
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while size > 0:
+                n = os.copy_file_range(src_fd, dst_fd, size,
+                                       src_offset, dst_offset)
+                if not n:
+                    break
+                src_offset, dst_offset, size = (src_offset + n,
+                                                dst_offset + n, size - n)
+        except OSError:
+            pass  # e.g. not supported across these filesystems
+
+    while size > 0:
+        buffer = os.pread(src_fd, min(bufsize, size), src_offset)
+        if not buffer:
+            raise EOFError(f"Source ended {size} bytes short")
+        n = os.pwrite(dst_fd, buffer, dst_offset)
+        src_offset, dst_offset, size = (src_offset + n,
+                                        dst_offset + n, size - n)
+
+
+def sha256_range(fd, offset, size, bufsize=int(1.6e7)):
+    """SHA256 hex digest of `size` bytes of a file at `offset`"""
+    sha256 = hashlib.sha256()
+    while size > 0:
+        buffer = os.pread(fd, min(bufsize, size), offset)
+        if not buffer:
+            break
+        sha256.update(buffer)
+        offset, size = offset + len(buffer), size - len(buffer)
+    return sha256.hexdigest()
+
+
+def _threads_and_bufsize(numchunks, mem_usage, nthreads=None):
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    nthreads = max(1, min(int(nthreads), numchunks))
+    return nthreads, max(1, int(mem_usage) // nthreads)
@@ -7,11 +7,15 @@ populated by `halotools` and `UniverseMachine` models.
 """
 
 import os
+import time
 import pathlib
+import sqlite3
 import warnings
 import json
 import inspect
-from contextlib import nullcontext
+import functools
+from contextlib import nullcontext, closing
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 
 import tqdm
@@ -420,6 +424,153 @@ class CompletenessTester:
         return mass, completeness
 
 
+class ConfigRegistry:
+    """
+    SQLite database (see default_registry_path) which stores the
+    contents of every config, and the list of files in each data
+    directory as of its last scan. Every write is a single transaction,
+    so concurrent processes can't corrupt it or read a partial config.
+
+    Configs saved as json files by older versions are imported when the
+    database is first created, and then renamed to *.json.imported,
+    since changes to them would no longer have any effect.
+    """
+    # Directory listings are only trusted if the directory was last
+    # modified this long before the scan (mtimes can be coarse)
+    racy_mtime_ns = int(2e9)
+    schema_version = 1
+
+    def __init__(self, filepath=None):
+        if filepath is None:
+            filepath = default_registry_path()
+            self.json_dir = util.config_file_directory()
+        else:
+            self.json_dir = os.path.dirname(filepath)
+        self.filepath = filepath
+        self._has_schema = False
+
+    def get(self, name):
+        """Contents of config `name`, or None if it isn't stored"""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT contents FROM configs WHERE name=?",
+                               (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, name, contents):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO configs VALUES (?, ?)",
+                         (name, json.dumps(contents)))
+
+    def delete(self, name):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM configs WHERE name=?", (name,))
+
+    def configs(self, prefix=""):
+        """Contents of every config whose name starts with `prefix`"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT name, contents FROM configs "
+                                "WHERE substr(name, 1, ?)=?",
+                                (len(prefix), prefix)).fetchall()
+        return {name: json.loads(contents) for name, contents in rows}
+
+    def listdir(self, directory):
+        """
+        Natural-sorted names of the regular files in `directory`. The
+        directory is only scanned again if its mtime has changed since
+        the last scan, which is then applied to the stored listing.
+        """
+        directory = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT mtime_ns, scan_ns FROM scans "
+                               "WHERE directory=?", (directory,)).fetchone()
+            stored = {name for (name,) in conn.execute(
+                "SELECT name FROM files WHERE directory=?", (directory,))}
+            if row is not None and row[0] == mtime and (
+                    mtime < row[1] - self.racy_mtime_ns):
+                return natsorted(stored)
+
+            scan_ns = time.time_ns()
+            with os.scandir(directory) as entries:
+                names = {entry.name for entry in entries if entry.is_file()}
+            with conn:
+                conn.executemany(
+                    "DELETE FROM files WHERE directory=? AND name=?",
+                    [(directory, name) for name in stored - names])
+                conn.executemany(
+                    "INSERT INTO files VALUES (?, ?)",
+                    [(directory, name) for name in names - stored])
+                conn.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?)",
+                             (directory, mtime, scan_ns))
+        return natsorted(names)
+
+    def _connect(self):
+        if not self._has_schema:
+            self._create_schema()
+        return sqlite3.connect(self.filepath, timeout=60)
+
+    def _create_schema(self):
+        # Only written once per database, so reads never need a write lock
+        pathlib.Path(self.filepath).parent.mkdir(parents=True, exist_ok=True)
+        imported = []
+        with closing(sqlite3.connect(self.filepath, timeout=60,
+                                     isolation_level=None)) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < self.schema_version:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    imported = self._init_tables(conn)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        for filepath in imported:
+            try:
+                os.replace(filepath, filepath + ".imported")
+            except OSError:
+                pass  # e.g. a read-only install
+        self._has_schema = True
+
+    def _init_tables(self, conn):
+        # Another process may have done this while we waited for the lock
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= self.schema_version:
+            return []
+        conn.execute("CREATE TABLE IF NOT EXISTS configs "
+                     "(name TEXT PRIMARY KEY, contents TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS scans "
+                     "(directory TEXT PRIMARY KEY, "
+                     "mtime_ns INTEGER, scan_ns INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS files "
+                     "(directory TEXT, name TEXT, "
+                     "PRIMARY KEY (directory, name))")
+        imported = []
+        if os.path.isdir(self.json_dir):
+            for name in os.listdir(self.json_dir):
+                if name.startswith("config-") and name.endswith(".json"):
+                    filepath = os.path.join(self.json_dir, name)
+                    with open(filepath) as f:
+                        conn.execute("INSERT OR IGNORE INTO configs "
+                                     "VALUES (?, ?)", (name, f.read()))
+                    imported.append(filepath)
+        conn.execute(f"PRAGMA user_version = {self.schema_version}")
+        return imported
+
+
+def default_registry_path():
+    """
+    registry.sqlite in the config file directory of the package, or if
+    that isn't writable (e.g., a system-wide install), in ~/.mocksurvey
+    """
+    dirpath = util.config_file_directory()
+    existing = dirpath if os.path.isdir(dirpath) else os.path.dirname(dirpath)
+    if not os.access(existing, os.W_OK):
+        dirpath = os.path.join(pathlib.Path.home(), ".mocksurvey")
+    return os.path.join(dirpath, "registry.sqlite")
+
+
+config_registry = ConfigRegistry()
+
+
 class BaseConfig(dict):
     """
     Abstract template class. Do not instantiate.
@@ -462,19 +613,32 @@ class BaseConfig(dict):
         d = self.get_path()
         # self.clear()
 
-        files = [f for f in natsorted(os.listdir(d))
-                 if os.path.isfile(os.path.join(d, f))]
+        files = config_registry.listdir(d)
+        self._listing = set(files)
 
         n = len(files)
-        for f in files:
-            try:
-                self.add_file(f)
-            except ValueError:
-                n -= 1
+        try:
+            for f in files:
+                try:
+                    self.add_file(f)
+                except ValueError:
+                    n -= 1
+        finally:
+            del self._listing
 
         print(f"Total of {n} files stored in {self}")
         self.save()
 
+    def isfile(self, filename):
+        """
+        Whether `filename` is a file in the data directory. During
+        auto_add, this is answered by the directory listing instead
+        of a call to the filesystem per file.
+        """
+        if hasattr(self, "_listing"):
+            return filename in self._listing
+        return os.path.isfile(self.get_path(filename))
+
     def save(self):
         """
         Update the config file to account for any changes that have
@@ -489,8 +653,7 @@ class BaseConfig(dict):
 
         # Don't write the file if this is a temporary config
         if not self.is_temp and not self["data_dir"] is None:
-            with open(self._filepath, "w") as f:
-                json.dump(self, f, indent=4)
+            config_registry.put(self._config_name, self.dict())
 
     def add_file(self, filename):
         """
@@ -509,7 +672,7 @@ class BaseConfig(dict):
             raise ValueError("That file is already stored")
 
         fullpath = os.path.join(self.get_path(), filename)
-        if not os.path.isfile(fullpath):
+        if not self.isfile(filename):
             raise FileNotFoundError(f"{fullpath} does not exist.")
 
         self["files"].append(filename)
@@ -541,7 +704,9 @@ class BaseConfig(dict):
 
     def delete(self):
         self.clear_keys(keep=[])
-        os.remove(self._filepath)
+        config_registry.delete(self._config_name)
+        if os.path.isfile(self._filepath):
+            os.remove(self._filepath)
 
     def clear_keys(self, keys=None, keep=None):
         """
@@ -562,16 +727,14 @@ class BaseConfig(dict):
         dirpath = util.config_file_directory()
         filepath = os.path.join(dirpath, filename)
 
+        # Configs are stored in the registry under their old json filename
+        self._config_name = filename
         self._filepath = filepath
 
-        #  Don't read the file if this is a temporary config
+        #  Don't read the config if this is a temporary config
         if not self.is_temp:
-            if not os.path.isdir(dirpath):
-                os.mkdir(dirpath)
-
-            if os.path.isfile(filepath):
-                with open(filepath) as f:
-                    config = json.load(f)
+            config = config_registry.get(filename)
+            if config is not None:
                 self.update(config)
 
 
@@ -854,10 +1017,8 @@ class LightConeConfig(BaseConfig):
 
     @staticmethod
     def stored_lightcones():
-        available = [os.path.join(util.config_file_directory(), x)
-                     for x in os.listdir(util.config_file_directory())
-                     if x.startswith("config-lightcone-")]
-        return [json.load(open(x))["data_dir"] for x in available]
+        return [config["data_dir"] for config in
+                config_registry.configs("config-lightcone-").values()]
 
     @staticmethod
     def available_lightcones():
@@ -925,12 +1086,18 @@ class LightConeConfig(BaseConfig):
         Returns
         -------
         meta : dict
-            Dictionay storing additional information about this lightcone
+            Dictionay storing additional information about this lightcone.
+            If the json file is missing, but the ascii file was kept, only
+            the information in its header is returned
         """
         self._check_load_index(index)
 
         datafile = self.get_path(self["files"][index])
         metafile = util.change_file_extension(datafile, "json")
+        asciifile = util.change_file_extension(datafile, "dat")
+        if not os.path.isfile(metafile) and os.path.isfile(asciifile):
+            return climber.util.metadict_from_header(
+                climber.util.read_ascii_header(asciifile))
         with open(metafile) as f:
             return json.load(f)
 
@@ -943,7 +1110,10 @@ class LightConeConfig(BaseConfig):
         return np.load(specpropfile)
 
     def load_specmap(self, index):
-        """Load memory-map of spectra data cube"""
+        """
+        Load memory-map of spectra data cube. Compact formats (see
+        lightcone_spectra) are decoded as spectra are accessed
+        """
         self._check_load_index(index, "spec")
 
         datafile = self.get_path(self["files"][index])
@@ -951,7 +1121,8 @@ class LightConeConfig(BaseConfig):
 
         meta = self.load_meta(index)
         shape = meta["Ngal"], meta["Nwave"]
-        return np.memmap(specfile, dtype="<f4", shape=shape)
+        return climber.util.open_specmap(
+            specfile, shape, meta.get("spec_format", "f4"))
 
     def add_file(self, filename):
         """
@@ -971,7 +1142,7 @@ class LightConeConfig(BaseConfig):
 
         if not filename.endswith(".npy"):
             raise ValueError(f"lightcone file {filename} must end in '.npy'")
-        if not os.path.isfile(metapath):
+        if not self.isfile(meta_filename):
             raise ValueError(f"metadata file {metapath} does not exist")
 
         BaseConfig.add_file(self, filename)
@@ -1428,16 +1599,94 @@ class SeanSpectraConfig(BaseConfig):
     def are_all_files_stored(self):
         return set(self["files"]) == set(self.SEANFILES)
 
-    def load(self, old_version=False, keep_all_columns=True):
+    def load(self, old_version=False, keep_all_columns=True, cache=False):
+        """
+        Load the catalog as a DataFrame. If cache=True, it is loaded from
+        the table cache (see load_table), which is much faster than
+        reading the fits file, and gives the same columns
+        """
+        if cache:
+            dat = self.load_table(old_version)
+            names = dat.dtype.names
+            if not keep_all_columns:
+                keep = set(self.names_to_keep())
+                if keep.difference(names):
+                    raise KeyError(f"columns {keep.difference(names)} "
+                                   f"do not exist")
+                names = [name for name in names if name in keep]
+            return pd.DataFrame({name: dat[name] for name in names})
+
         i = 5 if old_version else 0
         dat = astropy_table.Table.read(self.get_filepath(i))
         if not keep_all_columns:
             dat.keep_columns(self.names_to_keep())
         return dat.to_pandas()
 
+    def load_table(self, old_version=False):
+        """
+        Memory-mapped structured array of all columns of the catalog.
+        It is converted from the fits file once and cached as a hidden
+        .npy file in the data directory. Raises ValueError if a column
+        can't be stored this way (variable-length, or masked values
+        which aren't floats)
+        """
+        fitsfile = self.get_filepath(5 if old_version else 0)
+        npyfile = self._cache_path(fitsfile, "npy")
+        if util.is_stale(npyfile, fitsfile):
+            dat = astropy_table.Table.read(fitsfile)
+            cols = {}
+            for name in dat.colnames:
+                col = dat[name]
+                if hasattr(col, "filled"):
+                    if col.dtype.kind == "f":
+                        col = col.filled(np.nan)
+                    elif np.any(col.mask):
+                        raise ValueError(f"Can't cache masked values of "
+                                         f"column {name!r} of {fitsfile}")
+                    else:
+                        col = col.filled()
+                if col.dtype.kind == "O":
+                    raise ValueError(f"Can't cache variable-length column "
+                                     f"{name!r} of {fitsfile}")
+                cols[name] = col
+            table = np.empty(len(dat), dtype=[
+                (name, col.dtype.newbyteorder("="), col.shape[1:])
+                for name, col in cols.items()])
+            for name, col in cols.items():
+                table[name] = col
+            util.save_npy(npyfile, table)
+        return np.load(npyfile, mmap_mode="r")
+
+    def table_rows(self, ids, old_version=False):
+        """
+        Row of load_table() of each UltraVISTA ID in `ids`
+        """
+        fitsfile = self.get_filepath(5 if old_version else 0)
+        indexfile = self._cache_path(fitsfile, "index.npy")
+        if util.is_stale(indexfile, fitsfile):
+            util.save_npy(indexfile, util.id_index(
+                self.load_table(old_version)["id"]))
+        return util.lookup_id_index(np.load(indexfile), ids)
+
+    def _cache_path(self, filename, ext):
+        base = os.path.splitext(os.path.basename(filename))[0]
+        return self.get_path(f".{base}.{ext}")
+
     def specid(self):
         return np.load(self.get_filepath(1))
 
+    def specid_index(self):
+        """
+        Index from UltraVISTA ID to row of specid() (and of specmap()),
+        for util.lookup_id_index. Built once and saved as a hidden file
+        in the data directory, so all consumers of the spectra share it
+        """
+        specidfile = self.get_filepath(1)
+        indexfile = self._cache_path(specidfile, "index.npy")
+        if util.is_stale(indexfile, specidfile):
+            util.save_npy(indexfile, util.id_index(self.specid()))
+        return np.load(indexfile)
+
     def wavelength(self):
         return np.load(self.get_filepath(2))
 
@@ -1449,6 +1698,43 @@ class SeanSpectraConfig(BaseConfig):
         shape = (self.specid().size, self.wavelength().size)
         return lambda: np.memmap(path, dtype="<f4", shape=shape)
 
+    def filled_specmap(self, max_mem_usage=int(1e8)):
+        """
+        Same as specmap(), but with the NaNs of every spectrum filled
+        by climber.util.fill_nan_spec. The filled copy is only written
+        once, as a hidden file in the data directory, along with the
+        NaN counts of the original spectra (see nan_counts)
+        """
+        path = self.get_filepath(3)
+        filled = self._cache_path(path, "filled.mmap")
+        countfile = self._cache_path(path, "nancount.npy")
+        shape = (self.specid().size, self.wavelength().size)
+        if util.is_stale(countfile, path) or not os.path.isfile(filled):
+            original = self.specmap()()
+            tmp = f"{filled}.tmp{os.getpid()}"
+            out = np.memmap(tmp, dtype="<f4", mode="w+", shape=shape)
+            counts = np.empty(shape[0], dtype=int)
+            rows = max(1, max_mem_usage // (4 * shape[1]))
+            for i in range(0, shape[0], rows):
+                chunk = np.array(original[i:i + rows])
+                counts[i:i + rows] = climber.util.count_nan(chunk)
+                out[i:i + rows] = climber.util.fill_nan_spec(
+                    chunk, inplace=True)
+            out.flush()
+            del out
+            os.replace(tmp, filled)
+            # Written last, so it marks the filled copy as complete
+            util.save_npy(countfile, counts)
+        return lambda: np.memmap(filled, dtype="<f4", mode="r", shape=shape)
+
+    def nan_counts(self):
+        """
+        Number of NaNs filled at the start (positive) or end (negative)
+        of each spectrum in filled_specmap() (see climber.util.count_nan)
+        """
+        self.filled_specmap()
+        return np.load(self._cache_path(self.get_filepath(3), "nancount.npy"))
+
 
 class UMWgetter:
     fileinfo = [
@@ -1644,19 +1930,43 @@ class UMWgetter:
         self.fileids = [file[1] for file in self.fileinfo]
         self.sizes = [int(file[2]) for file in self.fileinfo]
 
-    def download_sfrcat_index(self, i, overwrite=False):
+    def download_sfrcat_index(self, i, overwrite=False, progress=True):
         fileid = self.fileids[i]
         size = self.sizes[i]
         outfile = UMConfig().get_path(self.sfr_cats[i])
         util.download_file_from_google_drive(fileid, outfile, size=size,
-                                             overwrite=overwrite)
+                                             overwrite=overwrite,
+                                             progress=progress)
 
-    def download_sfrcat_redshift(self, redshift, overwrite=False):
+    def download_sfrcat_redshift(self, redshift, overwrite=False,
+                                 max_workers=4, verify=False):
+        """
+        Download the catalogs within the given redshift range, skipping
+        those already downloaded intact (checked against the download
+        manifest by sampled checksums, or full ones if `verify` is true)
+        """
         zmin, zmax = np.min(redshift), np.max(redshift)
         imin = util.choose_close_index(zmax, self.redshifts, "none")
         imax = util.choose_close_index(zmin, self.redshifts, "none")
-        for i in range(imin, imax+1):
-            self.download_sfrcat_index(i, overwrite=overwrite)
+        indices = list(range(imin, imax+1))
+        path = UMConfig().get_path()
+        if not overwrite:
+            missing = util.verify_downloads(
+                path, [self.sfr_cats[i] for i in indices],
+                [self.sizes[i] for i in indices], full=verify)
+            indices = [i for i in indices if self.sfr_cats[i] in missing]
+            for i in indices:
+                if os.path.isfile(os.path.join(path, self.sfr_cats[i])):
+                    os.remove(os.path.join(path, self.sfr_cats[i]))
+            if not indices:
+                print("All files already downloaded")
+
+        util.download_files(
+            [functools.partial(self.download_sfrcat_index, i,
+                               overwrite=overwrite, progress=False)
+             for i in indices], max_workers=max_workers)
+        util.record_downloads(path, [self.sfr_cats[i] for i in indices],
+                              [self.fileids[i] for i in indices])
         UMConfig().auto_add()
 
 
@@ -1686,70 +1996,126 @@ class UVISTAWgetter:
 
     @staticmethod
     def decompress_tar(tarf):
-        tar = tarfile.open(tarf)
-        tar.extractall(path=os.path.dirname(tarf))
+        with tarfile.open(tarf) as tar:
+            members = util.extract_tar(tar, os.path.dirname(tarf))
         os.remove(tarf)
+        return members
 
     @staticmethod
-    def download_and_join_chunks(gfids, tarf, overwrite=False):
-        for i, gfid in enumerate(gfids):
-            util.wget_download(gfid, outfile=f"{tarf}.chunk.{i}",
-                               overwrite=overwrite)
+    def download_and_join_chunks(gfids, tarf, overwrite=False,
+                                 max_workers=4):
+        util.download_files(
+            [functools.partial(util.download_file_from_google_drive, gfid,
+                               f"{tarf}.chunk.{i}", overwrite=overwrite,
+                               progress=False)
+             for i, gfid in enumerate(gfids)], max_workers=max_workers)
         filechunk.joinchunks(tarf, rmchunks=True)
 
     @staticmethod
-    def wget_and_join_chunks(urls, tarf, overwrite=False):
-        for i, url in enumerate(urls):
-            util.wget_download(url, outfile=f"{tarf}.chunk.{i}",
-                               overwrite=overwrite)
+    def wget_and_join_chunks(urls, tarf, overwrite=False, max_workers=4):
+        util.download_files(
+            [functools.partial(util.download_file, url, f"{tarf}.chunk.{i}",
+                               overwrite=overwrite, progress=False)
+             for i, url in enumerate(urls)], max_workers=max_workers)
         filechunk.joinchunks(tarf, rmchunks=True)
 
     @staticmethod
-    def check_already_downloaded(wget_files, config):
-        stored_files = os.listdir(config.get_path())
-        if ans := set(wget_files).issubset(stored_files):
+    def download_and_extract_chunks(downloads, chunknames, path,
+                                    max_workers=4):
+        """
+        Extract the tarball split into `chunknames` to `path` while the
+        chunks are still being downloaded by `downloads` (functions with
+        no arguments, see util.download_files). Chunks are streamed in
+        order and removed once extracted, so the tarball is never joined.
+        Returns the tarball's members (see util.extract_tar).
+        """
+        with ThreadPoolExecutor(max(1, int(max_workers))) as executor:
+            futures = [executor.submit(download) for download in downloads]
+            try:
+                with filechunk.ChunkReader(
+                        chunknames, wait=lambda i: futures[i].result(),
+                        rmchunks=True) as f:
+                    with tarfile.open(fileobj=f, mode="r|*") as tar:
+                        members = util.extract_tar(tar, path)
+                    f.read()  # Remove any chunks of padding left unread
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return members
+
+    def wget_and_extract_chunks(self, urls, tarf, overwrite=False,
+                                max_workers=4):
+        chunknames = [f"{tarf}.chunk.{i}" for i in range(len(urls))]
+        return self.download_and_extract_chunks(
+            [functools.partial(util.download_file, url, chunkname,
+                               overwrite=overwrite, progress=False)
+             for url, chunkname in zip(urls, chunknames)],
+            chunknames, os.path.dirname(tarf), max_workers=max_workers)
+
+    @staticmethod
+    def check_already_downloaded(wget_files, config, verify=False):
+        """
+        Whether every file in `wget_files` is downloaded intact,
+        according to the download manifest (see util.verify_downloads)
+        """
+        missing = util.verify_downloads(config.get_path(), wget_files,
+                                        full=verify)
+        if ans := not missing:
             print("All files already downloaded")
             config.auto_add()
         return ans
 
-    def download_uvista(self, overwrite=False):
+    uvista_files = ["UVISTA_final_BC03_v4.1.fout",
+                    "UVISTA_final_colors_sfrs_v4.1.dat",
+                    "UVISTA_final_v4.1.153-155.rf",
+                    "UVISTA_final_v4.1.155-161.rf",
+                    "UVISTA_final_v4.1.cat",
+                    "UVISTA_final_v4.1.zout"]
+    sean_files = ["specid.npy", "wavelength.npy",
+                  "isnan.npy", "cosmos_V17.fits",
+                  "PYOBS"]
+    spec_files = ["spectra.mmap"]
+
+    def download_uvista(self, overwrite=False, verify=False):
         if not overwrite:
-            wget_files = ["UVISTA_final_BC03_v4.1.fout",
-                          "UVISTA_final_colors_sfrs_v4.1.dat",
-                          "UVISTA_final_v4.1.153-155.rf",
-                          "UVISTA_final_v4.1.155-161.rf",
-                          "UVISTA_final_v4.1.cat",
-                          "UVISTA_final_v4.1.zout"]
-            if self.check_already_downloaded(wget_files, self.uvista_config):
+            if self.check_already_downloaded(
+                    self.uvista_files, self.uvista_config, verify=verify):
                 return
 
+        util.begin_downloads(self.uvista_path, self.uvista_files)
         util.download_file_from_google_drive(
             self.uvista_gfid, self.uvista_tarf)
-        self.decompress_tar(self.uvista_tarf)
+        members = self.decompress_tar(self.uvista_tarf)
+        util.record_downloads(self.uvista_path, self.uvista_files,
+                              self.uvista_gfid, members=members)
         UVISTAConfig().auto_add()
 
-    def download_sean_specprops(self, overwrite=False):
+    def download_sean_specprops(self, overwrite=False, verify=False):
         if not overwrite:
-            wget_files = ["specid.npy", "wavelength.npy",
-                          "isnan.npy", "cosmos_V17.fits",
-                          "PYOBS"]
-            if self.check_already_downloaded(wget_files, self.sean_config):
+            if self.check_already_downloaded(
+                    self.sean_files, self.sean_config, verify=verify):
                 return
 
+        util.begin_downloads(self.sean_path, self.sean_files)
         util.wget_download(self.sean_url, outfile=self.sean_tarf,
                            overwrite=overwrite)
-        self.decompress_tar(self.sean_tarf)
+        members = self.decompress_tar(self.sean_tarf)
+        util.record_downloads(self.sean_path, self.sean_files,
+                              self.sean_url, members=members)
         SeanSpectraConfig().auto_add()
 
-    def download_sean_specmap(self, overwrite=False):
+    def download_sean_specmap(self, overwrite=False, verify=False):
         if not overwrite:
-            wget_files = ["spectra.mmap"]
-            if self.check_already_downloaded(wget_files, self.sean_config):
+            if self.check_already_downloaded(
+                    self.spec_files, self.sean_config, verify=verify):
                 return
 
-        self.wget_and_join_chunks(self.spec_urls, self.spec_tarf,
-                                  overwrite=overwrite)
-        self.decompress_tar(self.spec_tarf)
+        util.begin_downloads(self.spec_path, self.spec_files)
+        members = self.wget_and_extract_chunks(
+            self.spec_urls, self.spec_tarf, overwrite=overwrite)
+        util.record_downloads(self.spec_path, self.spec_files,
+                              " ".join(self.spec_urls), members=members)
         SeanSpectraConfig().auto_add()
 
 
@@ -93,6 +93,11 @@ class LightCone:
                 help="Don't generate new lightcones. Use preexisting ascii "
                      "files in the location they are expected")
 
+        # Options for batch processing
+        add_batch_arguments(parser, resume_help=(
+            "Skip realizations already converted by a previous run "
+            "(use with --start-from-ascii)"))
+
     def __call__(self):
         a = self.parser.parse_args()
         if "," in a.photbands:
@@ -109,7 +114,8 @@ class LightCone:
                              obs_mass_limit=a.obs_mass_limit, true_mass_limit=a.true_mass_limit,
                              outfilepath=a.outfilepath, id_tag=a.NAME, do_collision_test=a.do_collision_test,
                              ra=a.ra_center, dec=a.dec_center, theta=a.theta_center, rseed=a.rseed,
-                             keep_ascii_files=a.keep_ascii_files, start_from_ascii=a.start_from_ascii)
+                             keep_ascii_files=a.keep_ascii_files, start_from_ascii=a.start_from_ascii,
+                             workers=a.workers, resume=a.resume)
 
 
 class LightConeSelection:
@@ -167,6 +173,11 @@ class LightConeSelection:
             "--outfile", type=str, metavar="NAME",
             help="Base of the filename of the new lightcone")
 
+        # Options for batch processing
+        add_batch_arguments(parser, resume_help=(
+            "Allow OUTPUT_NAME to exist, and skip realizations already "
+            "selected there by a previous run"))
+
     def __call__(self):
         a = self.parser.parse_args()
         if a.max is not None:
@@ -179,7 +190,8 @@ class LightConeSelection:
         ms.climber.lightcone_selection(a.INPUT_NAME, a.OUTPUT_NAME, selector,
                                       outfile=a.outfile,
                                       input_realization=a.realization,
-                                      nblocks_per_dim=a.nblocks_per_dim)
+                                      nblocks_per_dim=a.nblocks_per_dim,
+                                      workers=a.workers, resume=a.resume)
 
 
 class LightConeSpectra:
@@ -199,6 +211,11 @@ class LightConeSpectra:
         parser.add_argument(
             "--make-specmap", "-s", action="store_true",
             help="Include large data cubes of raw spectra for the whole mock")
+        parser.add_argument(
+            "--spec-format", choices=["f4", "log16", "sparse"], default="f4",
+            help="Storage format of the spectra data cubes. 'log16' is "
+                 "half the size, accurate to < 2e-4 mag. 'sparse' only "
+                 "stores the neighbors and weights to stack spectra from")
 
         # Option to specify input lightcones
         parser.add_argument(
@@ -215,13 +232,26 @@ class LightConeSpectra:
             "--best-of", type=int, metavar="N", default=6,
             help="Number of nearest neighbors in mass,sSFR,z-space from "
                  "which to choose the nearest neighbor in color-space")
+        parser.add_argument(
+            "--fill-library", action="store_true",
+            help="Stack spectra from a copy of the spectra library whose "
+                 "NaNs are filled once and cached, instead of filling "
+                 "NaNs of every stacked spectrum")
+
+        # Options for batch processing
+        add_batch_arguments(parser, resume_help=(
+            "Skip realizations whose spectra were already assigned "
+            "by a previous run"))
 
     def __call__(self):
         a = self.parser.parse_args()
         ms.climber.lightcone_spectra(a.INPUT_NAME, a.realization,
                                     make_specmap=a.make_specmap,
                                     best_of=a.best_of,
-                                    photbands=a.photbands)
+                                    photbands=a.photbands,
+                                    workers=a.workers, resume=a.resume,
+                                    spec_format=a.spec_format,
+                                    fill_library=a.fill_library)
 
 
 class SetDataPath:
@@ -279,13 +309,16 @@ class DownloadUM:
         # Options
         # parser.add_argument("--verbose", "-v", action="store_true")
         parser.add_argument("--overwrite", "-o", action="store_true")
+        parser.add_argument("--verify", action="store_true",
+                            help="Check existing files by their full "
+                                 "checksums, instead of sampled ones")
 
     def __call__(self):
         a = self.parser.parse_args()
 
         redshift = a.Z_LOW if a.Z_HIGH is None else [a.Z_LOW, a.Z_HIGH]
         ms.UMWgetter().download_sfrcat_redshift(
-            redshift, overwrite=a.overwrite)
+            redshift, overwrite=a.overwrite, verify=a.verify)
 
 
 # TODO
@@ -322,13 +355,17 @@ class DownloadUVISTA:
         # Options
         # parser.add_argument("--verbose", "-v", action="store_true")
         parser.add_argument("--overwrite", "-o", action="store_true")
+        parser.add_argument("--verify", action="store_true",
+                            help="Check existing files by their full "
+                                 "checksums, instead of sampled ones")
 
     def __call__(self):
         a = self.parser.parse_args()
 
         wgetter = ms.UVISTAWgetter()
-        wgetter.download_uvista(overwrite=a.overwrite)
-        wgetter.download_sean_specprops(overwrite=a.overwrite)
+        wgetter.download_uvista(overwrite=a.overwrite, verify=a.verify)
+        wgetter.download_sean_specprops(overwrite=a.overwrite,
+                                        verify=a.verify)
 
 
 class DownloadUVISTAMockSpectra:
@@ -343,12 +380,16 @@ class DownloadUVISTAMockSpectra:
         # Options
         # parser.add_argument("--verbose", "-v", action="store_true")
         parser.add_argument("--overwrite", "-o", action="store_true")
+        parser.add_argument("--verify", action="store_true",
+                            help="Check existing files by their full "
+                                 "checksums, instead of sampled ones")
 
     def __call__(self):
         a = self.parser.parse_args()
 
         wgetter = ms.UVISTAWgetter()
-        wgetter.download_sean_specmap(overwrite=a.overwrite)
+        wgetter.download_sean_specmap(overwrite=a.overwrite,
+                                      verify=a.verify)
 
 
 class Config:  # TODO: write list-all-configs delete-directory command
@@ -406,6 +447,14 @@ class Config:  # TODO: write list-all-configs delete-directory command
         config.save()
 
 
+def add_batch_arguments(parser, resume_help):
+    parser.add_argument(
+        "--workers", type=int, default=1, metavar="N",
+        help="Number of realizations to process in parallel. Fewer are "
+             "run at once if there isn't enough memory available")
+    parser.add_argument("--resume", action="store_true", help=resume_help)
+
+
 class DictItem:
     def __init__(self, valuetype=float):
         self._is_value = True
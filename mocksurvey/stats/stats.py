@@ -128,11 +128,136 @@ def qpgf(catalog, rands, search_rad=4.0, search_min=0.3, pimax=None,
             precomputed_primary_selection=precomputed_primary_selection)
 
 
-def find_primaries(sample1, sample2, search_rad, pimax, m1, m2, period=None):
-    n_larger = _nic(sample1, sample2, search_rad, pimax, m1, m2,
-                   inclusive_bounds=[False, True],
-                   mass_ratio_lims=[1, np.inf], period=period)
-    return n_larger == 0
+def find_primaries(sample1, sample2, search_rad, pimax, m1, m2, period=None,
+                   max_pairs=int(1e7)):
+    """
+    Returns a boolean array, True for each galaxy in `sample1` that has
+    no strictly more massive galaxy in `sample2` within a cylinder of
+    radius `search_rad` (xy-plane) and half-length `pimax` (z-axis).
+    Equivalent to counting neighbors with m2/m1 > 1 via _nic, but much
+    faster since we never have to count past the first neighbor.
+
+    `sample2` is binned onto a grid of cells at least as large as the
+    cylinder, and sorted by descending mass within each cell. The only
+    candidates in a cell are then a prefix of it, found by binary
+    search, which is nearly empty for the most massive galaxies. A
+    galaxy stops being searched as soon as one larger neighbor is found.
+    At most `max_pairs` candidate pairs are held in memory at a time.
+    """
+    sample1 = np.asarray(sample1, dtype=np.float64).reshape(-1, 3)
+    sample2 = np.asarray(sample2, dtype=np.float64).reshape(-1, 3)
+    m1, m2 = np.asarray(m1, dtype=np.float64), np.asarray(m2, dtype=np.float64)
+    n1, n2 = len(sample1), len(sample2)
+    search_rad = np.broadcast_to(np.asarray(search_rad, dtype=np.float64), n1)
+    pimax = np.broadcast_to(np.asarray(pimax, dtype=np.float64), n1)
+
+    is_primary = np.ones(n1, dtype=bool)
+    if not n1 or not n2 or search_rad.max() <= 0 or pimax.max() <= 0:
+        return is_primary
+
+    # Set up the cell grid (at least as large as the cylinder)
+    extent = np.array([search_rad.max(), search_rad.max(), pimax.max()])
+    if period is None:
+        lo = np.minimum(sample1.min(axis=0), sample2.min(axis=0))
+        span = np.maximum(sample1.max(axis=0), sample2.max(axis=0)) - lo
+        span[span == 0] = 1.0
+    else:
+        period = np.broadcast_to(np.asarray(period, dtype=np.float64), 3)
+        lo, span = np.zeros(3), period
+        sample1, sample2 = sample1 % period, sample2 % period
+    ncell = np.clip(np.floor(span / extent), 1, 2 ** 20).astype(np.int64)
+    # Cell index * n2 must not overflow int64 (coarser cells are safe)
+    while np.prod(ncell.astype(float)) * n2 >= 2 ** 62:
+        ncell = np.maximum(ncell // 2, 1)
+
+    def cell_coords(pos):
+        ijk = np.floor((pos - lo) / span * ncell).astype(np.int64)
+        return np.clip(ijk, 0, ncell - 1)
+
+    def cell_index(ijk):
+        return (ijk[:, 0] * ncell[1] + ijk[:, 1]) * ncell[2] + ijk[:, 2]
+
+    # Sort sample2 by cell, then by descending mass (via its mass rank)
+    mass_order = np.argsort(-m2, kind="stable")
+    mass_rank = np.empty(n2, dtype=np.int64)
+    mass_rank[mass_order] = np.arange(n2)
+    keys = cell_index(cell_coords(sample2)) * n2 + mass_rank
+    order = np.argsort(keys, kind="stable")
+    keys, sample2 = keys[order], sample2[order]
+    # Number of sample2 galaxies strictly more massive than each m1
+    num_larger = n2 - np.searchsorted(np.sort(m2), m1, side="right")
+
+    # Visit sample1 in cell order so the binary searches stay local
+    ijk1 = cell_coords(sample1)
+    order1 = np.argsort(cell_index(ijk1), kind="stable")
+    ijk1, sample1 = ijk1[order1], sample1[order1]
+    num_larger, search_rad, pimax = (num_larger[order1], search_rad[order1],
+                                     pimax[order1])
+
+    # Search the home cell first, since it is the most likely hit
+    shifts = [sorted(set(range(-1, 2)) if n > 2 or period is None
+                     else set((np.arange(-1, 2) % n).tolist()), key=abs)
+              for n in ncell]
+    offsets = [(i, j, k) for i in shifts[0] for j in shifts[1]
+               for k in shifts[2]]
+    for offset in offsets:
+        query = np.flatnonzero(is_primary & (num_larger > 0))
+        if not len(query):
+            break
+        ijk = ijk1[query] + offset
+        if period is None:
+            valid = np.all((0 <= ijk) & (ijk < ncell), axis=1)
+            query, ijk = query[valid], ijk[valid]
+        else:
+            ijk %= ncell
+        cell = cell_index(ijk) * n2
+        start = np.searchsorted(keys, cell, side="left")
+        counts = np.searchsorted(keys, cell + num_larger[query],
+                                 side="left") - start
+        query, start, counts = query[counts > 0], start[counts > 0], \
+            counts[counts > 0]
+        if not len(query):
+            continue
+
+        # Expand candidate pairs in batches of roughly max_pairs
+        cumcounts = np.cumsum(counts)
+        edges = np.searchsorted(cumcounts, np.arange(
+            max_pairs, cumcounts[-1], max_pairs))
+        edges = np.unique([0, *edges, len(query)])
+        for a, b in zip(edges[:-1], edges[1:]):
+            q, c = query[a:b], counts[a:b]
+            first = np.repeat(np.cumsum(c) - c, c)
+            i1 = np.repeat(q, c)
+            i2 = np.arange(c.sum()) - first + np.repeat(start[a:b], c)
+
+            diff = sample2[i2] - sample1[i1]
+            if period is not None:
+                diff -= period * np.round(diff / period)
+            inside = ((diff[:, 0] ** 2 + diff[:, 1] ** 2
+                       < search_rad[i1] ** 2) &
+                      (diff[:, 2] ** 2 < pimax[i1] ** 2))
+            is_primary[i1[inside]] = False
+
+    ans = np.empty_like(is_primary)
+    ans[order1] = is_primary
+    return ans
+
+
+def primary_selection(catalog, search_rad=0.5, pimax=None, period=None,
+                      cosmo=None):
+    """
+    Primary selection (see find_primaries) of every galaxy in `catalog`,
+    which can be passed to qpgf() as `precomputed_primary_selection`, so
+    that calls with the same isolation criteria only search for primaries
+    once. Primary status doesn't depend on mass limits or sSFR cuts.
+    """
+    if pimax is None:
+        cosmo = ms.bplcosmo if cosmo is None else cosmo
+        pimax = ms.util.vpmax2pimax(1000., catalog["redshift"], cosmo)
+    pos = ms.util.xyz_array(catalog)
+    mass = catalog["obs_sm"]
+    return find_primaries(pos, pos, search_rad, pimax, mass, mass,
+                          period=period)
 
 
 def qpgf_vs_cia(pos, mass, sfr, search_rad, search_min, pimax,
@@ -0,0 +1,625 @@
+import unittest
+from unittest import mock
+import functools
+import json
+import os
+import tempfile
+import types
+import numpy as np
+import pandas as pd
+from scipy.integrate import simps
+import halotools.utils as ht_utils
+import halotools.empirical_models as ht_empirical_models
+import halotools.sim_manager as ht_sim_manager
+
+import mocksurvey as ms
+
+
+def reference_cam_binned_z(m, z, prop, m2, z2, prop2, nwin=501, dz=0.05,
+                           min_counts_in_z2_bins=None, seed=None):
+    # cam_binned_z as it was, conditional abundance matching one
+    # redshift bin (selected by masks) at a time
+    if min_counts_in_z2_bins is None:
+        min_counts_in_z2_bins = nwin+1
+    zrange = z.min() - dz/20, z.max() + dz/20
+    nz = int((zrange[1] - zrange[0]) / dz)
+    if nz:
+        centroids = np.linspace(*zrange, nz+1)
+    else:
+        centroids = np.array([-0.5, 0.5])*dz + np.mean(zrange)
+
+    zmin, zmax = centroids.min(), centroids.max()
+    s2 = (zmin < z2) & (z2 < zmax)
+    m2, z2, prop2 = m2[s2], z2[s2], prop2[s2]
+    inds2 = ht_utils.fuzzy_digitize(z2, centroids, seed=seed,
+                                    min_counts=min_counts_in_z2_bins)
+    centroids, inds2 = ms.util.correction_for_empty_bins(centroids, inds2)
+    inds = ms.util.fuzzy_digitize_improved(z, centroids, seed=seed,
+                                           min_counts=0)
+
+    new_prop = np.full_like(prop, np.nan)
+    for i in range(len(centroids)):
+        s, s2 = inds == i, inds2 == i
+        if not s.sum():
+            continue
+        nwin1 = min([nwin, s2.sum()//2*2-1, s.sum()//2*2-1])
+        new_prop[s] = ht_empirical_models.conditional_abunmatch(
+            m[s], prop[s], m2[s2], prop2[s2], nwin1)
+    return new_prop
+
+
+class TestCAMBinnedZ(unittest.TestCase):
+    def test_matches_per_bin_loop(self):
+        rng = np.random.RandomState(0)
+        m, z = rng.uniform(9, 12, 3000), rng.uniform(0.5, 1.5, 3000)
+        prop = rng.normal(size=3000)
+        m2, z2 = rng.uniform(8, 12, 8000), rng.uniform(0.3, 2.0, 8000)
+        prop2 = rng.normal(size=8000) + m2
+        # No observed galaxies at the low redshift edge, or in the middle
+        # of the range, so those bins are empty and get dropped
+        keep = (z2 > 0.6) & ((z2 < 0.95) | (z2 > 1.1))
+        m2, z2, prop2 = m2[keep], z2[keep], prop2[keep]
+
+        no_noise = functools.partial(
+            ht_empirical_models.conditional_abunmatch,
+            add_subgrid_noise=False)
+        with mock.patch.object(ht_empirical_models,
+                               "conditional_abunmatch", no_noise):
+            for seed in [1, 2]:
+                for nwin in [11, 101]:
+                    expected = reference_cam_binned_z(
+                        m, z, prop, m2, z2, prop2, nwin=nwin, seed=seed)
+                    result = ms.climber.util.cam_binned_z(
+                        m, z, prop, m2, z2, prop2, nwin=nwin, seed=seed)
+                    assert np.allclose(result, expected, equal_nan=True), \
+                        f"seed={seed}, nwin={nwin}"
+
+
+class TestCheckpointedMemmap(unittest.TestCase):
+    def test_resume_only_when_requested_and_inputs_match(self):
+        checkpointed_memmap = ms.climber.util.checkpointed_memmap
+        with tempfile.TemporaryDirectory() as path:
+            base = os.path.join(path, "appmags")
+
+            def interrupted(key):
+                with self.assertRaises(KeyboardInterrupt):
+                    with checkpointed_memmap(base, (4, 2), 2,
+                                             key=key) as (out, done):
+                        out[:2], done[0] = 1.0, True
+                        raise KeyboardInterrupt
+
+            def progress(key, resume):
+                with checkpointed_memmap(base, (4, 2), 2, key=key,
+                                         resume=resume) as (out, done):
+                    return done.tolist(), out[:2].tolist()
+
+            interrupted("a")
+            # Not resumed without being asked to, or if the inputs changed
+            assert progress("a", resume=False)[0] == [False, False]
+            interrupted("a")
+            assert progress("b", resume=True)[0] == [False, False]
+            interrupted("a")
+            assert progress("a", resume=True) == ([True, False], [[1, 1]]*2)
+            # Nothing is left behind after a successful run
+            assert os.listdir(path) == []
+
+
+class TestCachedFile(unittest.TestCase):
+    def test_input_hash(self):
+        input_hash = ms.climber.util.input_hash
+        x = np.arange(6.0)
+        assert input_hash(x, 1, a=2) == input_hash(x.copy(), 1, a=2)
+        assert input_hash(x[::2]) == input_hash(np.array([0.0, 2, 4]))
+        # Same bytes, but a different dtype, shape, or keyword
+        assert input_hash(x) != input_hash(x.view(np.int64))
+        assert input_hash(x) != input_hash(x.reshape(2, 3))
+        assert input_hash(x, a=2) != input_hash(x, b=2)
+
+    def test_hit_miss_and_stale(self):
+        with tempfile.TemporaryDirectory() as path:
+            compute = mock.Mock(side_effect=lambda: np.arange(3))
+
+            def cached(key):
+                return ms.climber.util.cached_file(
+                    path, "cols.npy", key, compute, np.load,
+                    lambda x, filename: np.save(filename, x))
+
+            np.testing.assert_array_equal(cached("a" * 40), np.arange(3))
+            np.testing.assert_array_equal(cached("a" * 40), np.arange(3))
+            assert compute.call_count == 1
+            assert os.listdir(path) == [".cols-" + "a" * 20 + ".npy"]
+
+            # A new key replaces the stale file of the old one
+            cached("b" * 40)
+            assert compute.call_count == 2
+            assert os.listdir(path) == [".cols-" + "b" * 20 + ".npy"]
+
+            # An unreadable file is computed and written again
+            with open(os.path.join(path, os.listdir(path)[0]), "w") as f:
+                f.write("garbage")
+            np.testing.assert_array_equal(cached("b" * 40), np.arange(3))
+            assert compute.call_count == 3
+            cached("b" * 40)
+            assert compute.call_count == 3
+
+    def test_uvdata_cache_invalidation(self):
+        rng = np.random.default_rng(0)
+        with tempfile.TemporaryDirectory() as path:
+            catfile = os.path.join(path, "catalog.dat")
+            config = mock.Mock(FILES={"p": None})
+            config.get_path.return_value = path
+            config.get_filepath.return_value = catfile
+
+            def write_catalog(n):
+                with open(catfile, "w") as f:
+                    f.write("x" * n)
+                os.utime(catfile, ns=(n, n))
+                config.load.return_value = pd.DataFrame({
+                    "redshift": rng.random(n), "logm": rng.random(n) + 9,
+                    "sfr_uv": rng.random(n) + 0.1, "M_g": rng.random(n),
+                    "M_r": rng.random(n), "id": np.arange(n)})
+
+            def uvdata():
+                return ms.climber.climber.UVData(
+                    "uvista", photbands=["g", "r"], cache=True)
+
+            with mock.patch.object(ms.climber.climber.UVData, "config",
+                                   config):
+                write_catalog(10)
+                first = uvdata()
+                assert config.load.call_count == 1
+                np.testing.assert_array_equal(uvdata().z, first.z)
+                assert config.load.call_count == 1
+                assert uvdata().abs_mag.columns.tolist() == ["g", "r"]
+
+                # Changing the catalog invalidates the cache, and the
+                # stale cache file is replaced
+                write_catalog(12)
+                assert len(uvdata().z) == 12
+                assert config.load.call_count == 2
+                assert len(uvdata().z) == 12
+                assert config.load.call_count == 2
+                caches = [f for f in os.listdir(path) if f.startswith(".")]
+                assert len(caches) == 1
+
+
+class TestKDTree(unittest.TestCase):
+    def test_reused_in_memory_and_from_disk(self):
+        from scipy import spatial
+        kdtree = ms.climber.climber.kdtree
+        points = np.random.default_rng(0).random((1000, 3))
+        built = mock.Mock(side_effect=spatial.cKDTree)
+        with tempfile.TemporaryDirectory() as path, \
+                mock.patch.object(spatial, "cKDTree", built), \
+                mock.patch.dict(ms.climber.climber._kdtrees, clear=True):
+            tree = kdtree(points, directory=path)
+            assert kdtree(points.copy(), directory=path) is tree
+            assert built.call_count == 1
+
+            # A new process (with an empty in-memory cache) loads the
+            # pickled tree instead of building it again
+            ms.climber.climber._kdtrees.clear()
+            loaded = kdtree(points, directory=path)
+            assert built.call_count == 1
+            np.testing.assert_array_equal(
+                loaded.query(points[:10], k=3)[1],
+                tree.query(points[:10], k=3)[1])
+
+            # Different points get a new tree
+            kdtree(points[1:], directory=path)
+            assert built.call_count == 2
+
+
+def make_stacker(rng, nspec=20, nwave=500):
+    # SeanSpecStacker of smooth synthetic spectra, some with NaN edges
+    wave = np.geomspace(300, 1200, nwave)
+    centers = rng.uniform(300, 1200, (nspec, 3, 1))
+    specs = 1 + np.exp(-0.5 * ((wave - centers) / 150) ** 2).sum(axis=1)
+    specs[:5, :8] = np.nan
+    specs[5:10, -12:] = np.nan
+    ids = np.arange(nspec) * 7 + 3
+
+    stacker = ms.climber.climber.SeanSpecStacker.__new__(
+        ms.climber.climber.SeanSpecStacker)
+    stacker.wave = wave
+    stacker.resample = ms.climber.util.RedshiftResampler(wave)
+    stacker.get_specmap = lambda: specs.astype(np.float32)
+    stacker.specid_index = stacker.uvista_index = ms.util.id_index(ids)
+    stacker.isnan = np.zeros(nspec, dtype=bool)
+    stacker.uvista_z = rng.uniform(0.3, 1.0, nspec)
+    stacker.fill_library = False
+    return stacker, ids
+
+
+def make_integrator(wave, bands=((450, 650), (700, 900), (850, 1100))):
+    # OptimizedFilterIntegrator with box filters
+    integrator = ms.climber.kcorrect.OptimizedFilterIntegrator.__new__(
+        ms.climber.kcorrect.OptimizedFilterIntegrator)
+    integrator.filter_strings = [f"box{i}" for i in range(len(bands))]
+    integrator.weights = np.array([(lo < wave) & (wave < hi)
+                                   for lo, hi in bands], dtype=float)
+    integrator.denominators = integrator.weights.sum(axis=1) * 1e-3
+    integrator.selections = integrator.weights != 0
+    return integrator
+
+
+class TestRedshiftFluxTable(unittest.TestCase):
+    def test_matches_stacked_spectra(self):
+        util = ms.climber.util
+        rng = np.random.RandomState(0)
+        stacker, ids = make_stacker(rng)
+        integrator = make_integrator(stacker.wave)
+        z_grid = np.linspace(0.2, 1.2, 101)
+        specids = np.unique(ids)
+        table = util.redshift_flux_table(stacker, integrator, specids,
+                                         z_grid, max_nan=30)
+
+        def exact_appmags(nbr_id, masscorr, redshift):
+            # Integrating each galaxy's stacked spectrum
+            stacks = stacker.avg_spectrum(nbr_id, masscorr, redshift)
+            fix = np.abs(util.count_nan(stacks)) <= 30
+            stacks[fix] = util.fill_nan_spec(stacks[fix])
+            return integrator.appmags(stacks)
+
+        def table_appmags(nbr_id, masscorr, redshift):
+            lumcorr = masscorr * ms.util.redshift_rest_flux_correction(
+                from_z=stacker.id2redshift(nbr_id), to_z=redshift,
+                cosmo=ms.bplcosmo)
+            return integrator.magnitudes(util.interp_redshift_flux_table(
+                table, z_grid, np.searchsorted(specids, nbr_id), redshift,
+                lumcorr))
+
+        nbr_id = rng.choice(ids, 200)
+        masscorr = rng.uniform(0.5, 2, 200)
+        on_grid = z_grid[rng.randint(len(z_grid), size=200)]
+        between = rng.uniform(z_grid[0], z_grid[-1], 200)
+
+        expected = exact_appmags(nbr_id, masscorr, on_grid)
+        assert np.isnan(expected).any() and np.isfinite(expected).any()
+        assert np.allclose(table_appmags(nbr_id, masscorr, on_grid),
+                           expected, rtol=0, atol=1e-5, equal_nan=True)
+        expected = exact_appmags(nbr_id, masscorr, between)
+        result = table_appmags(nbr_id, masscorr, between)
+        finite = np.isfinite(expected) & np.isfinite(result)
+        assert finite.mean() > 0.5
+        assert np.allclose(result[finite], expected[finite],
+                           rtol=0, atol=1e-3)
+
+        with self.assertRaises(ValueError):
+            table_appmags(nbr_id[:1], masscorr[:1], np.array([1.5]))
+
+
+def write_lightcone_ascii(filename, rng, nrows=300, extra_line=""):
+    # Random rows of UniverseMachine lightcone ascii output
+    with open(filename, "w") as f:
+        f.write("#ra dec z ...\n#Random seed: 5\n")
+        for i in range(nrows):
+            values = rng.uniform(0, 1, 34)
+            values[[25, 28]] = 10 ** rng.uniform(7, 11, 2)
+            row = [f"{x:.6g}" for x in values]
+            row[5], row[7] = str(rng.randint(1e9)), str(rng.randint(-1, 1e9))
+            f.write(" ".join(row) + "\n")
+            if i == nrows // 2:
+                f.write(extra_line)
+
+
+class TestLoadAsciiData(unittest.TestCase):
+    def test_matches_tabular_ascii_reader(self):
+        util = ms.climber.util
+        rng = np.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "lightcone.dat")
+            write_lightcone_ascii(filename, rng)
+            expected = ht_sim_manager.tabular_ascii_reader.TabularAsciiReader(
+                filename, util.LIGHTCONE_ASCII_COLS,
+                row_cut_min_dict={"obs_sm": 8e8, "true_sm": 0}).read_ascii()
+            # Small chunks, so rows are split among several threads
+            data, header = util.load_ascii_data(
+                filename, chunksize=2000, nthreads=3, return_header=True)
+            assert 0 < len(data) < 300
+            assert data.dtype == expected.dtype
+            for name in expected.dtype.names:
+                assert np.array_equal(data[name], expected[name]), name
+            assert header["columns"] == ["ra", "dec", "z", "..."]
+            assert header["seed"] == 5 and header["complete"]
+            # The header is found even if it spans several blocks
+            assert util.read_ascii_header(filename, blocksize=7) == header
+
+            # Malformed rows raise instead of being misread
+            for line in ["1 2 3\n", "1 2 x" + " 4" * 31 + "\n"]:
+                write_lightcone_ascii(filename, rng, extra_line=line)
+                with self.assertRaises(ValueError):
+                    util.load_ascii_data(filename, chunksize=2000)
+
+            # A header that isn't followed by data yet is incomplete
+            with open(filename, "w") as f:
+                f.write("#ra dec z ...\n#Random se")
+            header = util.read_ascii_header(filename)
+            assert not header["complete"] and header["nbytes"] == 14
+
+
+class TestRedshiftResampler(unittest.TestCase):
+    def test_matches_np_interp(self):
+        rng = np.random.RandomState(0)
+        specs = rng.uniform(1, 2, (20, 3, 400)).astype(np.float32)
+        specs[:4, :, :5] = np.nan
+        from_z = rng.uniform(0.2, 1.5, (20, 3))
+        to_z = rng.uniform(0.2, 1.5, (20, 1))
+        from_z[:5] = to_z[:5]  # unshifted
+
+        # Pixel shifts on a log-uniform grid, np.interp on any other
+        for wave, is_loguniform in [
+                (np.geomspace(300, 1200, 400), True),
+                (np.sort(rng.uniform(300, 1200, 400)), False)]:
+            resample = ms.climber.util.RedshiftResampler(wave)
+            assert resample.is_loguniform == is_loguniform
+            result = resample(specs, from_z, to_z)
+            expected = [[np.interp(wave / (1 + z2), wave / (1 + z1), spec,
+                                   left=np.nan, right=np.nan)
+                         for spec, z1 in zip(specs_i, from_z_i)]
+                        for specs_i, from_z_i, z2 in zip(specs, from_z, to_z)]
+            assert result.shape == specs.shape
+            assert np.allclose(result, expected, rtol=1e-6, atol=0,
+                               equal_nan=True)
+
+
+def reference_appmag(wave_nm, fnu_njy, curve):
+    # appmag_nm_njy as it was, integrating with simps for every spectrum
+    kcorrect = ms.climber.kcorrect.kcorrect
+    nu = kcorrect.c_A / (wave_nm * 10.0)
+    transmission = kcorrect.rebinfilter(curve, nu)["transmission"]
+    selection = transmission != 0
+    transmission, nu = transmission[selection], nu[selection]
+    fnu = fnu_njy[..., selection] / 1e9
+    numerator = simps(fnu * transmission / nu, nu)
+    denominator = simps(3631.0 * transmission / nu, nu)
+    return -2.5 * np.log10(numerator / denominator)
+
+
+class TestFilterIntegrator(unittest.TestCase):
+    def test_matches_simps(self):
+        kcorrect = ms.climber.kcorrect.kcorrect
+        rng = np.random.RandomState(0)
+        wave = np.geomspace(300, 1200, 700)
+        curves = {}
+        for name, (lo, hi) in {"test_a": (400, 550), "test_b": (520, 801),
+                               "test_c": (900, 1100)}.items():
+            filter_wave = np.linspace(lo, hi, 57) * 10.0
+            curve = np.zeros(len(filter_wave), dtype=[
+                ("nu", float), ("transmission", float)])
+            curve["nu"] = kcorrect.c_A / filter_wave
+            curve["transmission"] = np.sin(np.linspace(0, np.pi, 57)) ** 2
+            curves[name] = curve
+
+        specs = rng.uniform(1e3, 1e4, (10, len(wave)))
+        specs[0, :20] = np.nan  # outside of every filter
+        specs[1, 400] = np.nan  # inside test_b
+        kcorrect._filter_weights.cache_clear()
+        self.addCleanup(kcorrect._filter_weights.cache_clear)
+        with mock.patch.object(kcorrect, "readfilter", curves.get):
+            integrator = kcorrect.OptimizedFilterIntegrator(
+                wave, list(curves))
+            result = integrator.appmags(specs)
+            for i, (name, curve) in enumerate(curves.items()):
+                expected = reference_appmag(wave, specs, curve)
+                assert np.allclose(result[:, i], expected, rtol=0,
+                                   atol=1e-10, equal_nan=True), name
+                assert np.allclose(integrator.appmag_nm_njy(specs, name),
+                                   expected, rtol=0, atol=1e-10,
+                                   equal_nan=True), name
+        assert np.isnan(result[1]).tolist() == [False, True, False]
+        assert np.isfinite(result[0]).all()
+        assert kcorrect._filter_weights.cache_info().currsize == 3
+
+
+def reference_best_color(nfinder, spec_id, ummask):
+    # best_color as it was, with every galaxy's neighbor colors at once
+    um_colors = -np.diff(nfinder.umdat.abs_mag[ummask])
+    nbr_colors = -np.diff(nfinder.uvdat.abs_mag.values[
+                              nfinder.id2idx_uvista(spec_id)])
+    best_neighbor = (np.abs(um_colors[:, None, :] - nbr_colors)
+                     ).sum(axis=2).argmin(axis=1)
+    return spec_id[np.arange(len(spec_id)), best_neighbor]
+
+
+class TestBestColor(unittest.TestCase):
+    def test_matches_all_at_once(self):
+        rng = np.random.RandomState(0)
+        stacker, ids = make_stacker(rng)
+        bands = ["u", "g", "r", "i", "z"]
+        nfinder = ms.climber.climber.NeighborSeanSpecFinder.__new__(
+            ms.climber.climber.NeighborSeanSpecFinder)
+        nfinder.stacker = stacker
+        nfinder.uvdat = types.SimpleNamespace(abs_mag=pd.DataFrame(
+            rng.normal(-20, 1, (len(ids), 5)), columns=bands))
+        nfinder.umdat = types.SimpleNamespace(
+            z=rng.uniform(0, 1, 500), abs_mag=pd.DataFrame(
+                rng.normal(-20, 1, (500, 5)), columns=bands))
+        ummask = rng.uniform(size=500) < 0.6
+        spec_id = rng.choice(ids, (ummask.sum(), 7))
+
+        expected = reference_best_color(nfinder, spec_id, ummask)
+        for max_mem_usage in [1, 10_000, int(1e8)]:
+            assert np.array_equal(nfinder.best_color(
+                spec_id, ummask, max_mem_usage=max_mem_usage), expected)
+
+
+def reference_fill_nan_spec(spec, window_len=1000):
+    # fill_nan_spec as it was, for one NaN run at one end of each row
+    spec = np.array(spec)
+    shape = spec.shape
+    isnan = np.isnan(spec)
+    last_on_left = np.where(np.diff(isnan, axis=-1))
+    assert np.all(np.arange(shape[0]) == last_on_left[0])
+    last_on_left = last_on_left[1]
+
+    window = np.arange(window_len)[None, :] + last_on_left[:, None]
+    window[isnan[:, 0], :] += 1
+    window[~isnan[:, 0], :] += 1 - window_len
+    window[window < 0] = 0
+    window[window >= shape[1]] = shape[1] - 1
+
+    fill = spec[np.arange(shape[0])[:, None], window].mean(axis=1)
+    fill = np.tile(fill[:, None], (1, spec.shape[1]))
+    spec[isnan] = fill[isnan]
+    return spec
+
+
+def loop_fill_nan_spec(spec, window_len):
+    # One row at a time: interpolate inside, window means at the ends
+    spec = np.array(spec)
+    for row in spec:
+        known = np.flatnonzero(~np.isnan(row))
+        if not len(known):
+            continue
+        first, last = known[0], known[-1]
+        inside = np.arange(first, last + 1)
+        row[inside] = np.interp(inside, known, row[known])
+        row[:first] = row[np.clip(first + np.arange(window_len),
+                                  first, last)].mean()
+        row[last + 1:] = row[np.clip(last - np.arange(window_len),
+                                     first, last)].mean()
+    return spec
+
+
+class TestFillNanSpec(unittest.TestCase):
+    def test_edge_runs_unchanged(self):
+        rng = np.random.RandomState(0)
+        spec = rng.uniform(1, 2, (30, 200))
+        for i, n in enumerate(rng.randint(1, 150, 30)):
+            if i % 2:
+                spec[i, :n] = np.nan
+            else:
+                spec[i, -n:] = np.nan
+        for window_len in [5, 100, 1000]:
+            expected = reference_fill_nan_spec(spec, window_len)
+            result = ms.climber.util.fill_nan_spec(spec, window_len)
+            assert np.allclose(result, expected, rtol=1e-12, atol=0)
+        assert np.array_equal(ms.climber.util.count_nan(spec), np.where(
+            np.isnan(spec[:, 0]), np.isnan(spec).sum(axis=1),
+            -np.isnan(spec).sum(axis=1)))
+
+    def test_interior_and_edge_runs(self):
+        rng = np.random.RandomState(1)
+        spec = rng.uniform(1, 2, (40, 200))
+        for row in spec[:35]:
+            for _ in range(rng.randint(4)):
+                start = rng.randint(200)
+                row[start:start + rng.randint(1, 30)] = np.nan
+        spec[35] = np.nan  # all NaN, left as is
+        spec[36, :3] = spec[36, -4:] = spec[36, 100:110] = np.nan
+
+        for window_len in [1, 7, 1000]:
+            expected = loop_fill_nan_spec(spec, window_len)
+            result = ms.climber.util.fill_nan_spec(spec, window_len)
+            assert np.allclose(result, expected, rtol=1e-12, atol=0,
+                               equal_nan=True)
+            assert np.isnan(result).sum() == 200
+            # A single spectrum, filled in place
+            single = spec[36].copy()
+            ms.climber.util.fill_nan_spec(single, window_len, inplace=True)
+            assert np.allclose(single, expected[36], rtol=1e-12, atol=0)
+
+
+class TestLog16Specmap(unittest.TestCase):
+    def test_round_trip(self):
+        Log16Specmap = ms.climber.util.Log16Specmap
+        rng = np.random.RandomState(0)
+        specs = 10 ** rng.uniform(-3, 7, (12, 300))
+        specs[0, :10] = np.nan
+        specs[1, 20:25] = 0
+        specs[2] = 0
+        specs[3] = np.nan
+        specs[4] = 5.0
+
+        codes, scales = Log16Specmap.encode(specs)
+        decoded = Log16Specmap.decode(codes, scales)
+        # Relative error bound of the class docstring (+ float32 rounding)
+        span = np.log(np.nanmax(np.where(specs > 0, specs, np.nan), axis=1)
+                      / np.nanmin(np.where(specs > 0, specs, np.nan),
+                                  axis=1))
+        bound = np.nan_to_num(span) / 131064 + 1e-7
+        positive = specs > 0
+        relerr = np.abs(decoded / specs - 1)
+        assert np.all(relerr[positive] <= np.broadcast_to(
+            bound[:, None], specs.shape)[positive])
+        assert np.array_equal(np.isnan(decoded), np.isnan(specs))
+        assert np.all(decoded[specs == 0] == 0)
+
+        # A single spectrum encodes the same as its row
+        for i in range(5):
+            codes1, scales1 = Log16Specmap.encode(specs[i])
+            assert np.array_equal(codes1, codes[i])
+            assert np.array_equal(scales1, scales[i])
+
+        with tempfile.TemporaryDirectory() as path:
+            datafile = os.path.join(path, "lightcone_0.npy")
+            with open(os.path.join(path, "lightcone_0.json"), "w") as f:
+                json.dump({"Ngal": 12, "Nwave": 300,
+                           "spec_format": "log16"}, f)
+            specmap = ms.climber.util.open_specmap(
+                os.path.join(path, "lightcone_0.spec"), specs.shape,
+                spec_format="log16", mode="w+")
+            specmap[:6] = specs[:6]
+            for i in range(6, 12):
+                specmap[i] = specs[i]
+            specmap.flush()
+            del specmap
+
+            config = ms.LightConeConfig.__new__(ms.LightConeConfig)
+            dict.__init__(config, data_dir=path, files=[
+                os.path.basename(datafile)])
+            specmap = config.load_specmap(0)
+            assert isinstance(specmap, Log16Specmap)
+            assert specmap.shape == specs.shape
+            assert np.array_equal(specmap[:], decoded, equal_nan=True)
+            assert np.array_equal(specmap[7], decoded[7], equal_nan=True)
+            assert np.array_equal(specmap[2:5, 10:20], decoded[2:5, 10:20],
+                                  equal_nan=True)
+
+
+
+class TestSparseSpecmap(unittest.TestCase):
+    def test_same_as_dense(self):
+        from astropy.cosmology import Planck15
+        rng = np.random.RandomState(0)
+        stacker, ids = make_stacker(rng)
+        library = stacker.get_specmap()
+        filled = ms.climber.util.fill_nan_spec(library)
+        nfinder = ms.climber.climber.NeighborSeanSpecFinder.__new__(
+            ms.climber.climber.NeighborSeanSpecFinder)
+        nfinder.stacker = stacker
+        nfinder.umdat = types.SimpleNamespace(z=rng.uniform(0.2, 1.5, 15))
+        neighbor_id = rng.choice(ids, (15, 3))
+        sean = mock.Mock(wavelength=lambda: stacker.wave,
+                         specmap=lambda: lambda: library,
+                         filled_specmap=lambda: lambda: filled)
+
+        with tempfile.TemporaryDirectory() as path, mock.patch.object(
+                ms.mocksurvey, "SeanSpectraConfig", return_value=sean):
+            for fill_library in [False, True]:
+                stacker.fill_library = fill_library
+                stacker.get_specmap = lambda: filled if fill_library \
+                    else library
+                for spec_format in ["f4", "sparse"]:
+                    nfinder.write_specmap(
+                        os.path.join(path, f"{spec_format}.spec"),
+                        neighbor_id, cosmo=Planck15, corr=None,
+                        progress=False, spec_format=spec_format)
+
+                shape = (15, len(stacker.wave))
+                dense = ms.climber.util.open_specmap(
+                    os.path.join(path, "f4.spec"), shape)
+                sparse = ms.climber.util.open_specmap(
+                    os.path.join(path, "sparse.spec"), shape, "sparse")
+                assert isinstance(sparse, ms.climber.util.SparseSpecmap)
+                assert sparse.cosmo == Planck15
+                assert sparse.fill_library == fill_library
+                assert sparse.shape == shape
+                np.testing.assert_allclose(sparse[:], dense, rtol=1e-6)
+                np.testing.assert_allclose(sparse[4], dense[4], rtol=1e-6)
+                np.testing.assert_allclose(sparse[2:5, 10:20],
+                                           dense[2:5, 10:20], rtol=1e-6)
+
+if __name__ == "__main__":
+    unittest.main()
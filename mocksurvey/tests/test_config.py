@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+import astropy.table as astropy_table
+
+import mocksurvey as ms
+
+
+class TestConfigRegistry(unittest.TestCase):
+    def test_registry(self):
+        with tempfile.TemporaryDirectory() as path:
+            configdir = os.path.join(path, "config")
+            os.mkdir(configdir)
+            with open(os.path.join(configdir, "config-um.json"), "w") as f:
+                json.dump({"data_dir": path, "files": []}, f)
+            registry = ms.ConfigRegistry(
+                os.path.join(configdir, "registry.sqlite"))
+
+            # Old json configs are imported once, and then set aside
+            assert registry.get("config-um.json")["data_dir"] == path
+            assert sorted(os.listdir(configdir)) == [
+                "config-um.json.imported", "registry.sqlite"]
+            with open(os.path.join(configdir, "config-um.json"), "w") as f:
+                json.dump({"data_dir": "stale", "files": []}, f)
+            assert ms.ConfigRegistry(os.path.join(
+                configdir, "registry.sqlite")).get(
+                "config-um.json")["data_dir"] == path
+            registry.put("config-lightcone-&&a.json", {"data_dir": "a"})
+            assert list(registry.configs("config-lightcone-")) == [
+                "config-lightcone-&&a.json"]
+            registry.delete("config-lightcone-&&a.json")
+            assert registry.get("config-lightcone-&&a.json") is None
+
+            datadir = os.path.join(path, "data")
+            os.mkdir(datadir)
+            for name in ["file10", "file2", "file1"]:
+                open(os.path.join(datadir, name), "w").close()
+            os.utime(datadir, ns=(0, 0))
+            assert registry.listdir(datadir) == ["file1", "file2", "file10"]
+
+            # The stored listing is used while the directory's mtime is
+            # unchanged (which is faked here), and updated once it changes
+            os.remove(os.path.join(datadir, "file2"))
+            os.utime(datadir, ns=(0, 0))
+            assert registry.listdir(datadir) == ["file1", "file2", "file10"]
+            os.utime(datadir, ns=(0, 1))
+            assert registry.listdir(datadir) == ["file1", "file10"]
+
+    def test_default_path(self):
+        with tempfile.TemporaryDirectory() as path:
+            configdir = os.path.join(path, "config")
+            with mock.patch.object(ms.util, "config_file_directory",
+                                   lambda: configdir):
+                assert ms.mocksurvey.default_registry_path() == os.path.join(
+                    configdir, "registry.sqlite")
+                # Read-only installs keep the registry in the home directory
+                with mock.patch.object(os, "access", lambda *args: False), \
+                        mock.patch.object(ms.mocksurvey.pathlib.Path,
+                                          "home", lambda: path):
+                    assert ms.mocksurvey.default_registry_path() == \
+                        os.path.join(path, ".mocksurvey", "registry.sqlite")
+            assert not os.path.exists(configdir)
+
+
+class TestSeanSpectraTableCache(unittest.TestCase):
+    def test_cached_load_matches_fits(self):
+        with tempfile.TemporaryDirectory() as path:
+            table = astropy_table.Table()
+            table["id"] = np.arange(5)
+            table["name"] = np.array([b"a", b"bb", b"c", b"dd", b"e"])
+            table["redshift"] = astropy_table.MaskedColumn(
+                np.linspace(0, 1, 5), mask=[0, 1, 0, 0, 0])
+            table["lmass"] = np.linspace(9, 11, 5).astype(">f4")
+            table["flux"] = np.ones((5, 3))
+            for i, name in enumerate(ms.SeanSpectraConfig.names_to_keep()):
+                if name not in table.colnames:
+                    table[name] = np.arange(5) * (i + 0.5)
+            fitsfile = os.path.join(path, "cosmos_V17.fits")
+            table.write(fitsfile)
+
+            config = ms.SeanSpectraConfig.__new__(ms.SeanSpectraConfig)
+            with mock.patch.object(
+                    ms.SeanSpectraConfig, "get_path",
+                    lambda self, filename="": os.path.join(path, filename)):
+                with mock.patch.object(
+                        ms.SeanSpectraConfig, "get_filepath",
+                        lambda self, index=0: fitsfile):
+                    cached = config.load_table()
+                    assert cached.dtype.names == tuple(table.colnames)
+                    assert np.array_equal(cached["flux"], table["flux"])
+                    assert np.isnan(cached["redshift"][1])
+
+                    # Both loads fail on the multidimensional column
+                    with self.assertRaises(ValueError):
+                        config.load(cache=False)
+                    with self.assertRaises(ValueError):
+                        config.load(cache=True)
+                    table.remove_column("flux")
+                    os.remove(fitsfile)
+                    table.write(fitsfile)
+                    os.utime(fitsfile, ns=(0, 2**62))
+                    pd.testing.assert_frame_equal(config.load(cache=True),
+                                                  config.load(cache=False))
+                    pd.testing.assert_frame_equal(
+                        config.load(keep_all_columns=False, cache=True),
+                        config.load(keep_all_columns=False, cache=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import unittest
+import os
+import io
+import tarfile
+import types
+from unittest import mock
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import mocksurvey as ms
+
+
+class FlakyRangeHandler(BaseHTTPRequestHandler):
+    """Serves `data`, supporting Range requests, but drops the first
+    connection for each path halfway through"""
+    data = os.urandom(300_000)
+    dropped = set()
+
+    def do_GET(self):
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-"
+                             f"{len(self.data) - 1}/{len(self.data)}")
+        else:
+            self.send_response(200)
+        body = self.data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.path not in self.dropped:
+            self.dropped.add(self.path)
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+    def test_resume_concurrent_downloads(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyRangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+        size = len(FlakyRangeHandler.data)
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                files = [os.path.join(path, f"file{i}") for i in range(3)]
+                ms.util.download_files(
+                    [lambda i=i: ms.util.download_file(
+                        f"{url}/{i}", files[i], size=size, progress=False)
+                     for i in range(3)], max_workers=2, progress=False)
+                for filename in files:
+                    with open(filename, "rb") as f:
+                        assert f.read() == FlakyRangeHandler.data
+
+                with self.assertRaises(IOError):
+                    ms.util.download_file(f"{url}/0", files[0] + "x",
+                                          size=size + 1, progress=False)
+                # A short download is kept to be resumed later
+                assert os.path.getsize(files[0] + "x.part") == size
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_verify_downloads(self):
+        with tempfile.TemporaryDirectory() as path:
+            names = ["a.bin", "b.bin", "c.bin", "d.bin"]
+            for name in names:
+                with open(os.path.join(path, name), "wb") as f:
+                    f.write(os.urandom(4_000_000))
+            ms.util.record_downloads(path, names[:3], "test")
+
+            # Truncate, corrupt, and delete recorded files
+            os.truncate(os.path.join(path, "a.bin"), 3_000_000)
+            with open(os.path.join(path, "b.bin"), "r+b") as f:
+                f.write(b"corrupted")
+            os.remove(os.path.join(path, "c.bin"))
+            sizes = [None, None, None, 4_000_000]
+            assert ms.util.verify_downloads(path, names, sizes) == [
+                "a.bin", "b.bin", "c.bin"]
+
+            # d.bin is now recorded, so corruption the sampled checksums
+            # miss is still caught by the full checksum
+            with open(os.path.join(path, "d.bin"), "r+b") as f:
+                f.seek(150_000)
+                f.write(b"corrupted")
+            assert ms.util.verify_downloads(path, ["d.bin"]) == []
+            assert ms.util.verify_downloads(path, ["d.bin"],
+                                            full=True) == ["d.bin"]
+
+    def test_verify_upgrade_without_manifest(self):
+        with tempfile.TemporaryDirectory() as path:
+            # Files downloaded before there was a manifest, including a
+            # directory of files, like PYOBS, with no size to check
+            os.makedirs(os.path.join(path, "PYOBS", "sub"))
+            for name in ["a.par", os.path.join("sub", "b.par")]:
+                with open(os.path.join(path, "PYOBS", name), "wb") as f:
+                    f.write(os.urandom(1000))
+            with open(os.path.join(path, "e.bin"), "wb") as f:
+                f.write(os.urandom(1000))
+
+            names = ["PYOBS", "e.bin"]
+            with self.assertWarns(UserWarning):
+                assert ms.util.verify_downloads(path, names) == []
+            assert sorted(ms.util.load_download_manifest(path)) == names
+
+            # ...and from then on, they are checked against the manifest
+            os.remove(os.path.join(path, "PYOBS", "sub", "b.par"))
+            assert ms.util.verify_downloads(path, names) == ["PYOBS"]
+
+    def test_verify_partial_and_extracted(self):
+        with tempfile.TemporaryDirectory() as path:
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+                for name in ["./PYOBS/a.par", "./PYOBS/sub/b.par"]:
+                    info = tarfile.TarInfo(name)
+                    info.size = 1000
+                    tar.addfile(info, io.BytesIO(os.urandom(1000)))
+
+            # An interrupted download isn't trusted, despite no manifest
+            ms.util.begin_downloads(path, ["PYOBS"])
+            os.makedirs(os.path.join(path, "PYOBS"))
+            assert ms.util.verify_downloads(path, ["PYOBS"]) == ["PYOBS"]
+
+            buffer.seek(0)
+            with tarfile.open(fileobj=buffer, mode="r|gz") as tar:
+                members = ms.util.extract_tar(tar, path)
+            assert members == {os.path.join("PYOBS", "a.par"): 1000,
+                               os.path.join("PYOBS", "sub", "b.par"): 1000}
+            ms.util.record_downloads(path, ["PYOBS"], "test", members)
+            assert ms.util.verify_downloads(path, ["PYOBS"]) == []
+
+            os.remove(os.path.join(path, "PYOBS", "sub", "b.par"))
+            assert not ms.util._has_members(path, members)
+            assert ms.util.verify_downloads(path, ["PYOBS"]) == ["PYOBS"]
+
+
+class TestExtractTar(unittest.TestCase):
+    @staticmethod
+    def make_tar(*members):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            for name, linkname in members:
+                info = tarfile.TarInfo(name)
+                if linkname is None:
+                    info.size = 4
+                    tar.addfile(info, io.BytesIO(b"data"))
+                else:
+                    info.type, info.linkname = tarfile.SYMTYPE, linkname
+                    tar.addfile(info)
+        return buffer.getvalue()
+
+    def test_refuses_members_outside(self):
+        good = self.make_tar(("dir/file", None), ("dir/link", "file"))
+        bad = [self.make_tar(("dir/file", None), ("../escaped", None)),
+               self.make_tar(("dir/link", "../../outside")),
+               self.make_tar(("dir/link", "/etc/passwd"))]
+        no_filter = types.SimpleNamespace(TarError=tarfile.TarError)
+
+        # With tarfile's data filter and, without it, our own checks
+        for patch in [mock.patch.object(ms.util, "tarfile", tarfile),
+                      mock.patch.object(ms.util, "tarfile", no_filter)]:
+            with patch, tempfile.TemporaryDirectory() as path:
+                dest = os.path.join(path, "dest")
+                with tarfile.open(fileobj=io.BytesIO(good),
+                                  mode="r|*") as tar:
+                    ms.util.extract_tar(tar, dest)
+                with open(os.path.join(dest, "dir", "link")) as f:
+                    assert f.read() == "data"
+                for data in bad:
+                    with tarfile.open(fileobj=io.BytesIO(data),
+                                      mode="r|*") as tar:
+                        with self.assertRaises(tarfile.TarError):
+                            ms.util.extract_tar(tar, dest)
+                assert os.listdir(path) == ["dest"]
+
+                # Absolute names are either refused or kept inside dest
+                absolute = os.path.join(path, "absolute")
+                with tarfile.open(fileobj=io.BytesIO(self.make_tar(
+                        (absolute, None))), mode="r|*") as tar:
+                    try:
+                        ms.util.extract_tar(tar, dest)
+                    except tarfile.TarError:
+                        pass
+                assert not os.path.exists(absolute)
+
+
+if __name__ == "__main__":
+    unittest.main()
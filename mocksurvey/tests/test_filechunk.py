@@ -0,0 +1,77 @@
+import unittest
+import os
+import tarfile
+import tempfile
+import numpy as np
+
+from mocksurvey import filechunk
+
+
+class TestFileChunk(unittest.TestCase):
+    def test_split_and_join(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "data.bin")
+            data = np.random.RandomState(0).bytes(100_003)
+            with open(filename, "wb") as f:
+                f.write(data)
+
+            filechunk.splitchunks_by_num(filename, 4, mem_usage=1000)
+            os.remove(filename)
+            assert len(filechunk.get_chunknames(filename)) == 4
+            filechunk.joinchunks(filename, mem_usage=1000)
+            with open(filename, "rb") as f:
+                assert f.read() == data
+
+            # Resume a join after a chunk was removed, and a region of
+            # the output was corrupted
+            os.remove(filechunk.get_chunkname(filename, 0))
+            with open(filename, "r+b") as f:
+                f.seek(60_000)
+                f.write(b"corrupted")
+            filechunk.joinchunks(filename, rmchunks=True)
+            with open(filename, "rb") as f:
+                assert f.read() == data
+            assert os.listdir(path) == ["data.bin"]
+
+    def test_corrupted_chunk(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, "data.bin")
+            with open(filename, "wb") as f:
+                f.write(bytes(range(256)) * 100)
+
+            filechunk.splitchunks_by_size(filename, 10_000)
+            os.remove(filename)
+            with open(filechunk.get_chunkname(filename, 1), "r+b") as f:
+                f.write(b"corrupted")
+            with self.assertRaises(ValueError):
+                filechunk.joinchunks(filename)
+
+    def test_stream_tar_from_chunks(self):
+        with tempfile.TemporaryDirectory() as path:
+            member = os.path.join(path, "member.bin")
+            data = np.random.RandomState(1).bytes(50_000)
+            with open(member, "wb") as f:
+                f.write(data)
+            tarf = os.path.join(path, "data.tar.gz")
+            with tarfile.open(tarf, "w:gz") as tar:
+                tar.add(member, arcname="member.bin")
+            os.remove(member)
+
+            filechunk.splitchunks_by_size(tarf, 5_000)
+            os.remove(tarf)
+            chunknames = filechunk.get_chunknames(tarf)
+            waited = []
+            with filechunk.ChunkReader(chunknames, wait=waited.append,
+                                       rmchunks=True) as f:
+                with tarfile.open(fileobj=f, mode="r|*") as tar:
+                    tar.extractall(path=path)
+                f.read()
+
+            assert waited == list(range(len(chunknames)))
+            assert not filechunk.get_chunknames(tarf)
+            with open(member, "rb") as f:
+                assert f.read() == data
+
+
+if __name__ == "__main__":
+    unittest.main()
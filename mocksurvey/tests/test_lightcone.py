@@ -57,6 +57,26 @@ class TestLightCone(unittest.TestCase):
                     f"{key} column not as expected"
 
 
+class TestAsciiHeader(unittest.TestCase):
+    def test_metadict_from_header(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        test_dat_fn = os.path.join(path, "test_lightcone_0.dat")
+        test_json_fn = os.path.join(path, "test_lightcone_0.json")
+
+        header = ms.climber.util.read_ascii_header(test_dat_fn, blocksize=64)
+        meta = ms.climber.util.metadict_from_header(header)
+        with open(test_json_fn) as f:
+            j_test = json.load(f)
+
+        assert header["complete"]
+        with open(test_dat_fn, "rb") as f:
+            f.seek(header["nbytes"])
+            assert not f.readline().startswith(b"#")
+        for key in meta:
+            if key != "cmd":  # the temporary ascii filename differs
+                assert meta[key] == j_test[key], f"{key} not as expected"
+
+
 class TestSelector(unittest.TestCase):
     def test_fullsky_and_square(self):
         testdata = ms.util.make_struc_array(["redshift", "ra", "dec"],
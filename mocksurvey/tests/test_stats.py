@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+
+import mocksurvey as ms
+
+
+class TestFindPrimaries(unittest.TestCase):
+    def test_matches_counts_in_cylinders(self):
+        rng = np.random.RandomState(42)
+        pos = rng.uniform(0, 50, (3000, 3))
+        mass = 10 ** rng.uniform(9, 12, 3000)
+        search_rad = rng.uniform(0.5, 2.0, 3000)
+
+        for period in [None, 50.0]:
+            n_larger = ms.stats.stats._nic(
+                pos, pos, search_rad, 4.0, mass, mass,
+                mass_ratio_lims=[1, np.inf], period=period,
+                inclusive_bounds=[False, True])
+            is_primary = ms.stats.stats.find_primaries(
+                pos, pos, search_rad, 4.0, mass, mass, period=period,
+                max_pairs=1000)
+            assert np.all(is_primary == (n_larger == 0)), \
+                f"primaries differ from counts_in_cylinders (period={period})"
+
+
+class TestPrimarySelection(unittest.TestCase):
+    def test_precomputed_qpgf(self):
+        rng = np.random.RandomState(0)
+        catalog = {"x": rng.uniform(0, 300, 4000),
+                   "y": rng.uniform(0, 300, 4000),
+                   "z": rng.uniform(0, 300, 4000),
+                   "obs_sm": 10 ** rng.uniform(9.5, 11.5, 4000),
+                   "redshift": rng.uniform(0.5, 0.6, 4000)}
+        catalog["obs_sfr"] = catalog["obs_sm"] * 10 ** rng.uniform(
+            -12, -10, 4000)
+
+        primaries = ms.stats.stats.primary_selection(catalog)
+        assert 0 < primaries.sum() < 4000
+        for lims in [None, [10 ** 10.5, 10 ** 11]]:
+            expected = ms.stats.stats.qpgf(catalog, None,
+                                           primary_mass_lims=lims)
+            result = ms.stats.stats.qpgf(
+                catalog, None, primary_mass_lims=lims,
+                precomputed_primary_selection=primaries)
+            for x, y in zip(result, expected):
+                assert np.allclose(x, y, equal_nan=True)
+            assert np.isfinite(expected[1]).any()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,20 @@
 import sys
 import os
+import json
+import time
+import hashlib
+import threading
 import shutil
+import tarfile
 import collections
 import warnings
 from contextlib import contextmanager
 from typing import Union, Iterable, Sized, Generator, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import wget
 import requests
+import urllib3
 import tqdm
 import numpy as np
 import scipy.special as spec
@@ -363,6 +370,56 @@ def is_int(a):
     return np.asarray(a).dtype.kind == "i"
 
 
+def id_index(ids):
+    """
+    Lookup table from each unique ID in `ids` to its position, to be
+    searched by lookup_id_index()
+    """
+    ids = np.asarray(ids)
+    order = np.argsort(ids, kind="stable")
+    index = np.empty(len(ids), dtype=[("id", ids.dtype), ("row", "<i8")])
+    index["id"], index["row"] = ids[order], order
+    return index
+
+
+def lookup_id_index(index, ids):
+    """
+    Positions (in the array passed to id_index) of each of `ids`, which
+    may be of any shape. Raises KeyError if any ID is not in the index
+    """
+    ids = np.asarray(ids)
+    pos = np.searchsorted(index["id"], ids)
+    found = pos < len(index)
+    found[found] &= index["id"][pos[found]] == ids[found]
+    if not found.all():
+        raise KeyError(f"IDs not found: {ids[~found][:10]}")
+    return index["row"][pos]
+
+
+def is_stale(filename, *sources):
+    """
+    True if `filename` doesn't exist or is older than any `sources`
+    """
+    if not os.path.isfile(filename):
+        return True
+    mtime = os.path.getmtime(filename)
+    return any(os.path.getmtime(f) > mtime for f in sources)
+
+
+def save_npy(filename, arr):
+    """
+    np.save, but written to a temporary file first and then renamed
+    so that a partially written file can never be loaded
+    """
+    tmp = f"{filename}.tmp{os.getpid()}.npy"
+    try:
+        np.save(tmp, arr)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
 def angular_separation(ra1, dec1, ra2=0, dec2=0):
     """All angles (ra1, dec1, ra2=0, dec2=0) must be given in radians"""
     cos_theta = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2)
@@ -515,6 +572,46 @@ def comoving_disth(redshifts, cosmo):
             if is_arraylike(dist) else dist)
 
 
+def comoving_disth_interp(redshifts, cosmo, zprec=1e-3):
+    """
+    Same as comoving_disth, but interpolated from a table of distances
+    on a redshift grid of spacing `zprec` (relative error ~1e-7), which
+    is only computed once per cosmology
+    """
+    return _interp_distance(redshifts, cosmo, "comoving_distance",
+                            zprec) * cosmo.h
+
+
+def luminosity_disth_interp(redshifts, cosmo, zprec=1e-3):
+    """
+    h-scaled luminosity distance (Mpc/h), interpolated from a table of
+    distances on a redshift grid of spacing `zprec` (relative error
+    ~1e-7), which is only computed once per cosmology
+    """
+    return _interp_distance(redshifts, cosmo, "luminosity_distance",
+                            zprec) * cosmo.h
+
+
+def _interp_distance(redshifts, cosmo, method, zprec):
+    # Interpolate distance/redshift, which is smooth and finite at z=0
+    z = np.asarray(redshifts, dtype=np.float64)
+    zmax = max(1.0, float(np.ceil(np.max(z, initial=0))))
+    key = (repr(cosmo), method, zprec)
+    if key not in _distance_tables or _distance_tables[key][0][-1] < zmax:
+        grid = np.linspace(0, zmax, int(round(zmax / zprec)) + 1)
+        dist = getattr(cosmo, method)(grid).value
+        ratio = np.empty_like(dist)
+        ratio[1:] = dist[1:] / grid[1:]
+        ratio[0] = c.to("km/s").value / cosmo.H0.value
+        _distance_tables[key] = grid, ratio
+
+    grid, ratio = _distance_tables[key]
+    return np.interp(z, grid, ratio) * z
+
+
+_distance_tables = {}
+
+
 def distance2redshift(dist, cosmo, vr=None, zprec=1e-3, h_scaled=True):
     c_km_s = c.to('km/s').value
     dist_units = units.Mpc / cosmo.h if h_scaled else units.Mpc
@@ -1043,25 +1140,22 @@ def download_file_from_google_drive(fileid, destination, progress=True,
         None
 
     """
-    if not overwrite and os.path.isfile(destination):
+    if not overwrite and is_downloaded(destination, size):
         return
     if progress:
         print(f"Downloading file to {destination}...")
     url = "https://docs.google.com/uc?export=download"
 
     with requests.Session() as session:
-        response = session.get(url, params={"id": fileid}, stream=True)
-        token = _get_confirm_token(response)
-
+        params = {"id": fileid}
+        with session.get(url, params=params, stream=True) as response:
+            token = _get_confirm_token(response)
         if token:
-            params = {"id": fileid, "confirm": token}
-            response = session.get(url, params=params, stream=True)
+            params["confirm"] = token
 
-    try:
-        _save_response_content(response, destination, progress=progress, size=size)
-    except:
-        os.remove(destination)
-        raise
+        download_file(url, destination, params=params, size=size,
+                      progress=progress, overwrite=overwrite,
+                      session=session)
     _check_for_google_drive_error(destination, html_ok=html_ok)
 
 
@@ -1073,22 +1167,348 @@ def _get_confirm_token(response):
     return None
 
 
-def _save_response_content(response, destination, progress=True, size=None):
-    chunk_size = 32768
+def download_file(url, destination, params=None, size=None, progress=True,
+                  overwrite=False, session=None, retries=5, timeout=60,
+                  min_chunk_size=2**16, max_chunk_size=2**24):
+    """
+    Download `url` to `destination`, by way of a `.part` file. If the
+    transfer is interrupted, it is continued from the end of the `.part`
+    file with an HTTP Range request (here after up to `retries` failed
+    attempts in a row, or the next time this is called).
 
-    if size is None:
-        size_in_bytes = int(response.headers.get('content-length', 0))
-    else:
-        size_in_bytes = size
-    prog_bar = tqdm.tqdm(total=size_in_bytes, unit='iB',
-                         unit_scale=True, disable=not progress)
-    with open(destination, "wb") as f:
-        for chunk in response.iter_content(chunk_size):
-            if chunk:  # filter out keep-alive new chunks
-                prog_bar.update(len(chunk))
-                f.write(chunk)
+    Parameters
+    ----------
+    url : str
+        Where to download the file from
+    destination : str
+        Where to place the file and what to name it
+    params : dict | None
+        Query parameters for the request
+    size : int | None
+        Expected size of the file in bytes. If given, a download of any
+        other size is an error, and an existing `destination` of a
+        different size is downloaded again
+    progress : bool
+        If true (default), display progress bar during download
+    overwrite : bool
+        If true, download the file again, even if it already exists
+    session : requests.Session | None
+        Session to make the requests in (e.g., to keep its cookies)
+    retries : int
+        Number of times to reconnect after a failed request
+    timeout : float
+        Seconds to wait for the server to respond
+    min_chunk_size, max_chunk_size : int
+        Bytes read from the connection at a time. Starting from the
+        minimum, this doubles whenever a read is fast (<0.25 s) and halves
+        whenever a read is slow (>1 s)
+
+    Returns
+    -------
+        None
+    """
+    if not overwrite and is_downloaded(destination, size):
+        return
+    partfile = destination + ".part"
+    if overwrite and os.path.isfile(partfile):
+        os.remove(partfile)
+
+    if session is None:
+        with requests.Session() as session:
+            return download_file(url, destination, params, size, progress,
+                                 overwrite, session, retries, timeout,
+                                 min_chunk_size, max_chunk_size)
+
+    prog_bar = tqdm.tqdm(total=size, unit='iB', unit_scale=True,
+                         disable=not progress)
+    failures, last_start = 0, -1
+    while True:
+        start = os.path.getsize(partfile) if os.path.isfile(partfile) else 0
+        if size is not None and start >= size:
+            break
+        if start > last_start:
+            failures, last_start = 0, start  # Only count failures in a row
+        headers = {"Range": f"bytes={start}-"} if start else {}
+        try:
+            with session.get(url, params=params, headers=headers,
+                             stream=True, timeout=timeout) as response:
+                if response.status_code == 416 and size is None:
+                    break  # The .part file is already complete
+                response.raise_for_status()
+                if response.status_code != 206:
+                    start = 0  # The server doesn't support Range requests
+                if prog_bar.total is None:
+                    length = response.headers.get("content-length")
+                    prog_bar.total = length and start + int(length)
+                prog_bar.reset(prog_bar.total)
+                prog_bar.update(start)
+
+                with open(partfile, "ab" if start else "wb") as f:
+                    chunk_size = min_chunk_size
+                    while True:
+                        t = time.time()
+                        chunk = response.raw.read(chunk_size,
+                                                  decode_content=True)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        prog_bar.update(len(chunk))
+                        t = time.time() - t
+                        if t < 0.25:
+                            chunk_size = min(chunk_size * 2, max_chunk_size)
+                        elif t > 1:
+                            chunk_size = max(chunk_size // 2, min_chunk_size)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.HTTPError):
+            if failures >= retries:
+                prog_bar.close()
+                raise
+        else:
+            if size is None or os.path.getsize(partfile) >= size:
+                break
+            if failures >= retries:
+                break  # Still short, which is raised below
+        failures += 1
     prog_bar.close()
 
+    nbytes = os.path.getsize(partfile)
+    if size is not None and nbytes != size:
+        if nbytes > size:
+            os.remove(partfile)
+        raise IOError(f"Downloaded {nbytes} bytes of {url} "
+                      f"but expected {size} bytes")
+    os.replace(partfile, destination)
+
+
+def download_files(downloads, max_workers=4, progress=True):
+    """
+    Run downloads (functions with no arguments, such as partial
+    instances of download_file) concurrently on `max_workers` threads.
+    If any fail, the first exception is raised after the rest finish,
+    so that their progress isn't lost.
+    """
+    with ThreadPoolExecutor(max(1, int(max_workers))) as executor:
+        futures = [executor.submit(download) for download in downloads]
+        errors = []
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures),
+                                unit="file", disable=not progress):
+            if future.exception() is not None:
+                errors.append(future.exception())
+    if errors:
+        raise errors[0]
+
+
+def is_downloaded(filename, size=None):
+    """Whether `filename` exists (and has `size` bytes, if given)"""
+    return os.path.isfile(filename) and (
+        size is None or os.path.getsize(filename) == int(size))
+
+
+def begin_downloads(directory, filenames):
+    """
+    Mark files (or directories) in `directory` as partially downloaded
+    in its download manifest, so that verify_downloads won't trust
+    whatever an interrupted download or extraction leaves behind. Call
+    record_downloads once they're complete.
+    """
+    _update_download_manifest(
+        directory, {filename: dict(partial=True) for filename in filenames})
+
+
+def record_downloads(directory, filenames, sources=None, members=None):
+    """
+    Save the size, checksums (see file_checksum), and source of each
+    downloaded file (or directory) in `directory` to its download
+    manifest, which is then used by verify_downloads. If the files were
+    extracted from a tarball, pass its `members` (see extract_tar) too,
+    so that the extracted trees can be checked against them.
+    """
+    if sources is None or isinstance(sources, str):
+        sources = [sources] * len(filenames)
+    entries = {}
+    for filename, source in zip(filenames, sources):
+        path = os.path.join(directory, filename)
+        entries[filename] = dict(
+            size=download_size(path), source=source,
+            sampled_sha256=file_checksum(path, sample=True),
+            sha256=file_checksum(path))
+        if members is not None:
+            entries[filename]["members"] = {
+                name: size for name, size in members.items()
+                if name == filename or name.startswith(filename + "/")}
+    _update_download_manifest(directory, entries)
+
+
+def verify_downloads(directory, filenames, sizes=None, full=False):
+    """
+    Check files (or directories) in `directory` against its download
+    manifest, by size, the members of the tarball they were extracted
+    from, and sampled checksum (or the full checksum if `full` is true).
+    A file which predates the manifest is trusted if it has the expected
+    size in `sizes`, or if there is no size to check it against (with a
+    warning), and is then added to the manifest. Files marked by
+    begin_downloads, but never recorded, aren't trusted.
+
+    Returns
+    -------
+    missing : list[str]
+        The files that are missing or corrupt, and need to be downloaded
+    """
+    if sizes is None:
+        sizes = [None] * len(filenames)
+    manifest = load_download_manifest(directory)
+    missing, unrecorded = [], []
+    for filename, size in zip(filenames, sizes):
+        path = os.path.join(directory, filename)
+        entry = manifest.get(filename)
+        if entry is not None:
+            size = entry.get("size")
+        if not os.path.exists(path):
+            missing.append(filename)
+        elif entry is not None and entry.get("partial"):
+            missing.append(filename)
+        elif size is None:
+            warnings.warn(f"{path} predates the download manifest, and "
+                          f"can't be verified, so it is trusted as is. "
+                          f"Download it again if it was interrupted.")
+            unrecorded.append(filename)
+        elif download_size(path) != int(size):
+            missing.append(filename)
+        elif entry is None:
+            unrecorded.append(filename)
+        elif not _has_members(directory, entry.get("members", {})):
+            missing.append(filename)
+        elif full and file_checksum(path) != entry["sha256"]:
+            missing.append(filename)
+        elif not full and file_checksum(
+                path, sample=True) != entry["sampled_sha256"]:
+            missing.append(filename)
+
+    if unrecorded:
+        record_downloads(directory, unrecorded)
+    return missing
+
+
+def _has_members(directory, members):
+    # Whether each tarball member (relative name: size) was extracted
+    for name, size in members.items():
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+
+def _update_download_manifest(directory, entries):
+    with _download_manifest_lock:
+        manifest = load_download_manifest(directory)
+        manifest.update(entries)
+        manifestfile = os.path.join(directory, ".download-manifest.json")
+        with open(manifestfile + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(manifestfile + ".tmp", manifestfile)
+
+
+def download_size(path):
+    """Size in bytes of a file, or of all files within a directory"""
+    return sum(os.path.getsize(f) for _, f in _walk_files(path))
+
+
+def _walk_files(path):
+    # Sorted (relative name, full path) of each file in path (or itself)
+    if not os.path.isdir(path):
+        return [("", path)]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            fullpath = os.path.join(root, name)
+            files.append((os.path.relpath(fullpath, path), fullpath))
+    return files
+
+
+def extract_tar(tar, path):
+    """
+    Extract every member of the open TarFile `tar` (also in stream mode)
+    into `path`, refusing any member that would be written outside of
+    it, or that isn't a regular file, directory, or link within it
+
+    Returns
+    -------
+    members : dict[str, int]
+        Size of each regular file extracted, by its path relative to
+        `path` (see record_downloads)
+    """
+    if hasattr(tarfile, "data_filter"):
+        tar.extractall(path=path, filter="data")
+    else:
+        tar.extractall(path=path, members=_checked_tar_members(tar, path))
+    return {os.path.normpath(member.name.lstrip("/")): member.size
+            for member in tar.getmembers() if member.isfile()}
+
+
+def _checked_tar_members(tar, path):
+    # Same checks as tarfile's "data" filter, for Pythons without it
+    path = os.path.realpath(path)
+
+    def is_within(target):
+        target = os.path.realpath(os.path.join(path, target))
+        return os.path.commonpath([path, target]) == path
+
+    for member in tar:
+        if os.path.isabs(member.name) or not is_within(member.name):
+            raise tarfile.TarError(f"{member.name!r} is outside of {path}")
+        if not (member.isfile() or member.isdir() or member.issym()
+                or member.islnk()):
+            raise tarfile.TarError(f"{member.name!r} is a special file")
+        if member.issym() and (os.path.isabs(member.linkname) or
+                               not is_within(os.path.join(os.path.dirname(
+                                   member.name), member.linkname))):
+            raise tarfile.TarError(f"{member.name!r} links outside of "
+                                   f"{path}")
+        if member.islnk() and (os.path.isabs(member.linkname)
+                               or not is_within(member.linkname)):
+            raise tarfile.TarError(f"{member.name!r} links outside of "
+                                   f"{path}")
+        yield member
+
+
+def load_download_manifest(directory):
+    manifestfile = os.path.join(directory, ".download-manifest.json")
+    if not os.path.isfile(manifestfile):
+        return {}
+    with open(manifestfile) as f:
+        return json.load(f)
+
+
+_download_manifest_lock = threading.Lock()
+
+
+def file_checksum(filename, sample=False, nsamples=16, sample_size=2**16,
+                  bufsize=2**24):
+    """
+    SHA256 hex digest of a file. If `sample` is true, only `nsamples`
+    evenly spaced blocks of `sample_size` bytes (and the size) are
+    hashed, which catches truncated and most corrupted files quickly.
+    A directory is hashed as the names and contents of all its files.
+    """
+    sha256 = hashlib.sha256()
+    for name, path in _walk_files(filename):
+        if name:
+            sha256.update(name.encode() + b"\0")
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            if sample:
+                sha256.update(str(size).encode())
+                for offset in np.linspace(0, max(size - sample_size, 0),
+                                          nsamples).astype(int):
+                    f.seek(offset)
+                    sha256.update(f.read(sample_size))
+            else:
+                for block in iter(lambda: f.read(bufsize), b""):
+                    sha256.update(block)
+    return sha256.hexdigest()
+
 
 def _check_for_google_drive_error(filename, html_ok=False):
     delete_this_file = False